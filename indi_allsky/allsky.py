@@ -23,6 +23,8 @@ from .version import __version__
 from .version import __config_level__
 
 from .config import IndiAllSkyConfig
+from .uploadScheduler import IndiAllSkyUploadScheduler
+from .multipartState import IndiAllSkyMultipartState
 
 from . import constants
 
@@ -65,6 +67,7 @@ class IndiAllSky(object):
     aurora_tasks_offset = 3600          # 60 minutes
     smoke_tasks_offset = 10800          # 3 hours
     sat_data_tasks_offset = 259200      # 3 days
+    db_checkpoint_offset = 1800         # 30 minutes, WAL truncated during the day
 
 
     def __init__(self):
@@ -112,6 +115,7 @@ class IndiAllSky(object):
         self.aurora_tasks_time = time.time()    # run asap
         self.smoke_tasks_time = time.time()     # run asap
         self.sat_data_tasks_time = time.time()  # run asap
+        self.db_checkpoint_time = time.time() + self.db_checkpoint_offset
 
 
         self.position_av = Array('f', [
@@ -163,9 +167,14 @@ class IndiAllSky(object):
         self.capture_worker_idx = 0
 
         self.image_q = Queue()
-        self.image_error_q = Queue()
-        self.image_worker = None
+        self.image_worker_list = []
         self.image_worker_idx = 0
+        self.image_sequencer = None
+
+        # frames are passed to the image workers in shared memory
+        from .frameRing import IndiAllSkyFrameRing
+        frame_slots = self.config.get('IMAGE_QUEUE_MAX', 3) + self.config.get('IMAGE_WORKERS', 1) + 2
+        self.frame_ring = IndiAllSkyFrameRing(frame_slots)
 
         self.video_q = Queue()
         self.video_error_q = Queue()
@@ -178,6 +187,7 @@ class IndiAllSky(object):
         self.sensor_worker_idx = 0
 
         self.upload_q = Queue()
+        self.upload_scheduler = IndiAllSkyUploadScheduler(self.upload_q)
         self.upload_worker_list = []
         self.upload_worker_idx = 0
 
@@ -355,6 +365,7 @@ class IndiAllSky(object):
             self.sensors_user_av,
             self.night_v,
             self.moonmode_v,
+            frame_ring=self.frame_ring,
         )
         self.capture_worker.start()
 
@@ -376,28 +387,55 @@ class IndiAllSky(object):
         self.capture_worker.join()
 
 
-    def _startImageWorker(self):
+    def _startImageWorkers(self):
+        from .imageSequencer import IndiAllSkyImageSequencer
+
+        active_workers = [x for x in self.image_worker_list if x['worker'] and x['worker'].is_alive()]
+
+        if not active_workers:
+            # the worker pool is rebuilt after a reload
+            image_workers = int(self.config.get('IMAGE_WORKERS', 1))
+
+            if image_workers > 1 and self.config.get('IMAGE_STACK_COUNT', 1) > 1:
+                logger.warning('Image stacking requires a single image worker')
+                image_workers = 1
+
+            for image_worker_dict in self.image_worker_list:
+                # report errors from previous workers
+                self._imageWorkerErrors(image_worker_dict)
+
+            self.image_worker_list = list()
+            for x in range(image_workers):
+                self.image_worker_list.append({
+                    'worker'  : None,
+                    'error_q' : Queue(),
+                })
+
+            # frames are numbered from the beginning with new workers
+            self.image_sequencer = IndiAllSkyImageSequencer(workers=image_workers)
+
+
+        for image_worker_dict in self.image_worker_list:
+            self._imageWorkerStart(image_worker_dict)
+
+
+    def _imageWorkerStart(self, iw_dict):
         from .image import ImageWorker
 
-        if self.image_worker:
-            if self.image_worker.is_alive():
+        if iw_dict['worker']:
+            if iw_dict['worker'].is_alive():
                 return
 
-            try:
-                image_error, image_traceback = self.image_error_q.get_nowait()
-                for line in image_traceback.split('\n'):
-                    logger.error('Image worker exception: %s', line)
-            except queue.Empty:
-                pass
+            self._imageWorkerErrors(iw_dict)
 
 
         self.image_worker_idx += 1
 
         logger.info('Starting Image-%d worker', self.image_worker_idx)
-        self.image_worker = ImageWorker(
+        iw_dict['worker'] = ImageWorker(
             self.image_worker_idx,
             self.config,
-            self.image_error_q,
+            iw_dict['error_q'],
             self.image_q,
             self.upload_q,
             self.position_av,
@@ -408,8 +446,10 @@ class IndiAllSky(object):
             self.sensors_user_av,
             self.night_v,
             self.moonmode_v,
+            sequencer=self.image_sequencer,
+            frame_ring=self.frame_ring,
         )
-        self.image_worker.start()
+        iw_dict['worker'].start()
 
 
         if self.image_worker_idx % 10 == 0:
@@ -423,21 +463,37 @@ class IndiAllSky(object):
                 )
 
 
-    def _stopImageWorker(self):
-        if not self.image_worker:
-            return
+    def _imageWorkerErrors(self, iw_dict):
+        try:
+            image_error, image_traceback = iw_dict['error_q'].get_nowait()
+            for line in image_traceback.split('\n'):
+                logger.error('Image worker exception: %s', line)
+        except queue.Empty:
+            pass
 
-        if not self.image_worker.is_alive():
-            return
 
-        if self._terminate:
-            logger.info('Terminating Image worker')
-            self.image_worker.terminate()
+    def _stopImageWorkers(self):
+        active_worker_list = list()
+        for image_worker_dict in self.image_worker_list:
+            if not image_worker_dict['worker']:
+                continue
 
-        logger.info('Stopping Image worker')
+            if not image_worker_dict['worker'].is_alive():
+                continue
 
-        self.image_q.put({'stop' : True})
-        self.image_worker.join()
+            if self._terminate:
+                logger.info('Terminating Image worker')
+                image_worker_dict['worker'].terminate()
+
+            active_worker_list.append(image_worker_dict)
+
+            # need to put the stops in the queue before waiting on workers to join
+            self.image_q.put({'stop' : True})
+
+
+        for image_worker_dict in active_worker_list:
+            logger.info('Stopping Image worker')
+            image_worker_dict['worker'].join()
 
 
     def _startVideoWorker(self):
@@ -582,6 +638,7 @@ class IndiAllSky(object):
             self.config,
             uw_dict['error_q'],
             self.upload_q,
+            self.upload_scheduler,
         )
 
         uw_dict['worker'].start()
@@ -637,6 +694,10 @@ class IndiAllSky(object):
             self._startup()
 
 
+        # remove frames left by a previous run
+        self.frame_ring.cleanup()
+
+
         while True:
             if self._shutdown:
                 with app.app_context():
@@ -645,11 +706,13 @@ class IndiAllSky(object):
 
                 logger.warning('Shutting down')
                 self._stopCaptureWorker()  # stop this first so image queue is cleared out
-                self._stopImageWorker()
+                self._stopImageWorkers()
                 self._stopVideoWorker()
                 self._stopSensorWorker()
                 self._stopFileUploadWorkers()
 
+                self.frame_ring.cleanup()
+
 
                 with app.app_context():
                     self._miscDb.addNotification(
@@ -672,7 +735,7 @@ class IndiAllSky(object):
                 logger.warning('Restarting processes')
                 self._reload = False
                 self._stopCaptureWorker()  # stop this first so image queue is cleared out
-                self._stopImageWorker()
+                self._stopImageWorkers()
                 self._stopVideoWorker()
                 self._stopSensorWorker()
                 self._stopFileUploadWorkers()
@@ -687,7 +750,7 @@ class IndiAllSky(object):
 
             # restart worker if it has failed
             self._startCaptureWorker()
-            self._startImageWorker()
+            self._startImageWorkers()
             self._startVideoWorker()
             self._startSensorWorker()
             self._startFileUploadWorkers()
@@ -1219,6 +1282,10 @@ class IndiAllSky(object):
         db.session.commit()
 
 
+        # abandoned multipart uploads
+        IndiAllSkyMultipartState().expire()
+
+
     def _queueManualTasks(self):
         logger.info('Checking for manually submitted tasks')
         manual_tasks = IndiAllSkyDbTaskQueueTable.query\
@@ -1247,7 +1314,7 @@ class IndiAllSky(object):
             elif task.queue == TaskQueueQueue.UPLOAD:
                 logger.info('Queuing manual upload task %d', task.id)
                 task.setQueued()
-                self.upload_q.put({'task_id' : task.id})
+                self.upload_q.put(IndiAllSkyUploadScheduler.message(task))
 
             elif task.queue == TaskQueueQueue.MAIN:
                 logger.info('Picked up MAIN task')
@@ -1344,6 +1411,16 @@ class IndiAllSky(object):
             self._updateSatelliteTleData()
 
 
+        # TRUNCATE blocks writers while waiting for readers, night captures are not stalled
+        if self.db_checkpoint_time < now:
+            self.db_checkpoint_time = now + self.db_checkpoint_offset
+
+            if self.night_v.value == 0:
+                self._miscDb.walCheckpoint(mode='TRUNCATE')
+            else:
+                self._miscDb.walCheckpoint(mode='PASSIVE')
+
+
     def _updateAuroraData(self, task_state=TaskQueueState.QUEUED):
 
         active_cameras = IndiAllSkyDbCameraTable.query\
@@ -0,0 +1,218 @@
+import os
+import time
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+import logging
+
+from flask import current_app as app
+
+from .flask import db
+from .flask.models import IndiAllSkyDbThumbnailTable
+from .flask.models import IndiAllSkyDbImageTable
+from .flask.models import IndiAllSkyDbChartTable
+
+
+logger = logging.getLogger('indi_allsky')
+
+
+class IndiAllSkyAssetExpire(object):
+    # Expired entries are removed in chunks.  The files of a chunk are
+    # removed first, then the rows are deleted with a single statement.  If
+    # the run is interrupted, the remaining rows are found again by the next
+    # run and files that are already gone are ignored.
+
+    chunk_size = 500  # below the SQLite bound parameter limit
+    file_threads = 4
+    progress_interval = 30  # seconds
+
+
+    def __init__(self, task=None):
+        self.task = task
+
+        self.deleted = 0
+        self.errors = 0
+
+        self._last_progress = time.time()
+
+
+    def expire(self, query, table):
+        # query selects the entries of table to remove
+        total = query.order_by(None).count()
+        if not total:
+            return 0
+
+        logger.warning('Expiring %d %s entries', total, table.__tablename__)
+
+
+        entry_query = query\
+            .order_by(None)\
+            .with_entities(table.id, table.filename, table.thumbnail_uuid, table.camera_id, table.createDate)\
+            .order_by(table.id.asc())
+
+
+        table_deleted = 0
+        last_id = 0
+
+        with ThreadPoolExecutor(max_workers=self.file_threads) as executor:
+            while True:
+                entry_list = entry_query\
+                    .filter(table.id > last_id)\
+                    .limit(self.chunk_size)\
+                    .all()
+
+                if not entry_list:
+                    break
+
+                last_id = entry_list[-1].id
+
+
+                # thumbnails first, the entry is kept if the thumbnail cannot be removed
+                thumbnail_uuid_list = [x.thumbnail_uuid for x in entry_list if x.thumbnail_uuid]
+                failed_thumbnail_uuids = self._expireThumbnails(executor, thumbnail_uuid_list)
+
+
+                entry_list = [x for x in entry_list if x.thumbnail_uuid not in failed_thumbnail_uuids]
+
+                file_results = executor.map(self._deleteFile, [self._filesystemPath(x.filename) for x in entry_list])
+
+                delete_id_list = list()
+                for entry, removed in zip(entry_list, file_results):
+                    if removed:
+                        delete_id_list.append(entry.id)
+                    else:
+                        self.errors += 1
+
+
+                if delete_id_list:
+                    table.query\
+                        .filter(table.id.in_(delete_id_list))\
+                        .delete(synchronize_session=False)
+
+                    if table is IndiAllSkyDbImageTable:
+                        # chart entries of the removed images
+                        delete_id_set = set(delete_id_list)
+                        self._expireCharts([x for x in entry_list if x.id in delete_id_set])
+
+                    db.session.commit()
+
+
+                table_deleted += len(delete_id_list)
+                self.deleted += len(delete_id_list)
+
+                self._progress(table, table_deleted, total)
+
+
+        logger.warning('Expired %d of %d %s entries', table_deleted, total, table.__tablename__)
+
+        return table_deleted
+
+
+    def _expireThumbnails(self, executor, thumbnail_uuid_list):
+        # returns the uuids of thumbnails that could not be removed
+        failed_uuids = set()
+
+        if not thumbnail_uuid_list:
+            return failed_uuids
+
+
+        thumbnail_list = IndiAllSkyDbThumbnailTable.query\
+            .with_entities(IndiAllSkyDbThumbnailTable.id, IndiAllSkyDbThumbnailTable.uuid, IndiAllSkyDbThumbnailTable.filename)\
+            .filter(IndiAllSkyDbThumbnailTable.uuid.in_(thumbnail_uuid_list))\
+            .all()
+
+        file_results = executor.map(self._deleteFile, [self._filesystemPath(x.filename) for x in thumbnail_list])
+
+        delete_id_list = list()
+        for thumbnail, removed in zip(thumbnail_list, file_results):
+            if removed:
+                delete_id_list.append(thumbnail.id)
+            else:
+                failed_uuids.add(thumbnail.uuid)
+                self.errors += 1
+
+
+        if delete_id_list:
+            IndiAllSkyDbThumbnailTable.query\
+                .filter(IndiAllSkyDbThumbnailTable.id.in_(delete_id_list))\
+                .delete(synchronize_session=False)
+            db.session.commit()
+
+
+        return failed_uuids
+
+
+    def _expireCharts(self, entry_list):
+        # chart entries are matched by camera and createDate, committed with the images
+        camera_dates = dict()
+        for entry in entry_list:
+            camera_dates.setdefault(entry.camera_id, list()).append(entry.createDate)
+
+
+        for camera_id, createDate_list in camera_dates.items():
+            IndiAllSkyDbChartTable.query\
+                .filter(IndiAllSkyDbChartTable.camera_id == camera_id)\
+                .filter(IndiAllSkyDbChartTable.createDate.in_(createDate_list))\
+                .delete(synchronize_session=False)
+
+
+    def _filesystemPath(self, filename):
+        # same as IndiAllSkyDbFileBase.getFilesystemPath(), the app context is not available in the threads
+        if filename.startswith('/'):
+            return Path(filename)
+
+        return Path(app.config['INDI_ALLSKY_IMAGE_FOLDER']).joinpath(filename)
+
+
+    def _deleteFile(self, filename_p):
+        try:
+            filename_p.unlink()
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.error('Cannot remove file: %s', str(e))
+            return False
+
+        return True
+
+
+    def _progress(self, table, table_deleted, total):
+        now = time.time()
+
+        if now - self._last_progress < self.progress_interval:
+            return
+
+        self._last_progress = now
+
+
+        logger.info('Expired %d of %d %s entries', table_deleted, total, table.__tablename__)
+
+        if self.task:
+            self.task.result = 'Expired {0:d}/{1:d} {2:s}'.format(table_deleted, total, table.__tablename__)
+            db.session.commit()
+
+
+    def pruneEmptyFolders(self, folder):
+        # single bottom up walk, the top folder is kept
+        folder = str(folder)
+
+        removed_dirs = set()
+        for root, dirs, files in os.walk(folder, topdown=False):
+            if root == folder:
+                continue
+
+            if files:
+                continue
+
+            if any(os.path.join(root, d) not in removed_dirs for d in dirs):
+                continue
+
+
+            logger.info('Removing empty directory: %s', root)
+
+            try:
+                os.rmdir(root)
+            except OSError as e:
+                logger.error('Cannot remove folder: %s', str(e))
+                continue
+
+            removed_dirs.add(root)
@@ -0,0 +1,176 @@
+import math
+from collections import OrderedDict
+import logging
+
+from .flask.models import IndiAllSkyDbBadPixelMapTable
+from .flask.models import IndiAllSkyDbDarkFrameTable
+
+from sqlalchemy import func
+from sqlalchemy.sql.expression import true as sa_true
+
+
+logger = logging.getLogger('indi_allsky')
+
+
+class IndiAllskyCalibrationCache(object):
+    # Master darks (dark merged with bad pixel map) are kept in memory so
+    # the calibration frames do not need to be queried and read from disk
+    # for every exposure.  Entries are evicted least recently used first.
+
+    max_bytes = 256 * 1024 * 1024  # 256MB, a 20MP 16-bit master dark is ~40MB
+
+    temp_bucket_size = 1.0  # degrees
+
+
+    def __init__(self, dark_temperature_range):
+        self.dark_temperature_range = dark_temperature_range
+
+        self._cache = OrderedDict()
+        self._cache_bytes = 0
+
+        # detect darks being added/removed/deactivated by other processes
+        self._fingerprint = dict()
+
+        self.hits = 0
+        self.misses = 0
+
+
+    def key(self, camera_id, bitdepth, gain, binmode, exposure, temp):
+        # Darks are stored with integer exposures and are matched with exposure >= x,
+        # every exposure that rounds up to the same value matches the same dark
+        exposure_bucket = int(math.ceil(exposure))
+
+        temp_bucket = int(math.floor(temp / self.temp_bucket_size))
+
+        return (int(camera_id), int(bitdepth), int(gain), int(binmode), exposure_bucket, temp_bucket)
+
+
+    def get(self, key, temp):
+        self._checkFingerprint(key[0])
+
+        entry = self._cache.get(key)
+
+        if not entry:
+            self.misses += 1
+            return None
+
+
+        if not isinstance(entry['temp_min'], type(None)):
+            if temp < entry['temp_min'] or temp > entry['temp_max']:
+                logger.info('Temperature %0.1fc outside of cached calibration range, invalidating', temp)
+                self.remove(key)
+                self.misses += 1
+                return None
+
+
+        self._cache.move_to_end(key)
+        self.hits += 1
+
+        return entry
+
+
+    def add(self, key, master_dark, dark_entry, bpm_entry, dark_temp_matched, bpm_temp_matched):
+        # master_dark may be None to cache the fact that no calibration frames were found
+        self.remove(key)
+
+        temp_min = None
+        temp_max = None
+
+        # The sensor temperature range for which the matched frames remain valid
+        for entry, temp_matched in ((dark_entry, dark_temp_matched), (bpm_entry, bpm_temp_matched)):
+            if not entry or not temp_matched:
+                continue
+
+            if isinstance(entry.temp, type(None)):
+                continue
+
+            entry_temp_min = entry.temp - self.dark_temperature_range
+            entry_temp_max = entry.temp
+
+            if isinstance(temp_min, type(None)):
+                temp_min = entry_temp_min
+                temp_max = entry_temp_max
+            else:
+                temp_min = max(temp_min, entry_temp_min)
+                temp_max = min(temp_max, entry_temp_max)
+
+
+        if not isinstance(master_dark, type(None)):
+            nbytes = master_dark.nbytes
+        else:
+            nbytes = 0
+
+
+        if nbytes > self.max_bytes:
+            logger.warning('Master dark exceeds calibration cache size, not caching')
+            return
+
+
+        self._cache[key] = {
+            'master_dark' : master_dark,
+            'dark_id'     : getattr(dark_entry, 'id', None),
+            'bpm_id'      : getattr(bpm_entry, 'id', None),
+            'temp_min'    : temp_min,
+            'temp_max'    : temp_max,
+            'nbytes'      : nbytes,
+        }
+        self._cache_bytes += nbytes
+
+
+        while self._cache_bytes > self.max_bytes:
+            old_key, old_entry = self._cache.popitem(last=False)
+            self._cache_bytes -= old_entry['nbytes']
+            logger.info('Evicted master dark from calibration cache: %s', str(old_key))
+
+
+        logger.info('Calibration cache: %d entries, %0.1f MB', len(self._cache), self._cache_bytes / 1024 / 1024)
+
+
+    def remove(self, key):
+        entry = self._cache.pop(key, None)
+
+        if entry:
+            self._cache_bytes -= entry['nbytes']
+
+
+    def clear(self):
+        self._cache.clear()
+        self._cache_bytes = 0
+
+
+    def _checkFingerprint(self, camera_id):
+        # aggregate queries are much cheaper than matching and loading the calibration frames
+        dark_fp = IndiAllSkyDbDarkFrameTable.query\
+            .with_entities(
+                func.count(IndiAllSkyDbDarkFrameTable.id),
+                func.sum(IndiAllSkyDbDarkFrameTable.id),
+            )\
+            .filter(IndiAllSkyDbDarkFrameTable.camera_id == camera_id)\
+            .filter(IndiAllSkyDbDarkFrameTable.active == sa_true())\
+            .one()
+
+        bpm_fp = IndiAllSkyDbBadPixelMapTable.query\
+            .with_entities(
+                func.count(IndiAllSkyDbBadPixelMapTable.id),
+                func.sum(IndiAllSkyDbBadPixelMapTable.id),
+            )\
+            .filter(IndiAllSkyDbBadPixelMapTable.camera_id == camera_id)\
+            .filter(IndiAllSkyDbBadPixelMapTable.active == sa_true())\
+            .one()
+
+
+        fingerprint = (tuple(dark_fp), tuple(bpm_fp))
+
+        old_fingerprint = self._fingerprint.get(camera_id)
+        self._fingerprint[camera_id] = fingerprint
+
+        if isinstance(old_fingerprint, type(None)):
+            return
+
+        if fingerprint == old_fingerprint:
+            return
+
+
+        logger.warning('Calibration frames changed, invalidating calibration cache for camera %d', camera_id)
+        for key in [k for k in self._cache.keys() if k[0] == camera_id]:
+            self.remove(key)
@@ -126,6 +126,8 @@ class IndiClient(PyIndi.BaseClient):
 
         self._disconnected = False
 
+        self.frame_ring = None  # set by the capture worker
+
         logger.info('creating an instance of IndiClient')
 
         pyindi_version = '.'.join((
@@ -304,17 +306,26 @@ class IndiClient(PyIndi.BaseClient):
         blobfile = io.BytesIO(imgdata)
         hdulist = fits.open(blobfile)
 
-        try:
-            f_tmpfile = tempfile.NamedTemporaryFile(mode='w+b', delete=False, suffix='.fit')
-            f_tmpfile_p = Path(f_tmpfile.name)
+        frame = None
+        if self.frame_ring:
+            # pass the raw data to the image worker in shared memory
+            frame = self.frame_ring.put(hdulist[0].data, hdulist[0].header.tostring())
 
-            hdulist.writeto(f_tmpfile)
 
-            f_tmpfile.flush()
-            f_tmpfile.close()
-        except OSError as e:
-            logger.error('OSError: %s', str(e))
-            return
+        if frame:
+            f_tmpfile_p = None
+        else:
+            try:
+                f_tmpfile = tempfile.NamedTemporaryFile(mode='w+b', delete=False, suffix='.fit')
+                f_tmpfile_p = Path(f_tmpfile.name)
+
+                hdulist.writeto(f_tmpfile)
+
+                f_tmpfile.flush()
+                f_tmpfile.close()
+            except OSError as e:
+                logger.error('OSError: %s', str(e))
+                return
 
 
         #elapsed_s = time.time() - start
@@ -324,7 +335,8 @@ class IndiClient(PyIndi.BaseClient):
 
         ### process data in worker
         jobdata = {
-            'filename'    : str(f_tmpfile_p),
+            'filename'    : str(f_tmpfile_p) if f_tmpfile_p else None,
+            'frame'       : frame,
             'exposure'    : self.exposure,
             'exp_time'    : datetime.timestamp(exp_date),  # datetime objects are not json serializable
             'exp_elapsed' : exposure_elapsed_s,
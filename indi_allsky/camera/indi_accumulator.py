@@ -192,26 +192,37 @@ class IndiClientIndiAccumulator(IndiClient):
 
 
 
-        f_tmpfile = tempfile.NamedTemporaryFile(mode='w+b', delete=False, suffix='.fit')
+        frame = None
+        if self.frame_ring:
+            # pass the raw data to the image worker in shared memory
+            frame = self.frame_ring.put(hdulist[0].data, hdulist[0].header.tostring())
+
+
+        if frame:
+            tmpfile_p = None
+        else:
+            f_tmpfile = tempfile.NamedTemporaryFile(mode='w+b', delete=False, suffix='.fit')
+
+            try:
+                hdulist.writeto(f_tmpfile)
+                f_tmpfile.flush()
+                f_tmpfile.close()
+            except OSError as e:
+                logger.error('OSError: %s', str(e))
+                self.data = None
+                self.header = None
+                return
 
-        try:
-            hdulist.writeto(f_tmpfile)
-            f_tmpfile.flush()
-            f_tmpfile.close()
-        except OSError as e:
-            logger.error('OSError: %s', str(e))
-            self.data = None
-            self.header = None
-            return
 
+            tmpfile_p = Path(f_tmpfile.name)
 
-        tmpfile_p = Path(f_tmpfile.name)
 
         exp_date = datetime.now()
 
         ### process data in worker
         jobdata = {
-            'filename'    : str(tmpfile_p),
+            'filename'    : str(tmpfile_p) if tmpfile_p else None,
+            'frame'       : frame,
             'exposure'    : self.exposure,
             'exp_time'    : datetime.timestamp(exp_date),  # datetime objects are not json serializable
             'exp_elapsed' : exposure_elapsed_s,
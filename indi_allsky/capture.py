@@ -24,6 +24,7 @@ from . import constants
 from . import camera as camera_module
 
 from .utils import IndiAllSkyDateCalcs
+from .uploadScheduler import IndiAllSkyUploadScheduler
 
 from .flask.models import TaskQueueQueue
 from .flask.models import TaskQueueState
@@ -70,6 +71,7 @@ class CaptureWorker(Process):
         sensors_user_av,
         night_v,
         moonmode_v,
+        frame_ring=None,
     ):
 
         super(CaptureWorker, self).__init__()
@@ -94,6 +96,8 @@ class CaptureWorker(Process):
         self.night_v = night_v
         self.moonmode_v = moonmode_v
 
+        self.frame_ring = frame_ring
+
         self._miscDb = miscDb(self.config)
         self._dateCalcs = IndiAllSkyDateCalcs(self.config, self.position_av)
 
@@ -564,6 +568,8 @@ class CaptureWorker(Process):
             self.night_v,
         )
 
+        self.indiclient.frame_ring = self.frame_ring
+
 
         # set indi server localhost and port
         self.indiclient.setServer(self.config['INDI_SERVER'], self.config['INDI_PORT'])
@@ -981,7 +987,7 @@ class CaptureWorker(Process):
         db.session.add(upload_task)
         db.session.commit()
 
-        self.upload_q.put({'task_id' : upload_task.id})
+        self.upload_q.put(IndiAllSkyUploadScheduler.message(upload_task))
 
 
     def _pre_run_tasks(self):
@@ -221,6 +221,7 @@ class IndiAllSkyConfigBase(object):
         "IMAGE_QUEUE_MAX"       : 3,
         "IMAGE_QUEUE_MIN"       : 1,
         "IMAGE_QUEUE_BACKOFF"   : 0.5,
+        "IMAGE_WORKERS"         : 1,
         "FFMPEG_FRAMERATE" : 25,
         "FFMPEG_BITRATE"   : "5000k",
         "FFMPEG_VFSCALE"   : "",
@@ -335,6 +336,8 @@ class IndiAllSkyConfigBase(object):
             "PORT"                   : 0,
             "CONNECT_TIMEOUT"        : 10.0,
             "TIMEOUT"                : 60.0,
+            "PART_SIZE"              : 16,  # MB
+            "PART_THREADS"           : 4,
             "URL_TEMPLATE"           : "https://{bucket}.s3.{region}.{host}",
             "ACL"                    : "",
             "STORAGE_CLASS"          : "STANDARD",
@@ -3,6 +3,8 @@ import cv2
 import numpy
 import logging
 
+from .maskRegistry import IndiAllSkyMaskRegistry
+
 
 logger = logging.getLogger('indi_allsky')
 
@@ -23,56 +25,85 @@ class IndiAllskyDetectLines(object):
 
     mask_blur_kernel_size = 75
 
+    # detection runs on a downscaled image, each level halves the resolution
+    pyramid_levels = 1
+
+    # candidate lines are refined at full resolution within this margin
+    refine_margin = 20
+
+    # Hough is skipped when there are not enough new bright pixels since the previous frame
+    motion_prefilter = True
+    motion_threshold = 20
+    motion_min_pixels = 20
 
-    def __init__(self, config, bin_v, mask=None):
+
+    def __init__(self, config, bin_v, mask=None, mask_registry=None):
         self.config = config
         self.bin_v = bin_v
 
-        self._sqm_mask = mask
+        if mask_registry:
+            self._masks = mask_registry
+        else:
+            self._masks = IndiAllSkyMaskRegistry(self.config, self.bin_v, detection_mask=mask)
+
         self._sqm_gradient_mask = None
+        self._gradient_shape = None
 
+        self._mask_rect = None  # bounding box of the mask
+        self._small_gradient_mask = None
+        self._previous_small = None
 
-    def detectLines(self, original_img):
-        if isinstance(self._sqm_mask, type(None)):
-            # This only needs to be done once if a mask is not provided
-            self._generateSqmMask(original_img)
 
-        if isinstance(self._sqm_gradient_mask, type(None)):
-            # This only needs to be done once
+    def detectLines(self, original_img):
+        if original_img.shape[:2] != self._gradient_shape:
+            # This only needs to be done once per image size
             self._generateSqmGradientMask(original_img)
 
 
-        # apply the gradient to the image
-        masked_img = (original_img * self._sqm_gradient_mask).astype(numpy.uint8)
+        lines_start = time.time()
 
-        #cv2.imwrite('/tmp/masked.jpg', masked_img, [cv2.IMWRITE_JPEG_QUALITY, 90])  # debugging
 
+        x, y, w, h = self._mask_rect
 
         if len(original_img.shape) == 2:
-            img_gray = masked_img
+            img_gray = original_img[y:y + h, x:x + w]
         else:
-            img_gray = cv2.cvtColor(masked_img, cv2.COLOR_BGR2GRAY)
+            img_gray = cv2.cvtColor(original_img[y:y + h, x:x + w], cv2.COLOR_BGR2GRAY)
 
 
+        small_gray = img_gray
+        for i in range(self.pyramid_levels):
+            small_gray = cv2.pyrDown(small_gray)
 
-        lines_start = time.time()
+        # apply the gradient to the image
+        small_masked = cv2.multiply(small_gray, self._small_gradient_mask, scale=1 / 255)
 
-        blur_gray = cv2.GaussianBlur(img_gray, (self.blur_kernel_size, self.blur_kernel_size), cv2.BORDER_DEFAULT)
+        #cv2.imwrite('/tmp/masked.jpg', small_masked, [cv2.IMWRITE_JPEG_QUALITY, 90])  # debugging
 
 
-        edges = cv2.Canny(blur_gray, self.canny_low_threshold, self.canny_high_threshold)
+        if not self._motionDetected(small_masked):
+            lines_elapsed_s = time.time() - lines_start
+            logger.info('Line detection in %0.4f s (no motion)', lines_elapsed_s)
+            logger.info('Detected 0 lines')
+            return list()
+
+
+        factor = 2 ** self.pyramid_levels
+
+        candidates = self._houghLines(small_masked, factor)
+
+        if isinstance(candidates, type(None)):
+            lines = None
+        elif factor == 1:
+            lines = candidates
+        else:
+            lines = self._refineLines(img_gray, candidates, factor)
+
+
+        if not isinstance(lines, type(None)):
+            # back to image coordinates
+            lines = lines.reshape(-1, 1, 4) + numpy.array([x, y, x, y], dtype=lines.dtype)
 
-        # Run Hough on edge detected image
-        # Output "lines" is an array containing endpoints of detected line segments
-        lines = cv2.HoughLinesP(
-            edges,
-            self.rho,
-            self.theta,
-            self.threshold,
-            numpy.array([]),
-            self.min_line_length,
-            self.max_line_gap,
-        )
 
         lines_elapsed_s = time.time() - lines_start
         logger.info('Line detection in %0.4f s', lines_elapsed_s)
@@ -89,67 +120,139 @@ class IndiAllskyDetectLines(object):
         return lines
 
 
-    def _generateSqmMask(self, img):
-        logger.info('Generating mask based on SQM_ROI')
+    def _houghLines(self, img_gray, factor):
+        # hough parameters are scaled with the image
+        blur_kernel_size = max(3, int(self.blur_kernel_size / factor) | 1)  # must be odd
+
+        blur_gray = cv2.GaussianBlur(img_gray, (blur_kernel_size, blur_kernel_size), cv2.BORDER_DEFAULT)
 
-        image_height, image_width = img.shape[:2]
 
-        # create a black background
-        mask = numpy.zeros((image_height, image_width), dtype=numpy.uint8)
-
-        sqm_roi = self.config.get('SQM_ROI', [])
-
-        try:
-            x1 = int(sqm_roi[0] / self.bin_v.value)
-            y1 = int(sqm_roi[1] / self.bin_v.value)
-            x2 = int(sqm_roi[2] / self.bin_v.value)
-            y2 = int(sqm_roi[3] / self.bin_v.value)
-        except IndexError:
-            logger.warning('Using central ROI for blob calculations')
-            sqm_fov_div = self.config.get('SQM_FOV_DIV', 4)
-            x1 = int((image_width / 2) - (image_width / sqm_fov_div))
-            y1 = int((image_height / 2) - (image_height / sqm_fov_div))
-            x2 = int((image_width / 2) + (image_width / sqm_fov_div))
-            y2 = int((image_height / 2) + (image_height / sqm_fov_div))
-
-        # The white area is what we keep
-        cv2.rectangle(
-            img=mask,
-            pt1=(x1, y1),
-            pt2=(x2, y2),
-            color=(255),  # mono
-            thickness=cv2.FILLED,
+        edges = cv2.Canny(blur_gray, self.canny_low_threshold, self.canny_high_threshold)
+
+        # Run Hough on edge detected image
+        # Output "lines" is an array containing endpoints of detected line segments
+        lines = cv2.HoughLinesP(
+            edges,
+            self.rho,
+            self.theta,
+            int(self.threshold / factor),
+            numpy.array([]),
+            self.min_line_length / factor,
+            self.max_line_gap / factor,
         )
 
-        # mask needs to be blurred so that we do not detect it as an edge
-        self._sqm_mask = mask
+        return lines
+
+
+    def _refineLines(self, img_gray, candidates, factor):
+        height, width = img_gray.shape[:2]
+
+
+        # full resolution areas around the candidates
+        rect_list = list()
+        for x1, y1, x2, y2 in candidates.reshape(-1, 4).tolist():
+            rect_list.append([
+                max(0, (min(x1, x2) * factor) - self.refine_margin),
+                max(0, (min(y1, y2) * factor) - self.refine_margin),
+                min(width, (max(x1, x2) * factor) + factor + self.refine_margin),
+                min(height, (max(y1, y2) * factor) + factor + self.refine_margin),
+            ])
+
+
+        # merge overlapping areas so lines are only detected once
+        merged = True
+        while merged:
+            merged = False
+
+            for i in range(len(rect_list)):
+                for j in range(i + 1, len(rect_list)):
+                    a = rect_list[i]
+                    b = rect_list[j]
+
+                    if a[0] > b[2] or b[0] > a[2] or a[1] > b[3] or b[1] > a[3]:
+                        continue
+
+                    rect_list[i] = [min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])]
+                    del rect_list[j]
+                    merged = True
+                    break
+
+                if merged:
+                    break
+
+
+        line_list = list()
+        for rx1, ry1, rx2, ry2 in rect_list:
+            roi_masked = cv2.multiply(img_gray[ry1:ry2, rx1:rx2], self._sqm_gradient_mask[ry1:ry2, rx1:rx2], scale=1 / 255)
+
+            roi_lines = self._houghLines(roi_masked, 1)
+
+            if isinstance(roi_lines, type(None)):
+                continue
+
+            line_list.append(roi_lines.reshape(-1, 1, 4) + numpy.array([rx1, ry1, rx1, ry1], dtype=roi_lines.dtype))
+
+
+        if not line_list:
+            return None
+
+        return numpy.concatenate(line_list)
+
+
+    def _motionDetected(self, small_masked):
+        if not self.motion_prefilter:
+            return True
+
+
+        previous_small = self._previous_small
+        self._previous_small = small_masked
+
+        if isinstance(previous_small, type(None)):
+            return True
+
+        if previous_small.shape != small_masked.shape:
+            return True
+
+
+        # meteors and satellites only add light
+        diff = cv2.subtract(small_masked, previous_small)
+        _, diff_thresh = cv2.threshold(diff, self.motion_threshold, 255, cv2.THRESH_BINARY)
+
+        motion_pixels = cv2.countNonZero(diff_thresh)
+        #logger.info('Motion pixels: %d', motion_pixels)
+
+        return motion_pixels >= self.motion_min_pixels
 
 
     def _generateSqmGradientMask(self, img):
         image_height, image_width = img.shape[:2]
 
-        if self.config.get('IMAGE_STACK_COUNT', 1) > 1 and self.config.get('IMAGE_STACK_SPLIT'):
-            # mask center line split between panes
-            half_width = int(image_width / 2)
-            cv2.line(
-                img=self._sqm_mask,
-                pt1=(half_width, 0),
-                pt2=(half_width, image_height),
-                color=(0),  # mono
-                thickness=71,
-            )
+        split = self.config.get('IMAGE_STACK_COUNT', 1) > 1 and self.config.get('IMAGE_STACK_SPLIT')
+
+
+        # only the area inside the mask is searched
+        x, y, w, h = self._masks.boundingRect(img.shape)
+
+        if not w or not h:
+            logger.warning('Line detection mask is empty')
+            x, y, w, h = 0, 0, image_width, image_height
+
+        self._mask_rect = (x, y, w, h)
+
 
         # blur the mask to prevent mask edges from being detected as lines
-        blur_mask = cv2.blur(self._sqm_mask, (self.mask_blur_kernel_size, self.mask_blur_kernel_size), cv2.BORDER_DEFAULT)
+        blur_mask = self._masks.gradient(img.shape, self.mask_blur_kernel_size, split=split)
 
-        if len(img.shape) == 2:
-            # mono
-            mask = blur_mask
-        else:
-            # color
-            mask = cv2.cvtColor(blur_mask, cv2.COLOR_GRAY2BGR)
+        self._sqm_gradient_mask = blur_mask[y:y + h, x:x + w]
+
+
+        small_gradient_mask = self._sqm_gradient_mask
+        for i in range(self.pyramid_levels):
+            small_gradient_mask = cv2.pyrDown(small_gradient_mask)
 
-        self._sqm_gradient_mask = (mask / 255).astype(numpy.float32)
+        self._small_gradient_mask = small_gradient_mask
+        self._gradient_shape = img.shape[:2]
+        self._previous_small = None
 
 
     def _drawLines(self, img, lines):
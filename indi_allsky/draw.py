@@ -2,16 +2,21 @@ import math
 import cv2
 import logging
 
+from .maskRegistry import IndiAllSkyMaskRegistry
+
 
 logger = logging.getLogger('indi_allsky')
 
 
 class IndiAllSkyDraw(object):
-    def __init__(self, config, bin_v, mask=None):
+    def __init__(self, config, bin_v, mask=None, mask_registry=None):
         self.config = config
         self.bin_v = bin_v
 
-        self._sqm_mask = mask
+        if mask_registry:
+            self._masks = mask_registry
+        else:
+            self._masks = IndiAllSkyMaskRegistry(self.config, self.bin_v, detection_mask=mask)
 
 
     def main(self, sep_data):
@@ -21,8 +26,11 @@ class IndiAllSkyDraw(object):
         image_height, image_width = sep_data.shape[:2]
 
 
+        detection_mask = self._masks.detectionMask(sep_data.shape)
+
+
         ### ADU ROI ###
-        if isinstance(self._sqm_mask, type(None)):
+        if isinstance(detection_mask, type(None)):
             ### Draw ADU ROI if detection mask is not defined
             ###  Make sure the box calculation matches image.py
             adu_roi = self.config.get('ADU_ROI', [])
@@ -50,7 +58,7 @@ class IndiAllSkyDraw(object):
             )
         else:
             # apply mask to image
-            sep_data = cv2.bitwise_and(sep_data, sep_data, mask=self._sqm_mask)
+            sep_data = cv2.bitwise_and(sep_data, sep_data, mask=detection_mask)
 
 
         ### Keogram meridian ###
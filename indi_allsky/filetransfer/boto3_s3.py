@@ -2,6 +2,7 @@ from .generic import GenericFileTransfer
 #from .exceptions import AuthenticationFailure
 from .exceptions import ConnectionFailure
 from .exceptions import TransferFailure
+from .multipart import MultipartUpload
 
 from pathlib import Path
 #from datetime import datetime
@@ -15,6 +16,13 @@ logger = logging.getLogger('indi_allsky')
 
 
 class boto3_s3(GenericFileTransfer):
+
+    reusable = True
+
+    multipart_min_part_size = 5242880  # 5MB
+    multipart_max_parts = 10000
+
+
     def __init__(self, *args, **kwargs):
         super(boto3_s3, self).__init__(*args, **kwargs)
 
@@ -79,8 +87,12 @@ class boto3_s3(GenericFileTransfer):
         storage_class = kwargs['storage_class']
         acl = kwargs['acl']
         #metadata = kwargs['metadata']
+        part_size = kwargs.get('part_size', 0)
+        part_threads = kwargs.get('part_threads', 4)
+        multipart_state = kwargs.get('multipart_state')
 
         local_file_p = Path(local_file)
+        local_file_size = local_file_p.stat().st_size
 
 
         extra_args = dict()
@@ -116,12 +128,27 @@ class boto3_s3(GenericFileTransfer):
         start = time.time()
 
         try:
-            self.client.upload_file(
-                str(local_file_p),
-                bucket,
-                str(key),
-                ExtraArgs=extra_args,
-            )
+            if part_size and local_file_size > part_size:
+                upload = MultipartUpload(
+                    self,
+                    local_file_p,
+                    {
+                        'bucket'     : bucket,
+                        'key'        : str(key),
+                        'extra_args' : extra_args,
+                    },
+                    part_size,
+                    threads=part_threads,
+                    state=multipart_state,
+                )
+                upload.upload()
+            else:
+                self.client.upload_file(
+                    str(local_file_p),
+                    bucket,
+                    str(key),
+                    ExtraArgs=extra_args,
+                )
         except socket.gaierror as e:
             raise ConnectionFailure(str(e)) from e
         except socket.timeout as e:
@@ -140,12 +167,75 @@ class boto3_s3(GenericFileTransfer):
             raise ConnectionFailure(str(e)) from e
         except boto3.exceptions.S3UploadFailedError as e:
             raise TransferFailure(str(e)) from e
+        except botocore.exceptions.ClientError as e:
+            raise TransferFailure(str(e)) from e
 
         upload_elapsed_s = time.time() - start
-        local_file_size = local_file_p.stat().st_size
         logger.info('File transferred in %0.4f s (%0.2f kB/s)', upload_elapsed_s, local_file_size / upload_elapsed_s / 1024)
 
 
+    def multipartCreate(self, **kwargs):
+        response = self.client.create_multipart_upload(
+            Bucket=kwargs['bucket'],
+            Key=kwargs['key'],
+            **kwargs['extra_args'],
+        )
+
+        return response['UploadId']
+
+
+    def multipartPart(self, upload_id, part_number, data, **kwargs):
+        response = self.client.upload_part(
+            Bucket=kwargs['bucket'],
+            Key=kwargs['key'],
+            UploadId=upload_id,
+            PartNumber=part_number,
+            Body=data,
+        )
+
+        return response['ETag']
+
+
+    def multipartList(self, upload_id, **kwargs):
+        # returns the uploaded parts, None if the upload does not exist
+        import botocore.exceptions
+
+        parts = dict()
+
+        paginator = self.client.get_paginator('list_parts')
+
+        try:
+            for page in paginator.paginate(Bucket=kwargs['bucket'], Key=kwargs['key'], UploadId=upload_id):
+                for part in page.get('Parts', []):
+                    parts[part['PartNumber']] = part['ETag']
+        except botocore.exceptions.ClientError as e:
+            if e.response.get('Error', {}).get('Code') == 'NoSuchUpload':
+                return None
+
+            raise
+
+        return parts
+
+
+    def multipartComplete(self, upload_id, part_list, **kwargs):
+        self.client.complete_multipart_upload(
+            Bucket=kwargs['bucket'],
+            Key=kwargs['key'],
+            UploadId=upload_id,
+            MultipartUpload={
+                'Parts' : [{'PartNumber' : n, 'ETag' : etag} for n, etag in part_list],
+            },
+        )
+
+
+    def multipartAbort(self, upload_id, **kwargs):
+        self.client.abort_multipart_upload(
+            Bucket=kwargs['bucket'],
+            Key=kwargs['key'],
+            UploadId=upload_id,
+        )
+
+
     def delete(self, *args, **kwargs):
         super(boto3_s3, self).delete(*args, **kwargs)
 
@@ -1,7 +1,8 @@
 from .generic import GenericFileTransfer
 #from .exceptions import AuthenticationFailure
 from .exceptions import ConnectionFailure
-#from .exceptions import TransferFailure
+from .exceptions import TransferFailure
+from .multipart import MultipartUpload
 
 import os
 from pathlib import Path
@@ -9,6 +10,7 @@ from pathlib import Path
 #from datetime import timedelta
 import socket
 import time
+import uuid
 import requests.exceptions
 import logging
 
@@ -16,6 +18,12 @@ logger = logging.getLogger('indi_allsky')
 
 
 class gcp_storage(GenericFileTransfer):
+
+    # parts are uploaded as temporary objects and composed, compose accepts 32 objects
+    multipart_min_part_size = 5242880  # 5MB
+    multipart_max_parts = 32
+
+
     def __init__(self, *args, **kwargs):
         super(gcp_storage, self).__init__(*args, **kwargs)
 
@@ -64,6 +72,8 @@ class gcp_storage(GenericFileTransfer):
     def put(self, *args, **kwargs):
         super(gcp_storage, self).put(*args, **kwargs)
 
+        import google.api_core.exceptions
+
 
         local_file = kwargs['local_file']
         bucket = kwargs['bucket']
@@ -71,8 +81,12 @@ class gcp_storage(GenericFileTransfer):
         #storage_class = kwargs['storage_class']
         acl = kwargs['acl']
         #metadata = kwargs['metadata']
+        part_size = kwargs.get('part_size', 0)
+        part_threads = kwargs.get('part_threads', 4)
+        multipart_state = kwargs.get('multipart_state')
 
         local_file_p = Path(local_file)
+        local_file_size = local_file_p.stat().st_size
 
 
         gcp_bucket = self.client.bucket(bucket)
@@ -114,10 +128,27 @@ class gcp_storage(GenericFileTransfer):
         start = time.time()
 
         try:
-            blob.upload_from_filename(
-                str(local_file_p),
-                **upload_kwargs,
-            )
+            if part_size and local_file_size > part_size:
+                upload = MultipartUpload(
+                    self,
+                    local_file_p,
+                    {
+                        'bucket'        : bucket,
+                        'key'           : str(key),
+                        'blob'          : blob,
+                        'acl'           : acl,
+                        'content_type'  : content_type,
+                    },
+                    part_size,
+                    threads=part_threads,
+                    state=multipart_state,
+                )
+                upload.upload()
+            else:
+                blob.upload_from_filename(
+                    str(local_file_p),
+                    **upload_kwargs,
+                )
         except socket.gaierror as e:
             raise ConnectionFailure(str(e)) from e
         except socket.timeout as e:
@@ -130,12 +161,81 @@ class gcp_storage(GenericFileTransfer):
             raise ConnectionFailure(str(e)) from e
         except requests.exceptions.ReadTimeout as e:
             raise ConnectionFailure(str(e)) from e
+        except google.api_core.exceptions.GoogleAPIError as e:
+            raise TransferFailure(str(e)) from e
 
         upload_elapsed_s = time.time() - start
-        local_file_size = local_file_p.stat().st_size
         logger.info('File transferred in %0.4f s (%0.2f kB/s)', upload_elapsed_s, local_file_size / upload_elapsed_s / 1024)
 
 
+    def multipartCreate(self, **kwargs):
+        # the upload id is the name prefix of the part objects
+        return '{0:s}.multipart_{1:s}'.format(kwargs['key'], uuid.uuid4().hex)
+
+
+    def _partName(self, upload_id, part_number):
+        return '{0:s}_{1:05d}'.format(upload_id, part_number)
+
+
+    def multipartPart(self, upload_id, part_number, data, **kwargs):
+        gcp_bucket = self.client.bucket(kwargs['bucket'])
+        part_blob = gcp_bucket.blob(self._partName(upload_id, part_number))
+
+        part_blob.upload_from_string(
+            data,
+            content_type='application/octet-stream',
+            timeout=(self.connect_timeout, self.timeout),
+            retry=None,
+        )
+
+        return str(part_blob.generation)
+
+
+    def multipartList(self, upload_id, **kwargs):
+        gcp_bucket = self.client.bucket(kwargs['bucket'])
+
+        parts = dict()
+        for part_blob in self.client.list_blobs(gcp_bucket, prefix='{0:s}_'.format(upload_id), timeout=(self.connect_timeout, self.timeout)):
+            part_number = int(part_blob.name.rsplit('_', 1)[-1])
+            parts[part_number] = str(part_blob.generation)
+
+        return parts
+
+
+    def multipartComplete(self, upload_id, part_list, **kwargs):
+        gcp_bucket = self.client.bucket(kwargs['bucket'])
+        blob = kwargs['blob']
+
+        blob.content_type = kwargs['content_type']
+
+
+        source_list = [gcp_bucket.blob(self._partName(upload_id, n)) for n, generation in part_list]
+
+        blob.compose(
+            source_list,
+            timeout=(self.connect_timeout, self.timeout),
+            retry=None,
+        )
+
+
+        if kwargs['acl']:
+            blob.acl.save_predefined(kwargs['acl'], timeout=(self.connect_timeout, self.timeout))
+
+
+        self.multipartAbort(upload_id, **kwargs)
+
+
+    def multipartAbort(self, upload_id, **kwargs):
+        # remove the part objects
+        gcp_bucket = self.client.bucket(kwargs['bucket'])
+
+        part_list = list(self.client.list_blobs(gcp_bucket, prefix='{0:s}_'.format(upload_id), timeout=(self.connect_timeout, self.timeout)))
+        if not part_list:
+            return
+
+        gcp_bucket.delete_blobs(part_list, on_error=lambda x: None, timeout=(self.connect_timeout, self.timeout))
+
+
     def delete(self, *args, **kwargs):
         super(gcp_storage, self).delete(*args, **kwargs)
 
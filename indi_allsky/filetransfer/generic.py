@@ -5,6 +5,10 @@ logger = logging.getLogger('indi_allsky')
 
 
 class GenericFileTransfer(object):
+    # connected clients may be kept by the uploader for more transfers
+    reusable = False
+
+
     def __init__(self, *args, **kwargs):
         self.config = args[0]
         self.delete = kwargs.get('delete', False)
@@ -56,6 +60,11 @@ class GenericFileTransfer(object):
         pass
 
 
+    def alive(self):
+        # checked before a kept client is used again
+        return True
+
+
     def put(self, *args, **kwargs):
         if self.delete:
             # perform delete instead of upload
@@ -3,6 +3,7 @@ from .exceptions import AuthenticationFailure
 from .exceptions import ConnectionFailure
 #from .exceptions import TransferFailure
 
+import io
 from pathlib import Path
 #from datetime import datetime
 #from datetime import timedelta
@@ -62,8 +63,10 @@ class libcloud_s3(GenericFileTransfer):
         storage_class = kwargs['storage_class']
         acl = kwargs['acl']
         #metadata = kwargs['metadata']
+        part_size = kwargs.get('part_size', 0)
 
         local_file_p = Path(local_file)
+        local_file_size = local_file_p.stat().st_size
 
 
         container = self.client.get_container(container_name=bucket)
@@ -97,13 +100,24 @@ class libcloud_s3(GenericFileTransfer):
         start = time.time()
 
         try:
-            self.client.upload_object(
-                str(local_file_p),
-                container,
-                str(key),
-                ex_storage_class=storage_class.lower(),  # expects lower case keys
-                extra=extra_args,
-            )
+            if part_size and local_file_size > part_size:
+                # libcloud performs a multipart upload for streams, parts are not resumed
+                with io.open(str(local_file_p), 'rb') as f_localfile:
+                    self.client.upload_object_via_stream(
+                        f_localfile,
+                        container,
+                        str(key),
+                        ex_storage_class=storage_class.lower(),  # expects lower case keys
+                        extra=extra_args,
+                    )
+            else:
+                self.client.upload_object(
+                    str(local_file_p),
+                    container,
+                    str(key),
+                    ex_storage_class=storage_class.lower(),  # expects lower case keys
+                    extra=extra_args,
+                )
         except socket.gaierror as e:
             raise ConnectionFailure(str(e)) from e
         except socket.timeout as e:
@@ -114,7 +128,6 @@ class libcloud_s3(GenericFileTransfer):
             raise AuthenticationFailure(str(e)) from e
 
         upload_elapsed_s = time.time() - start
-        local_file_size = local_file_p.stat().st_size
         logger.info('File transferred in %0.4f s (%0.2f kB/s)', upload_elapsed_s, local_file_size / upload_elapsed_s / 1024)
 
 
@@ -0,0 +1,189 @@
+import io
+import math
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import as_completed
+from concurrent.futures import wait
+import logging
+
+logger = logging.getLogger('indi_allsky')
+
+
+class MultipartState(object):
+    # Progress of multipart uploads.  This state is only kept in memory, the
+    # uploader provides a state that is stored in the database.
+
+    def __init__(self):
+        self._uploads = dict()
+
+
+    def _key(self, identity):
+        return tuple(sorted(identity.items()))
+
+
+    def load(self, identity):
+        # returns the upload id and a dict of completed parts, None if not found
+        saved = self._uploads.get(self._key(identity))
+        if not saved:
+            return None
+
+        upload_id, parts = saved
+        return upload_id, dict(parts)
+
+
+    def stale(self, identity):
+        # upload ids of older uploads of the same key
+        return list()
+
+
+    def save(self, identity, upload_id, parts):
+        self._uploads[self._key(identity)] = (upload_id, dict(parts))
+
+
+    def remove(self, identity):
+        self._uploads.pop(self._key(identity), None)
+
+
+class MultipartUpload(object):
+    # Uploads a large file in parts.  Parts are uploaded in parallel and every
+    # completed part is recorded in the state, an interrupted upload continues
+    # with the missing parts when the same file is uploaded again.
+    #
+    # The client implements multipartCreate(), multipartPart(), multipartList(),
+    # multipartComplete() and multipartAbort().  Exceptions of the client are
+    # raised from upload().
+
+    def __init__(self, client, local_file_p, upload_kwargs, part_size, threads=4, state=None):
+        self.client = client
+        self.local_file_p = local_file_p
+        self.upload_kwargs = upload_kwargs
+        self.threads = max(int(threads), 1)
+
+        if isinstance(state, type(None)):
+            state = MultipartState()
+
+        self.state = state
+
+
+        file_st = self.local_file_p.stat()
+        self.size = file_st.st_size
+        self.mtime = file_st.st_mtime
+
+
+        # parts are larger when the file exceeds the part limit of the service
+        self.part_size = max(
+            int(part_size),
+            client.multipart_min_part_size,
+            math.ceil(self.size / client.multipart_max_parts),
+        )
+
+        self.part_count = max(math.ceil(self.size / self.part_size), 1)
+
+
+        self.identity = {
+            'classname' : client.__class__.__name__,
+            'bucket'    : str(upload_kwargs['bucket']),
+            'key'       : str(upload_kwargs['key']),
+            'filename'  : str(self.local_file_p),
+            'size'      : self.size,
+            'mtime'     : self.mtime,
+            'part_size' : self.part_size,
+        }
+
+
+    def upload(self):
+        self._abortStale()
+
+        upload_id, parts = self._resume()
+
+        if not upload_id:
+            upload_id = self.client.multipartCreate(**self.upload_kwargs)
+            parts = dict()
+
+            self.state.save(self.identity, upload_id, parts)
+
+
+        missing_list = [n for n in range(1, self.part_count + 1) if n not in parts]
+
+        logger.info(
+            'Multipart upload of %s: %d parts of %d bytes, %d remaining',
+            self.local_file_p.name,
+            self.part_count,
+            self.part_size,
+            len(missing_list),
+        )
+
+
+        with ThreadPoolExecutor(max_workers=self.threads) as executor:
+            future_dict = {executor.submit(self._uploadPart, upload_id, n): n for n in missing_list}
+
+            try:
+                for future in as_completed(future_dict):
+                    parts[future_dict[future]] = future.result()
+                    self.state.save(self.identity, upload_id, parts)
+            except Exception:
+                # record the parts that are still finishing
+                for future in future_dict:
+                    future.cancel()
+
+                wait(future_dict)
+
+                for future, n in future_dict.items():
+                    if future.cancelled() or future.exception():
+                        continue
+
+                    parts[n] = future.result()
+
+                self.state.save(self.identity, upload_id, parts)
+
+                logger.error('Multipart upload of %s interrupted, %d of %d parts done', self.local_file_p.name, len(parts), self.part_count)
+                raise
+
+
+        part_list = [(n, parts[n]) for n in sorted(parts.keys())]
+        self.client.multipartComplete(upload_id, part_list, **self.upload_kwargs)
+
+        self.state.remove(self.identity)
+
+
+    def _resume(self):
+        # returns the upload id and the completed parts of a previous attempt
+        saved = self.state.load(self.identity)
+        if not saved:
+            return None, dict()
+
+        upload_id, parts = saved
+
+
+        remote_parts = self.client.multipartList(upload_id, **self.upload_kwargs)
+        if isinstance(remote_parts, type(None)):
+            logger.warning('Multipart upload of %s no longer exists, starting over', self.local_file_p.name)
+            self.state.remove(self.identity)
+            return None, dict()
+
+
+        # only parts that are complete on both sides are kept
+        parts = {n: etag for n, etag in parts.items() if remote_parts.get(n) == etag}
+
+        logger.warning('Resuming multipart upload of %s, %d of %d parts done', self.local_file_p.name, len(parts), self.part_count)
+
+        return upload_id, parts
+
+
+    def _abortStale(self):
+        # uploads of a previous version of the file are not continued
+        for upload_id in self.state.stale(self.identity):
+            logger.warning('Aborting stale multipart upload of %s', self.identity['key'])
+
+            try:
+                self.client.multipartAbort(upload_id, **self.upload_kwargs)
+            except Exception as e:
+                logger.error('Unable to abort multipart upload: %s', str(e))
+
+
+    def _uploadPart(self, upload_id, part_number):
+        # runs in the executor threads
+        with io.open(str(self.local_file_p), 'rb') as f_localfile:
+            f_localfile.seek((part_number - 1) * self.part_size)
+            data = f_localfile.read(self.part_size)
+
+        return self.client.multipartPart(upload_id, part_number, data, **self.upload_kwargs)
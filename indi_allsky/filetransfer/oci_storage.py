@@ -1,7 +1,8 @@
 from .generic import GenericFileTransfer
 #from .exceptions import AuthenticationFailure
 from .exceptions import ConnectionFailure
-#from .exceptions import TransferFailure
+from .exceptions import TransferFailure
+from .multipart import MultipartUpload
 
 #import os
 import io
@@ -17,6 +18,11 @@ logger = logging.getLogger('indi_allsky')
 
 
 class oci_storage(GenericFileTransfer):
+
+    multipart_min_part_size = 10485760  # 10MB
+    multipart_max_parts = 10000
+
+
     def __init__(self, *args, **kwargs):
         super(oci_storage, self).__init__(*args, **kwargs)
 
@@ -59,6 +65,8 @@ class oci_storage(GenericFileTransfer):
     def put(self, *args, **kwargs):
         super(oci_storage, self).put(*args, **kwargs)
 
+        import oci
+
         local_file = kwargs['local_file']
         bucket = kwargs['bucket']
         key = kwargs['key']
@@ -66,8 +74,12 @@ class oci_storage(GenericFileTransfer):
         #storage_class = kwargs['storage_class']
         #acl = kwargs['acl']
         #metadata = kwargs['metadata']
+        part_size = kwargs.get('part_size', 0)
+        part_threads = kwargs.get('part_threads', 4)
+        multipart_state = kwargs.get('multipart_state')
 
         local_file_p = Path(local_file)
+        local_file_size = local_file_p.stat().st_size
 
         #extra_args = dict()
 
@@ -102,14 +114,30 @@ class oci_storage(GenericFileTransfer):
         start = time.time()
 
         try:
-            with io.open(str(local_file_p), 'rb') as f_localfile:
-                self.client.put_object(
-                    namespace,
-                    bucket,
-                    str(key),
-                    f_localfile,
-                    **upload_kwargs,
+            if part_size and local_file_size > part_size:
+                upload = MultipartUpload(
+                    self,
+                    local_file_p,
+                    {
+                        'namespace'     : namespace,
+                        'bucket'        : bucket,
+                        'key'           : str(key),
+                        'upload_kwargs' : upload_kwargs,
+                    },
+                    part_size,
+                    threads=part_threads,
+                    state=multipart_state,
                 )
+                upload.upload()
+            else:
+                with io.open(str(local_file_p), 'rb') as f_localfile:
+                    self.client.put_object(
+                        namespace,
+                        bucket,
+                        str(key),
+                        f_localfile,
+                        **upload_kwargs,
+                    )
         except socket.gaierror as e:
             raise ConnectionFailure(str(e)) from e
         except socket.timeout as e:
@@ -122,12 +150,89 @@ class oci_storage(GenericFileTransfer):
             raise ConnectionFailure(str(e)) from e
         except requests.exceptions.ReadTimeout as e:
             raise ConnectionFailure(str(e)) from e
+        except oci.exceptions.ServiceError as e:
+            raise TransferFailure(str(e)) from e
 
         upload_elapsed_s = time.time() - start
-        local_file_size = local_file_p.stat().st_size
         logger.info('File transferred in %0.4f s (%0.2f kB/s)', upload_elapsed_s, local_file_size / upload_elapsed_s / 1024)
 
 
+    def multipartCreate(self, **kwargs):
+        import oci
+
+        details = oci.object_storage.models.CreateMultipartUploadDetails(
+            object=kwargs['key'],
+            **kwargs['upload_kwargs'],
+        )
+
+        response = self.client.create_multipart_upload(
+            kwargs['namespace'],
+            kwargs['bucket'],
+            details,
+        )
+
+        return response.data.upload_id
+
+
+    def multipartPart(self, upload_id, part_number, data, **kwargs):
+        response = self.client.upload_part(
+            kwargs['namespace'],
+            kwargs['bucket'],
+            kwargs['key'],
+            upload_id,
+            part_number,
+            data,
+        )
+
+        return response.headers['etag']
+
+
+    def multipartList(self, upload_id, **kwargs):
+        # returns the uploaded parts, None if the upload does not exist
+        import oci
+
+        try:
+            response = oci.pagination.list_call_get_all_results(
+                self.client.list_multipart_upload_parts,
+                kwargs['namespace'],
+                kwargs['bucket'],
+                kwargs['key'],
+                upload_id,
+            )
+        except oci.exceptions.ServiceError as e:
+            if e.status == 404:
+                return None
+
+            raise
+
+        return {x.part_number: x.etag for x in response.data}
+
+
+    def multipartComplete(self, upload_id, part_list, **kwargs):
+        import oci
+
+        details = oci.object_storage.models.CommitMultipartUploadDetails(
+            parts_to_commit=[oci.object_storage.models.CommitMultipartUploadPartDetails(part_num=n, etag=etag) for n, etag in part_list],
+        )
+
+        self.client.commit_multipart_upload(
+            kwargs['namespace'],
+            kwargs['bucket'],
+            kwargs['key'],
+            upload_id,
+            details,
+        )
+
+
+    def multipartAbort(self, upload_id, **kwargs):
+        self.client.abort_multipart_upload(
+            kwargs['namespace'],
+            kwargs['bucket'],
+            kwargs['key'],
+            upload_id,
+        )
+
+
     def delete(self, *args, **kwargs):
         super(oci_storage, self).delete(*args, **kwargs)
 
@@ -12,6 +12,10 @@ logger = logging.getLogger('indi_allsky')
 
 
 class paramiko_sftp(GenericFileTransfer):
+
+    reusable = True
+
+
     def __init__(self, *args, **kwargs):
         super(paramiko_sftp, self).__init__(*args, **kwargs)
 
@@ -82,6 +86,17 @@ class paramiko_sftp(GenericFileTransfer):
             self.client.close()
 
 
+    def alive(self):
+        if not self.client:
+            return False
+
+        transport = self.client.get_transport()
+        if not transport:
+            return False
+
+        return transport.is_active()
+
+
     def put(self, *args, **kwargs):
         super(paramiko_sftp, self).put(*args, **kwargs)
 
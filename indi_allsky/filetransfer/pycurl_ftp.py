@@ -13,6 +13,10 @@ logger = logging.getLogger('indi_allsky')
 
 
 class pycurl_ftp(GenericFileTransfer):
+
+    reusable = True  # libcurl keeps the connection of the handle
+
+
     def __init__(self, *args, **kwargs):
         super(pycurl_ftp, self).__init__(*args, **kwargs)
 
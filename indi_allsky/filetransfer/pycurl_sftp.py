@@ -14,6 +14,10 @@ logger = logging.getLogger('indi_allsky')
 
 
 class pycurl_sftp(GenericFileTransfer):
+
+    reusable = True  # libcurl keeps the connection of the handle
+
+
     def __init__(self, *args, **kwargs):
         super(pycurl_sftp, self).__init__(*args, **kwargs)
 
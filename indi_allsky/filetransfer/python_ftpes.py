@@ -15,6 +15,10 @@ logger = logging.getLogger('indi_allsky')
 
 
 class python_ftpes(GenericFileTransfer):
+
+    reusable = True
+
+
     def __init__(self, *args, **kwargs):
         super(python_ftpes, self).__init__(*args, **kwargs)
 
@@ -60,6 +64,18 @@ class python_ftpes(GenericFileTransfer):
             self.client.quit()
 
 
+    def alive(self):
+        if not self.client:
+            return False
+
+        try:
+            self.client.voidcmd('NOOP')
+        except ftplib.all_errors:
+            return False
+
+        return True
+
+
     def put(self, *args, **kwargs):
         super(python_ftpes, self).put(*args, **kwargs)
 
@@ -27,6 +27,9 @@ logger = logging.getLogger('indi_allsky')
 
 class requests_syncapi_v1(GenericFileTransfer):
 
+    reusable = True
+
+
     time_skew = 300  # number of seconds the client is allowed to deviate from server
 
 
@@ -59,7 +62,7 @@ class requests_syncapi_v1(GenericFileTransfer):
         self.url = endpoint_url
 
 
-        self.client = requests
+        self.client = requests.Session()  # keep-alive
 
 
         if cert_bypass:
@@ -70,8 +73,14 @@ class requests_syncapi_v1(GenericFileTransfer):
     def close(self):
         super(requests_syncapi_v1, self).close()
 
+        if self.client:
+            self.client.close()
+
 
     def put(self, *args, **kwargs):
+        if kwargs.get('batch'):
+            return self.putBatch(*args, **kwargs)
+
         super(requests_syncapi_v1, self).put(*args, **kwargs)
 
         metadata = kwargs['metadata']
@@ -122,21 +131,8 @@ class requests_syncapi_v1(GenericFileTransfer):
         mp_enc = MultipartEncoder(fields=fields)
 
 
-        time_floor = math.floor(time.time() / self.time_skew)
-
-        # data is received as bytes
-        hmac_message = str(time_floor).encode() + json_metadata.encode()
-
-        message_hmac = hmac.new(
-            self.apikey.encode(),
-            msg=hmac_message,
-            digestmod=hashlib.sha3_512,
-        ).hexdigest()
-
-
         headers = {
-            'Authorization' : 'Bearer {0:s}:{1:s}'.format(self.username, message_hmac),
-            'Connection'    : 'close',  # no need for keep alives
+            'Authorization' : self._authorization(json_metadata),
             'Content-Type'  : mp_enc.content_type,
         }
 
@@ -181,3 +177,135 @@ class requests_syncapi_v1(GenericFileTransfer):
 
         return json.loads(r.text)
 
+
+    def putBatch(self, *args, **kwargs):
+        # multiple entries in a single request to the batch endpoint
+        # returns a result for each entry, either the id or an error
+        batch = kwargs['batch']
+        empty_file = kwargs['empty_file']
+
+
+        logger.info('Uploading batch of %d entries', len(batch))
+
+
+        manifest = {
+            'entries' : list(),
+        }
+
+        fields = dict()
+        batch_size = 0
+
+        try:
+            for i, batch_entry in enumerate(batch):
+                metadata = batch_entry['metadata']
+                local_file_p = Path(batch_entry['local_file'])
+
+                if str(local_file_p) == 'camera':
+                    # cameras do not have files
+                    local_file_p = Path('bogus.ext')
+                    local_file_size = 0
+                    f_media = io.BytesIO(b'')  # no data
+                    metadata['file_size'] = 0
+                elif not empty_file:
+                    local_file_size = local_file_p.stat().st_size
+                    metadata['file_size'] = local_file_size  # needed to validate
+                    f_media = io.open(str(local_file_p), 'rb')
+                else:
+                    local_file_size = 0
+                    f_media = io.BytesIO(b'')  # no data
+                    metadata['file_size'] = 0
+
+                batch_size += local_file_size
+
+
+                media_field = 'media_{0:d}'.format(i)
+
+                fields[media_field] = (
+                    local_file_p.name,  # need file extension from original file
+                    f_media,
+                    'application/octet-stream',
+                )
+
+                manifest['entries'].append({
+                    'metadata' : metadata,
+                    'media'    : media_field,
+                })
+
+
+            json_manifest = json.dumps(manifest)
+
+            fields['metadata'] = (
+                'metadata.json',
+                io.StringIO(json_manifest),
+                'application/json',
+            )
+
+
+            mp_enc = MultipartEncoder(fields=fields)
+
+            headers = {
+                'Authorization' : self._authorization(json_manifest),
+                'Content-Type'  : mp_enc.content_type,
+            }
+
+
+            start = time.time()
+
+            try:
+                # put allows overwrites
+                r = self.client.put(
+                    self.url,
+                    data=mp_enc,
+                    headers=headers,
+                    verify=self.verify,
+                    timeout=(self.connect_timeout, self.timeout)
+                )
+            except socket.gaierror as e:
+                raise ConnectionFailure(str(e)) from e
+            except socket.timeout as e:
+                raise ConnectionFailure(str(e)) from e
+            except requests.exceptions.ConnectTimeout as e:
+                raise ConnectionFailure(str(e)) from e
+            except requests.exceptions.ConnectionError as e:
+                raise ConnectionFailure(str(e)) from e
+            except requests.exceptions.ReadTimeout as e:
+                raise ConnectionFailure(str(e)) from e
+            except ssl.SSLCertVerificationError as e:
+                raise CertificateValidationFailure(str(e)) from e
+            except requests.exceptions.SSLError as e:
+                raise CertificateValidationFailure(str(e)) from e
+        finally:
+            for field in fields.values():
+                field[1].close()
+
+
+        if r.status_code >= 400:
+            # older servers do not have the batch endpoint
+            raise TransferFailure('Sync batch error: {0:d}'.format(r.status_code))
+
+
+        result_list = json.loads(r.text).get('results', [])
+        if len(result_list) != len(batch):
+            raise TransferFailure('Sync batch returned {0:d} of {1:d} results'.format(len(result_list), len(batch)))
+
+
+        upload_elapsed_s = time.time() - start
+        logger.info('Batch transferred in %0.4f s (%0.2f kB/s)', upload_elapsed_s, batch_size / upload_elapsed_s / 1024)
+
+
+        return result_list
+
+
+    def _authorization(self, json_data):
+        time_floor = math.floor(time.time() / self.time_skew)
+
+        # data is received as bytes
+        hmac_message = str(time_floor).encode() + json_data.encode()
+
+        message_hmac = hmac.new(
+            self.apikey.encode(),
+            msg=hmac_message,
+            digestmod=hashlib.sha3_512,
+        ).hexdigest()
+
+        return 'Bearer {0:s}:{1:s}'.format(self.username, message_hmac)
@@ -0,0 +1,208 @@
+import math
+import time
+import hashlib
+from pathlib import Path
+import numpy
+import cv2
+import logging
+
+
+logger = logging.getLogger('indi_allsky')
+
+
+class IndiAllskyFish2PanoMap(object):
+    # The fisheye to panorama projection only depends on the image size and
+    # the FISH2PANO settings.  The remap tables are built once, with the
+    # rotation folded in, and stored on disk.  Each panorama is a single
+    # cv2.remap() call.
+
+    map_folder = Path('/var/lib/indi-allsky/fish2pano')
+
+    # old tables for other image sizes or settings
+    map_keep = 5
+
+
+    def __init__(self, config):
+        self.config = config
+
+        self._key = None
+        self._map1 = None
+        self._map2 = None
+
+
+    def remap(self, image):
+        image_height, image_width = image.shape[:2]
+
+        key = self.key(image_height, image_width)
+
+        if key != self._key:
+            self._loadMaps(key, image_height, image_width)
+
+
+        fish2pano_start = time.time()
+
+        img_pano = cv2.remap(
+            image,
+            self._map1,
+            self._map2,
+            interpolation=cv2.INTER_LINEAR,
+            borderMode=cv2.BORDER_CONSTANT,
+            borderValue=0,
+        )
+
+        fish2pano_elapsed_s = time.time() - fish2pano_start
+        logger.info('Panorama in %0.4f s', fish2pano_elapsed_s)
+
+        return img_pano
+
+
+    def key(self, image_height, image_width):
+        fish2pano_config = self.config.get('FISH2PANO', {})
+
+        params = (
+            int(image_height),
+            int(image_width),
+            int(fish2pano_config.get('DIAMETER', 3000)),
+            int(fish2pano_config.get('OFFSET_X', 0)),
+            int(fish2pano_config.get('OFFSET_Y', 0)),
+            int(fish2pano_config.get('ROTATE_ANGLE', 0)),
+            float(fish2pano_config.get('SCALE', 0.3)),
+        )
+
+        return params
+
+
+    def _loadMaps(self, key, image_height, image_width):
+        key_str = '_'.join([str(x) for x in key])
+        map_p = self.map_folder.joinpath('fish2pano_{0:s}.npz'.format(hashlib.md5(key_str.encode()).hexdigest()))
+
+
+        map_x = None
+        map_y = None
+
+        if map_p.exists():
+            try:
+                with numpy.load(str(map_p)) as map_data:
+                    if map_data['key'].tolist() == list(key):
+                        map_x = map_data['map_x']
+                        map_y = map_data['map_y']
+            except (OSError, ValueError, KeyError) as e:
+                logger.error('Unable to load panorama map %s: %s', map_p, str(e))
+
+
+        if isinstance(map_x, type(None)):
+            map_start = time.time()
+
+            map_x, map_y = self._buildMaps(image_height, image_width)
+
+            map_elapsed_s = time.time() - map_start
+            logger.info('Panorama map generated in %0.4f s', map_elapsed_s)
+
+            self._saveMaps(map_p, key, map_x, map_y)
+        else:
+            logger.info('Loaded panorama map: %s', map_p)
+
+
+        # fixed point maps are faster to remap
+        self._map1, self._map2 = cv2.convertMaps(map_x, map_y, cv2.CV_16SC2)
+        self._key = key
+
+
+    def _buildMaps(self, image_height, image_width):
+        ### Projection courtesy of Russell Valentine <russell.valentine@gmail.com>
+        ### https://github.com/bluthen/fish2pano
+        fish2pano_config = self.config.get('FISH2PANO', {})
+
+        angle = fish2pano_config.get('ROTATE_ANGLE', 0)
+        x_offset = fish2pano_config.get('OFFSET_X', 0)
+        y_offset = fish2pano_config.get('OFFSET_Y', 0)
+        radius = fish2pano_config.get('DIAMETER', 3000) / 2
+        scale = fish2pano_config.get('SCALE', 0.3)
+
+
+        if angle:
+            # the image is rotated into a larger canvas
+            center_x = int(image_width / 2)
+            center_y = int(image_height / 2)
+
+            rot = cv2.getRotationMatrix2D((center_x, center_y), int(angle), 1.0)
+
+            abs_cos = abs(rot[0, 0])
+            abs_sin = abs(rot[0, 1])
+
+            rot_width = int(image_height * abs_sin + image_width * abs_cos)
+            rot_height = int(image_height * abs_cos + image_width * abs_sin)
+
+            rot[0, 2] += rot_width / 2 - center_x
+            rot[1, 2] += rot_height / 2 - center_y
+
+            # canvas coordinates to original image coordinates
+            inv_rot = cv2.invertAffineTransform(rot)
+        else:
+            rot_width = image_width
+            rot_height = image_height
+            inv_rot = None
+
+
+        center_x = int(rot_width / 2) + x_offset
+        center_y = int(rot_height / 2) - y_offset  # note minus for y
+
+
+        w = int(scale * 2 * math.pi * radius + 0.5)
+        h = int(scale * radius + 0.5)
+
+        # width and height needs to be divisible by 2 for timelapse
+        mod_height = h % 2
+        mod_width = w % 2
+
+
+        theta = (2.0 * math.pi) * numpy.arange(0, w - mod_width, dtype=numpy.float64) / w
+        r_0 = radius * numpy.arange(mod_height, h, dtype=numpy.float64) / h  # trim the top
+
+        canvas_x = r_0[:, None] * numpy.cos(theta)[None, :] + center_x
+        canvas_y = r_0[:, None] * numpy.sin(theta)[None, :] + center_y
+
+
+        # pixels outside of the canvas are black
+        outside = (canvas_x < 0) | (canvas_x >= rot_width) | (canvas_y < 0) | (canvas_y >= rot_height)
+
+
+        if not isinstance(inv_rot, type(None)):
+            map_x = inv_rot[0, 0] * canvas_x + inv_rot[0, 1] * canvas_y + inv_rot[0, 2]
+            map_y = inv_rot[1, 0] * canvas_x + inv_rot[1, 1] * canvas_y + inv_rot[1, 2]
+        else:
+            map_x = canvas_x
+            map_y = canvas_y
+
+
+        map_x[outside] = -1
+        map_y[outside] = -1
+
+        return map_x.astype(numpy.float32), map_y.astype(numpy.float32)
+
+
+    def _saveMaps(self, map_p, key, map_x, map_y):
+        try:
+            if not self.map_folder.exists():
+                self.map_folder.mkdir(mode=0o755, parents=True)
+
+            map_tmp_p = map_p.with_suffix('.npz_tmp')
+
+            with map_tmp_p.open('wb') as f_map:
+                numpy.savez(f_map, key=numpy.array(key, dtype=numpy.float64), map_x=map_x, map_y=map_y)
+
+            map_tmp_p.replace(map_p)
+        except OSError as e:
+            logger.error('Unable to save panorama map %s: %s', map_p, str(e))
+            return
+
+
+        # remove old maps
+        map_list = sorted(self.map_folder.glob('fish2pano_*.npz'), key=lambda p: p.stat().st_mtime, reverse=True)
+        for old_map_p in map_list[self.map_keep:]:
+            logger.info('Removing old panorama map: %s', old_map_p)
+
+            try:
+                old_map_p.unlink()
+            except OSError as e:
+                logger.error('Unable to remove panorama map %s: %s', old_map_p, str(e))
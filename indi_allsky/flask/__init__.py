@@ -11,10 +11,16 @@ from flask_wtf.csrf import CSRFProtect
 
 from flask_login import LoginManager
 
+from .dbProfiles import SQLITE_PROFILES
+from .dbProfiles import IndiAllSkyDbMetrics
+
 db = SQLAlchemy()
 migrate = Migrate()
 csrf = CSRFProtect()
 
+# lock contention counters of each role in this process
+db_metrics = dict()
+
 from .views import bp_allsky  # noqa: E402
 from .auth_views import bp_auth_allsky  # noqa: E402
 from .syncapi_views import bp_syncapi_allsky  # noqa: E402
@@ -70,15 +76,18 @@ dictConfig({
 })
 
 
-def _sqlite_pragma_on_connect(dbapi_con, con_record):
-    dbapi_con.execute('PRAGMA journal_mode=WAL')
-    dbapi_con.execute('PRAGMA synchronous=NORMAL')
-    dbapi_con.execute('PRAGMA busy_timeout=20000')
-    #dbapi_con.execute('PRAGMA read_uncommitted=ON')
-    #dbapi_con.execute('PRAGMA foreign_keys=ON')
+def _sqlite_pragma_profile(profile):
+    def _sqlite_pragma_on_connect(dbapi_con, con_record):
+        for k, v in profile.items():
+            dbapi_con.execute('PRAGMA {0:s}={1}'.format(k, v))
+
+        #dbapi_con.execute('PRAGMA read_uncommitted=ON')
+        #dbapi_con.execute('PRAGMA foreign_keys=ON')
+
+    return _sqlite_pragma_on_connect
 
 
-def create_app():
+def create_app(role='worker'):
     """Construct the core application."""
     app = Flask(
         __name__,
@@ -120,8 +129,17 @@ def create_app():
     with app.app_context():
         from sqlalchemy import event
 
+        app.config['INDI_ALLSKY_DB_ROLE'] = role
+
         if app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
-            event.listen(db.engine, 'connect', _sqlite_pragma_on_connect)
+            event.listen(db.engine, 'connect', _sqlite_pragma_profile(SQLITE_PROFILES[role]))
+
+            if role not in db_metrics:
+                db_metrics[role] = IndiAllSkyDbMetrics(role)
+
+            event.listen(db.engine, 'before_cursor_execute', db_metrics[role].beforeExecute)
+            event.listen(db.engine, 'after_cursor_execute', db_metrics[role].afterExecute)
+            event.listen(db.engine, 'handle_error', db_metrics[role].handleError)
 
         #from . import views  # noqa: F401
 
@@ -37,6 +37,7 @@ from .models import IndiAllSkyDbCameraTable
 from .forms import IndiAllskyCameraSelectForm
 
 from .miscDb import miscDb
+from .responseCache import IndiAllSkyResponseCache
 
 #from ..exceptions import ConfigSaveException
 
@@ -952,9 +953,45 @@ class FormView(TemplateView):
 
 
 class JsonView(BaseView):
+    # polled responses are cached for this many seconds, 0 disables caching
+    cache_seconds = 0
+
+    # responses depend on the client being in an admin network
+    cache_vary_admin_network = False
+
+
     def dispatch_request(self):
-        json_data = self.get_objects()
-        return jsonify(json_data)
+        if not self.cache_seconds:
+            json_data = self.get_objects()
+            return jsonify(json_data)
+
+
+        response_cache = IndiAllSkyResponseCache()
+
+        cache_key = response_cache.key(
+            response_cache.generation(),
+            request.endpoint,
+            sorted(request.args.items(multi=True)),
+            current_user.is_authenticated,
+            self.cache_vary_admin_network and self.verify_admin_network(),
+        )
+
+
+        cache_entry = response_cache.get(cache_key, self.cache_seconds)
+
+        if cache_entry:
+            etag, body = cache_entry
+            response = app.response_class(body, mimetype='application/json')
+        else:
+            response = jsonify(self.get_objects())
+            etag = response_cache.put(cache_key, response.get_data())
+
+
+        response.set_etag(etag)
+        response.cache_control.no_cache = True  # clients must revalidate with the etag
+
+        return response.make_conditional(request)
+
 
     def get_objects(self):
         raise NotImplementedError()
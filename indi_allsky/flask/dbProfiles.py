@@ -0,0 +1,205 @@
+import io
+import os
+import time
+import json
+import tempfile
+import threading
+from pathlib import Path
+import logging
+
+
+logger = logging.getLogger('indi_allsky')
+
+
+# SQLite connection settings for each role
+#   web     gunicorn, mostly reads
+#   writer  image processing, commits every frame
+#   worker  everything else
+SQLITE_PROFILES = {
+    'web' : {
+        'journal_mode'       : 'WAL',
+        'synchronous'        : 'NORMAL',
+        'busy_timeout'       : 20000,
+        'cache_size'         : -32000,  # 32MB
+        'mmap_size'          : 268435456,  # 256MB
+        'temp_store'         : 'MEMORY',
+    },
+    'writer' : {
+        'journal_mode'       : 'WAL',
+        'synchronous'        : 'NORMAL',
+        'busy_timeout'       : 20000,
+        'cache_size'         : -8000,  # 8MB
+        'wal_autocheckpoint' : 0,  # checkpoints are scheduled between frames
+    },
+    'worker' : {
+        'journal_mode'       : 'WAL',
+        'synchronous'        : 'NORMAL',
+        'busy_timeout'       : 20000,
+    },
+}
+
+
+class IndiAllSkyDbMetrics(object):
+    # Lock contention counters of the SQLite connections of this process.
+    # Each process writes its counters to a file, the counters of all of the
+    # processes are summed by role.
+
+    if Path('/dev/shm').is_dir():
+        metrics_folder = Path('/dev/shm').joinpath('indi_allsky_db')
+    else:
+        metrics_folder = Path(tempfile.gettempdir()).joinpath('indi_allsky_db')
+
+    # statements that take longer than this waited for a lock
+    lock_wait_threshold = 0.25
+
+    save_interval = 60
+
+    # files of processes that stopped
+    expire_seconds = 3600
+
+
+    def __init__(self, role):
+        self.role = role
+
+        self._pid = None
+        self._last_save = 0
+
+        # statements run concurrently in threads, start times are kept per connection
+        self._lock = threading.Lock()
+
+        self._counters = dict()
+        self._reset()
+
+
+    def _reset(self):
+        self._counters = {
+            'statements'      : 0,
+            'write_statements': 0,
+            'lock_waits'      : 0,
+            'lock_wait_s'     : 0.0,
+            'busy_errors'     : 0,
+            'checkpoints'     : 0,
+            'checkpoint_s'    : 0.0,
+        }
+
+
+    def beforeExecute(self, conn, cursor, statement, parameters, context, executemany):
+        if self._pid != os.getpid():
+            # counters are not inherited by forked processes, a lock held by
+            # another thread during the fork is never released in the child
+            self._lock = threading.Lock()
+            self._pid = os.getpid()
+            self._reset()
+
+        conn.info.setdefault('indi_allsky_start_time', []).append(time.time())
+
+
+    def afterExecute(self, conn, cursor, statement, parameters, context, executemany):
+        start_time_list = conn.info.get('indi_allsky_start_time')
+        if not start_time_list:
+            return
+
+        elapsed_s = time.time() - start_time_list.pop()
+
+
+        with self._lock:
+            self._counters['statements'] += 1
+
+            if statement.lstrip()[:6].upper() in ('INSERT', 'UPDATE', 'DELETE'):
+                self._counters['write_statements'] += 1
+
+                if elapsed_s > self.lock_wait_threshold:
+                    self._counters['lock_waits'] += 1
+                    self._counters['lock_wait_s'] += elapsed_s
+
+        self._save()
+
+
+    def handleError(self, exception_context):
+        # the statement did not finish
+        conn = exception_context.connection
+        if not isinstance(conn, type(None)):
+            start_time_list = conn.info.get('indi_allsky_start_time')
+            if start_time_list:
+                start_time_list.pop()
+
+
+        if 'database is locked' in str(exception_context.original_exception):
+            with self._lock:
+                self._counters['busy_errors'] += 1
+
+            self._save(force=True)
+
+
+    def checkpoint(self, elapsed_s):
+        with self._lock:
+            self._counters['checkpoints'] += 1
+            self._counters['checkpoint_s'] += elapsed_s
+
+
+    def _save(self, force=False):
+        now = time.time()
+
+        with self._lock:
+            if not force and now - self._last_save < self.save_interval:
+                return
+
+            self._last_save = now
+
+
+            metrics = dict(self._counters)
+            metrics['role'] = self.role
+            metrics['time'] = now
+
+            metrics_p = self.metrics_folder.joinpath('{0:s}_{1:d}.json'.format(self.role, os.getpid()))
+            metrics_tmp_p = metrics_p.with_suffix('.json_tmp')
+
+            try:
+                if not self.metrics_folder.exists():
+                    self.metrics_folder.mkdir(mode=0o755, parents=True)
+
+                with io.open(str(metrics_tmp_p), 'w') as f_metrics:
+                    json.dump(metrics, f_metrics)
+
+                metrics_tmp_p.replace(metrics_p)
+            except OSError as e:
+                logger.error('Unable to write DB metrics: %s', str(e))
+
+
+    def load(self):
+        # counters summed by role
+        role_metrics = dict()
+
+        if not self.metrics_folder.exists():
+            return role_metrics
+
+
+        now = time.time()
+
+        for metrics_p in self.metrics_folder.glob('*.json'):
+            try:
+                if now - metrics_p.stat().st_mtime > self.expire_seconds:
+                    metrics_p.unlink()
+                    continue
+
+                with io.open(str(metrics_p), 'r') as f_metrics:
+                    metrics = json.load(f_metrics)
+            except (OSError, ValueError):
+                continue
+
+
+            role = metrics.pop('role')
+            metrics.pop('time')
+
+            if role not in role_metrics:
+                role_metrics[role] = dict(metrics)
+                role_metrics[role]['processes'] = 1
+                continue
+
+            for k, v in metrics.items():
+                role_metrics[role][k] += v
+
+            role_metrics[role]['processes'] += 1
+
+
+        return role_metrics
@@ -33,7 +33,6 @@ from sqlalchemy import func
 #from sqlalchemy.types import Date
 from sqlalchemy import and_
 from sqlalchemy import or_
-from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy.sql.expression import true as sa_true
 from sqlalchemy.sql.expression import false as sa_false
 from sqlalchemy.sql.expression import null as sa_null
@@ -42,6 +41,7 @@ from flask import current_app as app
 
 from .models import IndiAllSkyDbCameraTable
 from .models import IndiAllSkyDbImageTable
+from .models import IndiAllSkyDbImageCalendarTable
 from .models import IndiAllSkyDbVideoTable
 from .models import IndiAllSkyDbMiniVideoTable
 from .models import IndiAllSkyDbKeogramTable
@@ -961,6 +961,17 @@ def IMAGE_QUEUE_BACKOFF_validator(form, field):
         raise ValidationError('Backoff multiplier must be greater than 0')
 
 
+def IMAGE_WORKERS_validator(form, field):
+    if not isinstance(field.data, int):
+        raise ValidationError('Please enter valid number')
+
+    if field.data < 1:
+        raise ValidationError('Worker count must be 1 or greater')
+
+    if field.data > 8:
+        raise ValidationError('Worker count must be less than 9')
+
+
 def IMAGE_FILE_TYPE_validator(form, field):
     if field.data not in ('jpg', 'png', 'tif', 'webp'):
         raise ValidationError('Please select a valid file type')
@@ -1911,6 +1922,28 @@ def S3UPLOAD__PORT_validator(form, field):
         raise ValidationError('Port must be less than 65535')
 
 
+def S3UPLOAD__PART_SIZE_validator(form, field):
+    if not isinstance(field.data, int):
+        raise ValidationError('Please enter valid number')
+
+    if field.data < 5:
+        raise ValidationError('Part size must be 5 or greater')
+
+    if field.data > 1024:
+        raise ValidationError('Part size must be 1024 or less')
+
+
+def S3UPLOAD__PART_THREADS_validator(form, field):
+    if not isinstance(field.data, int):
+        raise ValidationError('Please enter valid number')
+
+    if field.data < 1:
+        raise ValidationError('Threads must be 1 or greater')
+
+    if field.data > 16:
+        raise ValidationError('Threads must be 16 or less')
+
+
 def S3UPLOAD__REGION_validator(form, field):
     if not field.data:
         return
@@ -3064,6 +3097,7 @@ class IndiAllskyConfigForm(FlaskForm):
     IMAGE_QUEUE_MAX                  = IntegerField('Image Queue Maximum', validators=[IMAGE_QUEUE_MAX_validator])
     IMAGE_QUEUE_MIN                  = IntegerField('Image Queue Minimum', validators=[IMAGE_QUEUE_MIN_validator])
     IMAGE_QUEUE_BACKOFF              = FloatField('Image Queue Backoff Multiplier', validators=[IMAGE_QUEUE_BACKOFF_validator])
+    IMAGE_WORKERS                    = IntegerField('Image Workers', validators=[DataRequired(), IMAGE_WORKERS_validator])
     FISH2PANO__ENABLE                = BooleanField('Enable Fisheye to Panoramic')
     FISH2PANO__DIAMETER              = IntegerField('Diameter', validators=[DataRequired(), FISH2PANO__DIAMETER_validator])
     FISH2PANO__OFFSET_X              = IntegerField('X Offset', validators=[FISH2PANO__OFFSET_X_validator])
@@ -3189,6 +3223,8 @@ class IndiAllskyConfigForm(FlaskForm):
     S3UPLOAD__PORT                   = IntegerField('Port', validators=[S3UPLOAD__PORT_validator])
     S3UPLOAD__CONNECT_TIMEOUT        = FloatField('Connect Timeout', validators=[DataRequired(), S3UPLOAD__TIMEOUT_validator])
     S3UPLOAD__TIMEOUT                = FloatField('Read Timeout', validators=[DataRequired(), S3UPLOAD__TIMEOUT_validator])
+    S3UPLOAD__PART_SIZE              = IntegerField('Part Size (MB)', validators=[DataRequired(), S3UPLOAD__PART_SIZE_validator])
+    S3UPLOAD__PART_THREADS           = IntegerField('Part Threads', validators=[DataRequired(), S3UPLOAD__PART_THREADS_validator])
     S3UPLOAD__URL_TEMPLATE           = StringField('URL Template', validators=[DataRequired(), S3UPLOAD__URL_TEMPLATE_validator])
     S3UPLOAD__ACL                    = StringField('S3 ACL', validators=[S3UPLOAD__ACL_validator])
     S3UPLOAD__STORAGE_CLASS          = StringField('S3 Storage Class', validators=[S3UPLOAD__STORAGE_CLASS_validator])
@@ -3760,33 +3796,35 @@ class IndiAllskyImageViewer(FlaskForm):
         self.local = kwargs.get('local')
 
 
-    def getYears(self):
-        years_query = db.session.query(
-            IndiAllSkyDbImageTable.createDate_year,
-        )\
-            .join(IndiAllSkyDbImageTable.camera)\
-            .filter(
-                and_(
-                    IndiAllSkyDbCameraTable.id == self.camera_id,
-                    IndiAllSkyDbImageTable.detections >= self.detections_count,
-                )
-        )
+    def _calendarQuery(self, *columns):
+        # the drop-downs are served from the precomputed image calendar
+        calendar_query = db.session.query(*columns)\
+            .filter(IndiAllSkyDbImageCalendarTable.camera_id == self.camera_id)
+
+
+        if self.detections_count:
+            calendar_query = calendar_query\
+                .filter(IndiAllSkyDbImageCalendarTable.detections > 0)
+        else:
+            calendar_query = calendar_query\
+                .filter(IndiAllSkyDbImageCalendarTable.images > 0)
 
 
         if not self.local:
             # Do not serve local assets
-            years_query = years_query\
-                .filter(
-                    or_(
-                        IndiAllSkyDbImageTable.remote_url != sa_null(),
-                        IndiAllSkyDbImageTable.s3_key != sa_null(),
-                    )
-                )
+            calendar_query = calendar_query\
+                .filter(IndiAllSkyDbImageCalendarTable.remote > 0)
 
 
-        years_query = years_query\
+        return calendar_query
+
+
+    def getYears(self):
+        years_query = self._calendarQuery(
+            IndiAllSkyDbImageCalendarTable.createDate_year,
+        )\
             .distinct()\
-            .order_by(IndiAllSkyDbImageTable.createDate_year.desc())
+            .order_by(IndiAllSkyDbImageCalendarTable.createDate_year.desc())
 
 
         year_choices = []
@@ -3799,34 +3837,12 @@ class IndiAllskyImageViewer(FlaskForm):
 
 
     def getMonths(self, year):
-        months_query = db.session.query(
-            IndiAllSkyDbImageTable.createDate_year,
-            IndiAllSkyDbImageTable.createDate_month,
+        months_query = self._calendarQuery(
+            IndiAllSkyDbImageCalendarTable.createDate_month,
         )\
-            .join(IndiAllSkyDbImageTable.camera)\
-            .filter(
-                and_(
-                    IndiAllSkyDbCameraTable.id == self.camera_id,
-                    IndiAllSkyDbImageTable.detections >= self.detections_count,
-                    IndiAllSkyDbImageTable.createDate_year == year,
-                )
-        )
-
-
-        if not self.local:
-            # Do not serve local assets
-            months_query = months_query\
-                .filter(
-                    or_(
-                        IndiAllSkyDbImageTable.remote_url != sa_null(),
-                        IndiAllSkyDbImageTable.s3_key != sa_null(),
-                    )
-                )
-
-
-        months_query = months_query\
+            .filter(IndiAllSkyDbImageCalendarTable.createDate_year == year)\
             .distinct()\
-            .order_by(IndiAllSkyDbImageTable.createDate_month.desc())
+            .order_by(IndiAllSkyDbImageCalendarTable.createDate_month.desc())
 
 
         month_choices = []
@@ -3841,36 +3857,13 @@ class IndiAllskyImageViewer(FlaskForm):
 
 
     def getDays(self, year, month):
-        days_query = db.session.query(
-            IndiAllSkyDbImageTable.createDate_year,
-            IndiAllSkyDbImageTable.createDate_month,
-            IndiAllSkyDbImageTable.createDate_day,
+        days_query = self._calendarQuery(
+            IndiAllSkyDbImageCalendarTable.createDate_day,
         )\
-            .join(IndiAllSkyDbImageTable.camera)\
-            .filter(
-                and_(
-                    IndiAllSkyDbCameraTable.id == self.camera_id,
-                    IndiAllSkyDbImageTable.detections >= self.detections_count,
-                    IndiAllSkyDbImageTable.createDate_year == year,
-                    IndiAllSkyDbImageTable.createDate_month == month,
-                )
-        )
-
-
-        if not self.local:
-            # Do not serve local assets
-            days_query = days_query\
-                .filter(
-                    or_(
-                        IndiAllSkyDbImageTable.remote_url != sa_null(),
-                        IndiAllSkyDbImageTable.s3_key != sa_null(),
-                    )
-                )
-
-
-        days_query = days_query\
+            .filter(IndiAllSkyDbImageCalendarTable.createDate_year == year)\
+            .filter(IndiAllSkyDbImageCalendarTable.createDate_month == month)\
             .distinct()\
-            .order_by(IndiAllSkyDbImageTable.createDate_day.desc())
+            .order_by(IndiAllSkyDbImageCalendarTable.createDate_day.desc())
 
 
         day_choices = []
@@ -3883,38 +3876,14 @@ class IndiAllskyImageViewer(FlaskForm):
 
 
     def getHours(self, year, month, day):
-        hours_query = db.session.query(
-            IndiAllSkyDbImageTable.createDate_year,
-            IndiAllSkyDbImageTable.createDate_month,
-            IndiAllSkyDbImageTable.createDate_day,
-            IndiAllSkyDbImageTable.createDate_hour,
+        hours_query = self._calendarQuery(
+            IndiAllSkyDbImageCalendarTable.createDate_hour,
         )\
-            .join(IndiAllSkyDbImageTable.camera)\
-            .filter(
-                and_(
-                    IndiAllSkyDbCameraTable.id == self.camera_id,
-                    IndiAllSkyDbImageTable.detections >= self.detections_count,
-                    IndiAllSkyDbImageTable.createDate_year == year,
-                    IndiAllSkyDbImageTable.createDate_month == month,
-                    IndiAllSkyDbImageTable.createDate_day == day,
-                )
-        )
-
-
-        if not self.local:
-            # Do not serve local assets
-            hours_query = hours_query\
-                .filter(
-                    or_(
-                        IndiAllSkyDbImageTable.remote_url != sa_null(),
-                        IndiAllSkyDbImageTable.s3_key != sa_null(),
-                    )
-                )
-
-
-        hours_query = hours_query\
+            .filter(IndiAllSkyDbImageCalendarTable.createDate_year == year)\
+            .filter(IndiAllSkyDbImageCalendarTable.createDate_month == month)\
+            .filter(IndiAllSkyDbImageCalendarTable.createDate_day == day)\
             .distinct()\
-            .order_by(IndiAllSkyDbImageTable.createDate_hour.desc())
+            .order_by(IndiAllSkyDbImageCalendarTable.createDate_hour.desc())
 
 
         hour_choices = []
@@ -3958,8 +3927,23 @@ class IndiAllskyImageViewer(FlaskForm):
             .order_by(IndiAllSkyDbImageTable.createDate.desc())
 
 
+        image_list = images_query.all()
+
+        if not image_list:
+            return list()
+
+
+        # companion assets of the hour are fetched with one query per table
+        createDate_start = image_list[-1].createDate
+        createDate_end = image_list[0].createDate
+
+        fits_dict = self._getCompanionAssets(IndiAllSkyDbFitsImageTable, createDate_start, createDate_end)
+        raw_dict = self._getCompanionAssets(IndiAllSkyDbRawImageTable, createDate_start, createDate_end)
+        panorama_dict = self._getCompanionAssets(IndiAllSkyDbPanoramaImageTable, createDate_start, createDate_end)
+
+
         images_data = list()
-        for img in images_query:
+        for img in image_list:
             try:
                 url = img.getUrl(s3_prefix=self.s3_prefix, local=self.local)
             except ValueError as e:
@@ -3982,33 +3966,24 @@ class IndiAllskyImageViewer(FlaskForm):
 
 
             # look for fits
-            try:
-                fits_image = db.session.query(
-                    IndiAllSkyDbFitsImageTable,
-                )\
-                    .filter(IndiAllSkyDbFitsImageTable.createDate == img.createDate)\
-                    .one()
-
+            fits_image = fits_dict.get(img.createDate)
+            if fits_image:
                 image_dict['fits'] = str(fits_image.getUrl(s3_prefix=self.s3_prefix, local=self.local))
                 image_dict['fits_id'] = fits_image.id
-            except NoResultFound:
+            else:
                 image_dict['fits'] = None
                 image_dict['fits_id'] = None
 
 
             # look for raw exports
+            raw_image = raw_dict.get(img.createDate)
             try:
-                raw_image = db.session.query(
-                    IndiAllSkyDbRawImageTable,
-                )\
-                    .filter(IndiAllSkyDbRawImageTable.createDate == img.createDate)\
-                    .one()
-
-                image_dict['raw'] = str(raw_image.getUrl(s3_prefix=self.s3_prefix, local=self.local))
-                image_dict['raw_id'] = raw_image.id
-            except NoResultFound:
-                image_dict['raw'] = None
-                image_dict['raw_id'] = None
+                if raw_image:
+                    image_dict['raw'] = str(raw_image.getUrl(s3_prefix=self.s3_prefix, local=self.local))
+                    image_dict['raw_id'] = raw_image.id
+                else:
+                    image_dict['raw'] = None
+                    image_dict['raw_id'] = None
             except ValueError:
                 # this can happen when RAW files are exported outside of the document root
                 image_dict['raw'] = None
@@ -4016,16 +3991,11 @@ class IndiAllskyImageViewer(FlaskForm):
 
 
             # look for panorama
-            try:
-                panorama_image = db.session.query(
-                    IndiAllSkyDbPanoramaImageTable,
-                )\
-                    .filter(IndiAllSkyDbPanoramaImageTable.createDate == img.createDate)\
-                    .one()
-
+            panorama_image = panorama_dict.get(img.createDate)
+            if panorama_image:
                 image_dict['panorama'] = str(panorama_image.getUrl(s3_prefix=self.s3_prefix, local=self.local))
                 image_dict['panorama_id'] = panorama_image.id
-            except NoResultFound:
+            else:
                 image_dict['panorama'] = None
                 image_dict['panorama_id'] = None
 
@@ -4036,6 +4006,28 @@ class IndiAllskyImageViewer(FlaskForm):
         return images_data
 
 
+    def _getCompanionAssets(self, table, createDate_start, createDate_end):
+        # entries keyed by createDate, uses the (camera_id, createDate) index
+        asset_query = db.session.query(
+            table,
+        )\
+            .filter(
+                and_(
+                    table.camera_id == self.camera_id,
+                    table.createDate >= createDate_start,
+                    table.createDate <= createDate_end,
+                )
+        )
+
+
+        asset_dict = dict()
+        for asset in asset_query:
+            asset_dict[asset.createDate] = asset
+
+
+        return asset_dict
+
+
 class IndiAllskyImageViewerPreload(IndiAllskyImageViewer):
     def __init__(self, *args, **kwargs):
         super(IndiAllskyImageViewerPreload, self).__init__(*args, **kwargs)
@@ -1,7 +1,9 @@
+import time
 from datetime import datetime
 from datetime import timedelta
 from pathlib import Path
 import uuid
+import threading
 import logging
 #from pprint import pformat
 
@@ -13,9 +15,12 @@ from cryptography.fernet import Fernet
 
 from flask import current_app as app  # prevent circular import
 from . import db
+from . import db_metrics
 
 from .models import IndiAllSkyDbCameraTable
 from .models import IndiAllSkyDbImageTable
+from .models import IndiAllSkyDbChartTable
+from .models import IndiAllSkyDbImageCalendarTable
 from .models import IndiAllSkyDbBadPixelMapTable
 from .models import IndiAllSkyDbDarkFrameTable
 from .models import IndiAllSkyDbVideoTable
@@ -34,6 +39,15 @@ from .models import IndiAllSkyDbStateTable
 #from .models import NotificationCategory
 
 from sqlalchemy.orm.exc import NoResultFound
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy import text
+from sqlalchemy import func
+from sqlalchemy import case
+from sqlalchemy import or_
+from sqlalchemy import and_
+from sqlalchemy.sql.expression import null as sa_null
+
+from .responseCache import IndiAllSkyResponseCache
 
 from .. import constants
 #from ..exceptions import BadImage
@@ -42,6 +56,15 @@ logger = logging.getLogger('indi_allsky')
 
 
 class miscDb(object):
+    # DB writes between beginBatch() and commitBatch() are coalesced in to a
+    # single transaction.  Entries are flushed to assign ids, the state is
+    # shared by every miscDb object in the thread (sessions are per thread).
+    _batch = threading.local()
+
+    chart_stars_rolling_count = 5  # previous entries averaged with the current stars
+    chart_rebuild_chunk = 5000
+
+
     def __init__(self, config):
         self.config = config
 
@@ -53,6 +76,106 @@ class miscDb(object):
 
 
 
+    @property
+    def _batch_depth(self):
+        return getattr(miscDb._batch, 'depth', 0)
+
+    @_batch_depth.setter
+    def _batch_depth(self, new_depth):
+        miscDb._batch.depth = new_depth
+
+
+    @property
+    def _batch_callbacks(self):
+        if not hasattr(miscDb._batch, 'callbacks'):
+            miscDb._batch.callbacks = list()
+
+        return miscDb._batch.callbacks
+
+
+    def beginBatch(self):
+        self._batch_depth += 1
+
+
+    def commitBatch(self):
+        if not self._batch_depth:
+            return
+
+        self._batch_depth -= 1
+
+        if self._batch_depth:
+            # nested batch
+            return
+
+
+        try:
+            db.session.commit()
+        except SQLAlchemyError as e:
+            logger.error('Batch commit failed: %s', str(e))
+            db.session.rollback()
+            self._batch_callbacks.clear()
+            raise
+
+
+        callback_list = list(self._batch_callbacks)
+        self._batch_callbacks.clear()
+
+        for callback, args in callback_list:
+            callback(*args)
+
+
+    def commit(self):
+        if self._batch_depth:
+            db.session.flush()  # ids are available before the commit
+            return
+
+        db.session.commit()
+
+
+    def afterCommit(self, callback, *args):
+        # run once the data is visible to other processes
+        if self._batch_depth:
+            self._batch_callbacks.append((callback, args))
+            return
+
+        callback(*args)
+
+
+    def walCheckpoint(self, mode='PASSIVE'):
+        # PASSIVE never waits for other connections, TRUNCATE waits up to the
+        # busy timeout for readers and writers and empties the write-ahead log
+        if db.engine.dialect.name != 'sqlite':
+            return
+
+        if mode not in ('PASSIVE', 'FULL', 'RESTART', 'TRUNCATE'):
+            raise ValueError('Invalid checkpoint mode: {0:s}'.format(str(mode)))
+
+
+        checkpoint_start = time.time()
+
+        try:
+            busy, log_frames, checkpointed_frames = db.session.execute(text('PRAGMA wal_checkpoint({0:s})'.format(mode))).fetchone()
+            db.session.commit()
+        except SQLAlchemyError as e:
+            logger.error('WAL checkpoint failed: %s', str(e))
+            db.session.rollback()
+            return
+
+        checkpoint_elapsed_s = time.time() - checkpoint_start
+
+
+        role_metrics = db_metrics.get(app.config.get('INDI_ALLSKY_DB_ROLE'))
+        if role_metrics:
+            role_metrics.checkpoint(checkpoint_elapsed_s)
+
+
+        if busy or checkpointed_frames < log_frames:
+            logger.warning('WAL %s checkpoint incomplete, %d of %d frames (%0.4f s)', mode, checkpointed_frames, log_frames, checkpoint_elapsed_s)
+            return
+
+        logger.info('WAL %s checkpoint of %d frames in %0.4f s', mode, checkpointed_frames, checkpoint_elapsed_s)
+
+
     def addCamera(self, metadata):
         now = datetime.now()
 
@@ -73,7 +196,7 @@ class miscDb(object):
             )
 
             db.session.add(camera)
-            db.session.commit()
+            self.commit()
 
 
         keys_exclude = [
@@ -98,7 +221,7 @@ class miscDb(object):
             setattr(camera, k, v)
 
 
-        db.session.commit()
+        self.commit()
 
         logger.info('Camera DB ID: %d', camera.id)
 
@@ -123,7 +246,7 @@ class miscDb(object):
             )
 
             db.session.add(camera)
-            db.session.commit()
+            self.commit()
 
 
         # The camera name and friendlyName must be unique
@@ -158,7 +281,7 @@ class miscDb(object):
             setattr(camera, k, v)
 
 
-        db.session.commit()
+        self.commit()
 
         logger.info('Camera DB ID: %d', camera.id)
 
@@ -262,11 +385,260 @@ class miscDb(object):
         )
 
         db.session.add(image)
-        db.session.commit()
+
+        db.session.add(self.addChartRollup(image))
+
+        self.addImageCalendar(image)
+
+        self.commit()
+
+        self.afterCommit(IndiAllSkyResponseCache().invalidate)  # new latest image
 
         return image
 
 
+    def addChartRollup(self, image):
+        # chart values are calculated once when the image is added
+        previous_entries = IndiAllSkyDbChartTable.query\
+            .filter(IndiAllSkyDbChartTable.camera_id == image.camera_id)\
+            .filter(IndiAllSkyDbChartTable.createDate < image.createDate)\
+            .order_by(IndiAllSkyDbChartTable.createDate.desc())\
+            .limit(self.chart_stars_rolling_count)\
+            .all()
+
+        previous_list = [{'stars' : x.stars, 'sqm' : x.sqm} for x in previous_entries]
+
+        return IndiAllSkyDbChartTable(**self._chartRollup(image, previous_list))
+
+
+    def _chartRollup(self, image, previous_list):
+        # previous_list is the newest first values of the previous chart entries
+        stars_list = [x['stars'] for x in previous_list if not isinstance(x['stars'], type(None))]
+        if not isinstance(image.stars, type(None)):
+            stars_list.append(image.stars)
+
+        if stars_list:
+            stars_rolling = sum(stars_list) / len(stars_list)
+        else:
+            stars_rolling = None
+
+
+        sqm_diff = None
+        if previous_list:
+            previous_sqm = previous_list[0]['sqm']
+
+            if not isinstance(image.sqm, type(None)) and not isinstance(previous_sqm, type(None)):
+                sqm_diff = image.sqm - previous_sqm
+
+
+        custom_list = list()
+        for slot, slot_default in ((1, 10), (2, 11), (3, 12), (4, 13)):
+            custom_index = self.config.get('CHARTS', {}).get('CUSTOM_SLOT_{0:d}'.format(slot), slot_default)
+
+            if custom_index < 100:
+                custom_key = 'sensor_user_{0:d}'.format(custom_index)
+            else:
+                custom_key = 'sensor_temp_{0:d}'.format(custom_index - 100)
+
+            try:
+                custom_list.append(image.data[custom_key])
+            except (KeyError, TypeError):
+                custom_list.append(0)
+
+
+        return {
+            'camera_id'     : image.camera_id,
+            'createDate'    : image.createDate,
+            'sqm'           : image.sqm,
+            'sqm_diff'      : sqm_diff,
+            'stars'         : image.stars,
+            'stars_rolling' : stars_rolling,
+            'temp'          : image.temp,
+            'exposure'      : image.exposure,
+            'detections'    : image.detections,
+            'custom_1'      : custom_list[0],
+            'custom_2'      : custom_list[1],
+            'custom_3'      : custom_list[2],
+            'custom_4'      : custom_list[3],
+        }
+
+
+    def rebuildChartRollup(self, camera_id):
+        # chart entries of existing images, the entries are replaced in a single transaction
+        IndiAllSkyDbChartTable.query\
+            .filter(IndiAllSkyDbChartTable.camera_id == camera_id)\
+            .delete()
+
+
+        image_query = db.session.query(
+            IndiAllSkyDbImageTable.id,
+            IndiAllSkyDbImageTable.camera_id,
+            IndiAllSkyDbImageTable.createDate,
+            IndiAllSkyDbImageTable.sqm,
+            IndiAllSkyDbImageTable.stars,
+            IndiAllSkyDbImageTable.temp,
+            IndiAllSkyDbImageTable.exposure,
+            IndiAllSkyDbImageTable.detections,
+            IndiAllSkyDbImageTable.data,
+        )\
+            .filter(IndiAllSkyDbImageTable.camera_id == camera_id)\
+            .order_by(
+                IndiAllSkyDbImageTable.createDate.asc(),
+                IndiAllSkyDbImageTable.id.asc(),
+            )
+
+
+        chart_count = 0
+        previous_list = list()
+        current_list = list()  # images with the same createDate are not previous entries
+        last_image = None
+
+        while True:
+            page_query = image_query
+
+            if last_image:
+                # keyset pagination, the inserts do not change the image query
+                page_query = page_query.filter(
+                    or_(
+                        IndiAllSkyDbImageTable.createDate > last_image.createDate,
+                        and_(
+                            IndiAllSkyDbImageTable.createDate == last_image.createDate,
+                            IndiAllSkyDbImageTable.id > last_image.id,
+                        ),
+                    )
+                )
+
+            image_list = page_query.limit(self.chart_rebuild_chunk).all()
+            if not image_list:
+                break
+
+
+            chart_list = list()
+            for image in image_list:
+                if current_list and image.createDate != current_list[0]['createDate']:
+                    previous_list = list(reversed(current_list)) + previous_list
+                    del previous_list[self.chart_stars_rolling_count:]
+                    current_list = list()
+
+                chart_list.append(self._chartRollup(image, previous_list))
+
+                current_list.append({'createDate' : image.createDate, 'stars' : image.stars, 'sqm' : image.sqm})
+
+
+            db.session.execute(IndiAllSkyDbChartTable.__table__.insert(), chart_list)
+
+            chart_count += len(chart_list)
+            last_image = image_list[-1]
+
+
+        self.commit()
+
+        logger.info('Chart rebuilt with %d entries', chart_count)
+
+
+    def addImageCalendar(self, image):
+        calendar = IndiAllSkyDbImageCalendarTable.query\
+            .filter(IndiAllSkyDbImageCalendarTable.camera_id == image.camera_id)\
+            .filter(IndiAllSkyDbImageCalendarTable.createDate_year == image.createDate_year)\
+            .filter(IndiAllSkyDbImageCalendarTable.createDate_month == image.createDate_month)\
+            .filter(IndiAllSkyDbImageCalendarTable.createDate_day == image.createDate_day)\
+            .filter(IndiAllSkyDbImageCalendarTable.createDate_hour == image.createDate_hour)\
+            .first()
+
+        if not calendar:
+            calendar = IndiAllSkyDbImageCalendarTable(
+                camera_id=image.camera_id,
+                createDate_year=image.createDate_year,
+                createDate_month=image.createDate_month,
+                createDate_day=image.createDate_day,
+                createDate_hour=image.createDate_hour,
+                images=0,
+                detections=0,
+                remote=0,
+            )
+            db.session.add(calendar)
+
+
+        calendar.images += 1
+
+        if image.detections:
+            calendar.detections += 1
+
+        if image.remote_url or image.s3_key:
+            calendar.remote += 1
+
+
+    def addImageCalendarRemote(self, image):
+        # image was uploaded to S3
+        IndiAllSkyDbImageCalendarTable.query\
+            .filter(IndiAllSkyDbImageCalendarTable.camera_id == image.camera_id)\
+            .filter(IndiAllSkyDbImageCalendarTable.createDate_year == image.createDate_year)\
+            .filter(IndiAllSkyDbImageCalendarTable.createDate_month == image.createDate_month)\
+            .filter(IndiAllSkyDbImageCalendarTable.createDate_day == image.createDate_day)\
+            .filter(IndiAllSkyDbImageCalendarTable.createDate_hour == image.createDate_hour)\
+            .update({IndiAllSkyDbImageCalendarTable.remote : IndiAllSkyDbImageCalendarTable.remote + 1})
+
+
+    def rebuildImageCalendar(self, camera_id):
+        # counts drift when images are deleted, the calendar is replaced in a single transaction
+        calendar_query = db.session.query(
+            IndiAllSkyDbImageTable.createDate_year,
+            IndiAllSkyDbImageTable.createDate_month,
+            IndiAllSkyDbImageTable.createDate_day,
+            IndiAllSkyDbImageTable.createDate_hour,
+            func.count(IndiAllSkyDbImageTable.id).label('images'),
+            func.sum(case((IndiAllSkyDbImageTable.detections > 0, 1), else_=0)).label('detections'),
+            func.sum(
+                case(
+                    (
+                        or_(
+                            IndiAllSkyDbImageTable.remote_url != sa_null(),
+                            IndiAllSkyDbImageTable.s3_key != sa_null(),
+                        ),
+                        1,
+                    ),
+                    else_=0,
+                )
+            ).label('remote'),
+        )\
+            .filter(IndiAllSkyDbImageTable.camera_id == camera_id)\
+            .filter(IndiAllSkyDbImageTable.createDate_year != sa_null())\
+            .group_by(
+                IndiAllSkyDbImageTable.createDate_year,
+                IndiAllSkyDbImageTable.createDate_month,
+                IndiAllSkyDbImageTable.createDate_day,
+                IndiAllSkyDbImageTable.createDate_hour,
+            )
+
+
+        calendar_list = list()
+        for c in calendar_query:
+            calendar_list.append({
+                'camera_id'        : camera_id,
+                'createDate_year'  : c.createDate_year,
+                'createDate_month' : c.createDate_month,
+                'createDate_day'   : c.createDate_day,
+                'createDate_hour'  : c.createDate_hour,
+                'images'           : c.images,
+                'detections'       : c.detections,
+                'remote'           : c.remote,
+            })
+
+
+        IndiAllSkyDbImageCalendarTable.query\
+            .filter(IndiAllSkyDbImageCalendarTable.camera_id == camera_id)\
+            .delete()
+
+        if calendar_list:
+            db.session.execute(IndiAllSkyDbImageCalendarTable.__table__.insert(), calendar_list)
+
+        self.commit()
+
+        self.afterCommit(IndiAllSkyResponseCache().invalidate)
+
+        logger.info('Image calendar rebuilt with %d hours', len(calendar_list))
+
+
     def addDarkFrame(self, filename, camera_id, metadata):
 
         ### expected metadata
@@ -326,7 +698,7 @@ class miscDb(object):
         )
 
         db.session.add(dark)
-        db.session.commit()
+        self.commit()
 
         return dark
 
@@ -389,7 +761,7 @@ class miscDb(object):
         )
 
         db.session.add(bpm)
-        db.session.commit()
+        self.commit()
 
         return bpm
 
@@ -448,7 +820,7 @@ class miscDb(object):
         )
 
         db.session.add(video)
-        db.session.commit()
+        self.commit()
 
         return video
 
@@ -532,7 +904,7 @@ class miscDb(object):
         )
 
         db.session.add(mini_video)
-        db.session.commit()
+        self.commit()
 
         return mini_video
 
@@ -588,7 +960,7 @@ class miscDb(object):
         )
 
         db.session.add(panorama_video)
-        db.session.commit()
+        self.commit()
 
         return panorama_video
 
@@ -641,7 +1013,7 @@ class miscDb(object):
         )
 
         db.session.add(keogram)
-        db.session.commit()
+        self.commit()
 
         return keogram
 
@@ -695,7 +1067,7 @@ class miscDb(object):
         )
 
         db.session.add(startrail)
-        db.session.commit()
+        self.commit()
 
         return startrail
 
@@ -751,7 +1123,7 @@ class miscDb(object):
         )
 
         db.session.add(startrail_video)
-        db.session.commit()
+        self.commit()
 
         return startrail_video
 
@@ -809,7 +1181,7 @@ class miscDb(object):
         )
 
         db.session.add(fits_image)
-        db.session.commit()
+        self.commit()
 
         return fits_image
 
@@ -867,7 +1239,9 @@ class miscDb(object):
         )
 
         db.session.add(raw_image)
-        db.session.commit()
+        self.commit()
+
+        self.afterCommit(IndiAllSkyResponseCache().invalidate)  # new latest image
 
         return raw_image
 
@@ -929,7 +1303,9 @@ class miscDb(object):
         )
 
         db.session.add(panorama_image)
-        db.session.commit()
+        self.commit()
+
+        self.afterCommit(IndiAllSkyResponseCache().invalidate)  # new latest image
 
         return panorama_image
 
@@ -975,7 +1351,7 @@ class miscDb(object):
         )
 
         db.session.add(new_notice)
-        db.session.commit()
+        self.commit()
 
         logger.info('Added %s notification: %d', category.value, new_notice.id)
 
@@ -1016,7 +1392,7 @@ class miscDb(object):
             db.session.add(state)
 
 
-        db.session.commit()
+        self.commit()
 
 
     def setEncryptedState(self, key, value):
@@ -1054,7 +1430,7 @@ class miscDb(object):
 
 
         db.session.delete(state)
-        db.session.commit()
+        self.commit()
 
 
     def addThumbnail(self, entry, entry_metadata, camera_id, thumbnail_metadata, new_width=150, numpy_data=None, image_entry=None):
@@ -1062,6 +1438,32 @@ class miscDb(object):
             return
 
 
+        if not isinstance(numpy_data, type(None)):
+            source_p = None
+        elif image_entry:
+            # use alternate image entry
+            source_p = Path(image_entry.getFilesystemPath())
+        else:
+            # use entry file on filesystem
+            source_p = Path(entry.getFilesystemPath())
+
+
+        thumbnail_filename_p = self.writeThumbnail(
+            thumbnail_metadata,
+            new_width=new_width,
+            numpy_data=numpy_data,
+            source_p=source_p,
+        )
+
+        if not thumbnail_filename_p:
+            return
+
+
+        return self.addThumbnailEntry(entry, entry_metadata, camera_id, thumbnail_filename_p, thumbnail_metadata)
+
+
+    def writeThumbnail(self, thumbnail_metadata, new_width=150, numpy_data=None, source_p=None):
+        # only creates the file, the DB entry is added by addThumbnailEntry()
         if isinstance(thumbnail_metadata['createDate'], (int, float)):
             createDate = datetime.fromtimestamp(thumbnail_metadata['createDate'])
         else:
@@ -1115,8 +1517,6 @@ class miscDb(object):
             '{0:s}.jpg'.format(thumbnail_uuid_str),
         )
 
-        logger.info('Adding thumbnail to DB: %s', thumbnail_filename_p)
-
         if not thumbnail_dir_p.exists():
             thumbnail_dir_p.mkdir(mode=0o755, parents=True)
 
@@ -1124,31 +1524,13 @@ class miscDb(object):
         if not isinstance(numpy_data, type(None)):
             # process numpy data
             img = Image.fromarray(cv2.cvtColor(numpy_data, cv2.COLOR_BGR2RGB))
-
-        elif image_entry:
-            # use alternate image entry
-            filename_p = Path(image_entry.getFilesystemPath())
-
-            if not filename_p.exists():
-                logger.error('Cannot create thumbnail: File not found: %s', filename_p)
-                return
-
-            try:
-                img = Image.open(str(filename_p))
-            except PIL.UnidentifiedImageError:
-                logger.error('Cannot create thumbnail:  Bad Image')
-                return
-
         else:
-            # use entry file on filesystem
-            filename_p = Path(entry.getFilesystemPath())
-
-            if not filename_p.exists():
-                logger.error('Cannot create thumbnail: File not found: %s', filename_p)
+            if not source_p.exists():
+                logger.error('Cannot create thumbnail: File not found: %s', source_p)
                 return
 
             try:
-                img = Image.open(str(filename_p))
+                img = Image.open(str(source_p))
             except PIL.UnidentifiedImageError:
                 logger.error('Cannot create thumbnail:  Bad Image')
                 return
@@ -1169,7 +1551,6 @@ class miscDb(object):
 
 
         # insert new metadata
-        entry_metadata['thumbnail_uuid'] = thumbnail_uuid_str
         thumbnail_metadata['uuid'] = thumbnail_uuid_str
         thumbnail_metadata['dayDate'] = dayDate.strftime('%Y%m%d')
         thumbnail_metadata['width'] = new_width
@@ -1178,14 +1559,29 @@ class miscDb(object):
 
         thumbnail_data.save(str(thumbnail_filename_p), quality=75)
 
+        return thumbnail_filename_p
+
+
+    def addThumbnailEntry(self, entry, entry_metadata, camera_id, thumbnail_filename_p, thumbnail_metadata):
+        # thumbnail file created by writeThumbnail()
+        if isinstance(thumbnail_metadata['createDate'], (int, float)):
+            createDate = datetime.fromtimestamp(thumbnail_metadata['createDate'])
+        else:
+            createDate = thumbnail_metadata['createDate']
+
+
+        logger.info('Adding thumbnail to DB: %s', thumbnail_filename_p)
+
+        entry_metadata['thumbnail_uuid'] = thumbnail_metadata['uuid']
+
 
         thumbnail_entry = IndiAllSkyDbThumbnailTable(
-            uuid=thumbnail_uuid_str,
+            uuid=thumbnail_metadata['uuid'],
             filename=str(thumbnail_filename_p.relative_to(self.image_dir)),
             createDate=createDate,
             origin=thumbnail_metadata['origin'],
-            width=new_width,
-            height=new_height,
+            width=thumbnail_metadata['width'],
+            height=thumbnail_metadata['height'],
             camera_id=camera_id,
             data=thumbnail_metadata.get('data', {}),
             s3_key=thumbnail_metadata.get('s3_key'),
@@ -1193,17 +1589,17 @@ class miscDb(object):
         )
 
         db.session.add(thumbnail_entry)
-        entry.thumbnail_uuid = thumbnail_uuid_str
-        db.session.commit()
+        entry.thumbnail_uuid = thumbnail_metadata['uuid']
+        self.commit()
 
         return thumbnail_entry
 
 
-    def addThumbnailImageAuto(self, *args, **kwargs):
+    def writeThumbnailImageAuto(self, *args, **kwargs):
         if not self.config.get('THUMBNAILS', {}).get('IMAGES_AUTO', True):
             return
 
-        return self.addThumbnail(*args, **kwargs)
+        return self.writeThumbnail(*args, **kwargs)
 
 
     def addThumbnail_remote(self, filename, camera_id, thumbnail_metadata):
@@ -1246,7 +1642,7 @@ class miscDb(object):
         )
 
         db.session.add(thumbnail_entry)
-        db.session.commit()
+        self.commit()
 
         return thumbnail_entry
 
@@ -17,6 +17,8 @@ __all__ = (
     'IndiAllSkyDbCameraTable',
     'IndiAllSkyDbThumbnailTable',
     'IndiAllSkyDbImageTable',
+    'IndiAllSkyDbChartTable',
+    'IndiAllSkyDbImageCalendarTable',
     'IndiAllSkyDbBadPixelMapTable',
     'IndiAllSkyDbDarkFrameTable',
     'IndiAllSkyDbVideoTable',
@@ -31,6 +33,7 @@ __all__ = (
     'TaskQueueState', 'TaskQueueQueue', 'IndiAllSkyDbTaskQueueTable',
     'NotificationCategory', 'IndiAllSkyDbNotificationTable',
     'IndiAllSkyDbStateTable',
+    'IndiAllSkyDbMultipartUploadTable',
     'IndiAllSkyDbUserTable',
     'IndiAllSkyDbTleDataTable',
 )
@@ -84,13 +87,15 @@ class IndiAllSkyDbCameraTable(db.Model):
     web_nonlocal_images = db.Column(db.Boolean, server_default=expression.false(), nullable=False)
     web_local_images_admin = db.Column(db.Boolean, server_default=expression.false(), nullable=False)
 
-    data = db.Column(db.JSON, index=True)
+    data = db.Column(db.JSON)
 
     local = db.Column(db.Boolean, server_default=expression.true(), nullable=False, index=True)
     sync_id = db.Column(db.Integer, nullable=True, index=True)
 
     thumbnails = db.relationship('IndiAllSkyDbThumbnailTable', back_populates='camera')
     images = db.relationship('IndiAllSkyDbImageTable', back_populates='camera')
+    charts = db.relationship('IndiAllSkyDbChartTable', back_populates='camera')
+    imagecalendar = db.relationship('IndiAllSkyDbImageCalendarTable', back_populates='camera')
     videos = db.relationship('IndiAllSkyDbVideoTable', back_populates='camera')
     minivideos = db.relationship('IndiAllSkyDbMiniVideoTable', back_populates='camera')
     keograms = db.relationship('IndiAllSkyDbKeogramTable', back_populates='camera')
@@ -216,7 +221,7 @@ class IndiAllSkyDbThumbnailTable(IndiAllSkyDbFileBase):
     origin = db.Column(db.Integer, nullable=True, index=True)
     uploaded = db.Column(db.Boolean, server_default=expression.false(), nullable=False)
     sync_id = db.Column(db.Integer, nullable=True, index=True)
-    data = db.Column(db.JSON, index=True)
+    data = db.Column(db.JSON)
     width = db.Column(db.Integer, nullable=True, index=True)
     height = db.Column(db.Integer, nullable=True, index=True)
     camera_id = db.Column(db.Integer, db.ForeignKey('camera.id'), nullable=False)
@@ -245,10 +250,10 @@ class IndiAllSkyDbImageTable(IndiAllSkyDbFileBase):
     remote_url = db.Column(db.String(length=255), nullable=True, index=True)
     s3_key = db.Column(db.String(length=255), nullable=True, index=True)
     createDate = db.Column(db.DateTime(), nullable=False, index=True, server_default=db.func.now())
-    createDate_year = db.Column(db.Integer, nullable=True, index=True)
-    createDate_month = db.Column(db.Integer, nullable=True, index=True)
-    createDate_day = db.Column(db.Integer, nullable=True, index=True)
-    createDate_hour = db.Column(db.Integer, nullable=True, index=True)
+    createDate_year = db.Column(db.Integer, nullable=True)
+    createDate_month = db.Column(db.Integer, nullable=True)
+    createDate_day = db.Column(db.Integer, nullable=True)
+    createDate_hour = db.Column(db.Integer, nullable=True)
     dayDate = db.Column(db.Date, nullable=False, index=True)
     exposure = db.Column(db.Float, nullable=False)
     exp_elapsed = db.Column(db.Float, nullable=True)
@@ -256,7 +261,7 @@ class IndiAllSkyDbImageTable(IndiAllSkyDbFileBase):
     gain = db.Column(db.Integer, nullable=False)
     binmode = db.Column(db.Integer, server_default='1', nullable=False)
     temp = db.Column(db.Float, nullable=True)
-    night = db.Column(db.Boolean, server_default=expression.true(), nullable=False, index=True)
+    night = db.Column(db.Boolean, server_default=expression.true(), nullable=False)
     adu = db.Column(db.Float, nullable=False)
     stable = db.Column(db.Boolean, server_default=expression.true(), nullable=False)
     moonmode = db.Column(db.Boolean, server_default=expression.false(), nullable=False)
@@ -267,15 +272,15 @@ class IndiAllSkyDbImageTable(IndiAllSkyDbFileBase):
     uploaded = db.Column(db.Boolean, server_default=expression.false(), nullable=False)
     sync_id = db.Column(db.Integer, nullable=True, index=True)
     calibrated = db.Column(db.Boolean, server_default=expression.false(), nullable=False)
-    detections = db.Column(db.Integer, server_default='0', nullable=False, index=True)
-    kpindex = db.Column(db.Float, nullable=True, index=True)
-    ovation_max = db.Column(db.Integer, nullable=True, index=True)
-    smoke_rating = db.Column(db.Integer, nullable=True, index=True)
-    data = db.Column(db.JSON, index=True)
+    detections = db.Column(db.Integer, server_default='0', nullable=False)
+    kpindex = db.Column(db.Float, nullable=True)
+    ovation_max = db.Column(db.Integer, nullable=True)
+    smoke_rating = db.Column(db.Integer, nullable=True)
+    data = db.Column(db.JSON)
     #tags = db.Column(db.JSON, index=True)
-    exclude = db.Column(db.Boolean, server_default=expression.false(), nullable=False, index=True)
-    width = db.Column(db.Integer, nullable=True, index=True)
-    height = db.Column(db.Integer, nullable=True, index=True)
+    exclude = db.Column(db.Boolean, server_default=expression.false(), nullable=False)
+    width = db.Column(db.Integer, nullable=True)
+    height = db.Column(db.Integer, nullable=True)
     camera_id = db.Column(db.Integer, db.ForeignKey('camera.id'), nullable=False)
     camera = db.relationship('IndiAllSkyDbCameraTable', back_populates='images')
 
@@ -300,10 +305,95 @@ class IndiAllSkyDbImageTable(IndiAllSkyDbFileBase):
         s3_key,
     )
 
+    # timelapse and day list queries, ordered by createDate
+    db.Index(
+        'idx_image_dayDate_night',
+        camera_id,
+        dayDate,
+        night,
+        exclude,
+        createDate,
+    )
+
     def __repr__(self):
         return '<Image {0:s}>'.format(self.filename)
 
 
+    def deleteAsset(self):
+        super(IndiAllSkyDbImageTable, self).deleteAsset()
+
+        self.deleteChart()
+
+
+    def deleteChart(self):
+        # chart values of the image, committed with the image delete
+        chart_entry = IndiAllSkyDbChartTable.query\
+            .filter(IndiAllSkyDbChartTable.camera_id == self.camera_id)\
+            .filter(IndiAllSkyDbChartTable.createDate == self.createDate)\
+            .first()
+
+        if chart_entry:
+            db.session.delete(chart_entry)
+
+
+class IndiAllSkyDbChartTable(db.Model):
+    # chart values of each image, maintained when images are added
+    __tablename__ = 'chart'
+
+    id = db.Column(db.Integer, primary_key=True)
+    createDate = db.Column(db.DateTime(), nullable=False)
+    sqm = db.Column(db.Float, nullable=True)
+    sqm_diff = db.Column(db.Float, nullable=True)
+    stars = db.Column(db.Integer, nullable=True)
+    stars_rolling = db.Column(db.Float, nullable=True)
+    temp = db.Column(db.Float, nullable=True)
+    exposure = db.Column(db.Float, nullable=False)
+    detections = db.Column(db.Integer, server_default='0', nullable=False)
+    custom_1 = db.Column(db.Float, nullable=True)
+    custom_2 = db.Column(db.Float, nullable=True)
+    custom_3 = db.Column(db.Float, nullable=True)
+    custom_4 = db.Column(db.Float, nullable=True)
+    camera_id = db.Column(db.Integer, db.ForeignKey('camera.id'), nullable=False)
+    camera = db.relationship('IndiAllSkyDbCameraTable', back_populates='charts')
+
+    db.Index(
+        'idx_chart_camera_createDate',
+        camera_id,
+        createDate,
+    )
+
+    def __repr__(self):
+        return '<Chart {0:d}>'.format(self.id)
+
+
+class IndiAllSkyDbImageCalendarTable(db.Model):
+    # image counts of each hour for the image viewer, maintained when images are added
+    __tablename__ = 'image_calendar'
+
+    id = db.Column(db.Integer, primary_key=True)
+    createDate_year = db.Column(db.Integer, nullable=False)
+    createDate_month = db.Column(db.Integer, nullable=False)
+    createDate_day = db.Column(db.Integer, nullable=False)
+    createDate_hour = db.Column(db.Integer, nullable=False)
+    images = db.Column(db.Integer, server_default='0', nullable=False)
+    detections = db.Column(db.Integer, server_default='0', nullable=False)  # images with detections
+    remote = db.Column(db.Integer, server_default='0', nullable=False)  # images with remote_url or s3_key
+    camera_id = db.Column(db.Integer, db.ForeignKey('camera.id'), nullable=False)
+    camera = db.relationship('IndiAllSkyDbCameraTable', back_populates='imagecalendar')
+
+    db.Index(
+        'idx_image_calendar_camera_YmdH',
+        camera_id,
+        createDate_year,
+        createDate_month,
+        createDate_day,
+        createDate_hour,
+    )
+
+    def __repr__(self):
+        return '<ImageCalendar {0:d}>'.format(self.id)
+
+
 class IndiAllSkyDbDarkFrameTable(IndiAllSkyDbFileBase):
     __tablename__ = 'darkframe'
 
@@ -320,7 +410,7 @@ class IndiAllSkyDbDarkFrameTable(IndiAllSkyDbFileBase):
     width = db.Column(db.Integer, nullable=True, index=True)
     height = db.Column(db.Integer, nullable=True, index=True)
     active = db.Column(db.Boolean, server_default=expression.true(), nullable=False, index=True)
-    data = db.Column(db.JSON, index=True)
+    data = db.Column(db.JSON)
     camera_id = db.Column(db.Integer, db.ForeignKey('camera.id'), nullable=False)
     camera = db.relationship('IndiAllSkyDbCameraTable', back_populates='darkframes')
 
@@ -357,7 +447,7 @@ class IndiAllSkyDbBadPixelMapTable(IndiAllSkyDbFileBase):
     width = db.Column(db.Integer, nullable=True, index=True)
     height = db.Column(db.Integer, nullable=True, index=True)
     active = db.Column(db.Boolean, server_default=expression.true(), nullable=False, index=True)
-    data = db.Column(db.JSON, index=True)
+    data = db.Column(db.JSON)
     camera_id = db.Column(db.Integer, db.ForeignKey('camera.id'), nullable=False)
     camera = db.relationship('IndiAllSkyDbCameraTable', back_populates='badpixelmaps')
 
@@ -400,7 +490,7 @@ class IndiAllSkyDbVideoTable(IndiAllSkyDbFileBase):
     #kpindex = db.Column(db.Float, nullable=True, index=True)
     #ovation_max = db.Column(db.Integer, nullable=True, index=True)
     #smoke_rating = db.Column(db.Integer, nullable=True, index=True)
-    data = db.Column(db.JSON, index=True)
+    data = db.Column(db.JSON)
     #tags = db.Column(db.JSON, index=True)
     width = db.Column(db.Integer, nullable=True, index=True)  # this may never be populated
     height = db.Column(db.Integer, nullable=True, index=True)  # this may never be populated
@@ -444,7 +534,7 @@ class IndiAllSkyDbMiniVideoTable(IndiAllSkyDbFileBase):
     framerate = db.Column(db.Float, server_default='0', nullable=False)
     frames = db.Column(db.Integer, server_default='0', nullable=False)
     note = db.Column(db.String(length=255), nullable=False)
-    data = db.Column(db.JSON, index=True)
+    data = db.Column(db.JSON)
     width = db.Column(db.Integer, nullable=True, index=True)  # this may never be populated
     height = db.Column(db.Integer, nullable=True, index=True)  # this may never be populated
     camera_id = db.Column(db.Integer, db.ForeignKey('camera.id'), nullable=False)
@@ -480,7 +570,7 @@ class IndiAllSkyDbKeogramTable(IndiAllSkyDbFileBase):
     success = db.Column(db.Boolean, server_default=expression.true(), nullable=False, index=True)
     width = db.Column(db.Integer, nullable=True, index=True)
     height = db.Column(db.Integer, nullable=True, index=True)
-    data = db.Column(db.JSON, index=True)
+    data = db.Column(db.JSON)
     camera_id = db.Column(db.Integer, db.ForeignKey('camera.id'), nullable=False)
     camera = db.relationship('IndiAllSkyDbCameraTable', back_populates='keograms')
 
@@ -514,7 +604,7 @@ class IndiAllSkyDbStarTrailsTable(IndiAllSkyDbFileBase):
     success = db.Column(db.Boolean, server_default=expression.true(), nullable=False, index=True)
     width = db.Column(db.Integer, nullable=True, index=True)
     height = db.Column(db.Integer, nullable=True, index=True)
-    data = db.Column(db.JSON, index=True)
+    data = db.Column(db.JSON)
     camera_id = db.Column(db.Integer, db.ForeignKey('camera.id'), nullable=False)
     camera = db.relationship('IndiAllSkyDbCameraTable', back_populates='startrails')
 
@@ -550,7 +640,7 @@ class IndiAllSkyDbStarTrailsVideoTable(IndiAllSkyDbFileBase):
     frames = db.Column(db.Integer, server_default='0', nullable=False)
     width = db.Column(db.Integer, nullable=True, index=True)  # this may never be populated
     height = db.Column(db.Integer, nullable=True, index=True)  # this may never be populated
-    data = db.Column(db.JSON, index=True)
+    data = db.Column(db.JSON)
     camera_id = db.Column(db.Integer, db.ForeignKey('camera.id'), nullable=False)
     camera = db.relationship('IndiAllSkyDbCameraTable', back_populates='startrailvideos')
 
@@ -586,10 +676,16 @@ class IndiAllSkyDbFitsImageTable(IndiAllSkyDbFileBase):
     sync_id = db.Column(db.Integer, nullable=True, index=True)
     width = db.Column(db.Integer, nullable=True, index=True)
     height = db.Column(db.Integer, nullable=True, index=True)
-    data = db.Column(db.JSON, index=True)
+    data = db.Column(db.JSON)
     camera_id = db.Column(db.Integer, db.ForeignKey('camera.id'), nullable=False)
     camera = db.relationship('IndiAllSkyDbCameraTable', back_populates='fitsimages')
 
+    db.Index(
+        'idx_fitsimage_camera_createDate',
+        camera_id,
+        createDate,
+    )
+
     def __repr__(self):
         return '<FitsImage {0:s}>'.format(self.filename)
 
@@ -612,10 +708,16 @@ class IndiAllSkyDbRawImageTable(IndiAllSkyDbFileBase):
     sync_id = db.Column(db.Integer, nullable=True, index=True)
     width = db.Column(db.Integer, nullable=True, index=True)
     height = db.Column(db.Integer, nullable=True, index=True)
-    data = db.Column(db.JSON, index=True)
+    data = db.Column(db.JSON)
     camera_id = db.Column(db.Integer, db.ForeignKey('camera.id'), nullable=False)
     camera = db.relationship('IndiAllSkyDbCameraTable', back_populates='rawimages')
 
+    db.Index(
+        'idx_rawimage_camera_createDate',
+        camera_id,
+        createDate,
+    )
+
     def __repr__(self):
         return '<RawImage {0:s}>'.format(self.filename)
 
@@ -643,7 +745,7 @@ class IndiAllSkyDbPanoramaImageTable(IndiAllSkyDbFileBase):
     exclude = db.Column(db.Boolean, server_default=expression.false(), nullable=False, index=True)
     width = db.Column(db.Integer, nullable=True, index=True)
     height = db.Column(db.Integer, nullable=True, index=True)
-    data = db.Column(db.JSON, index=True)
+    data = db.Column(db.JSON)
     camera_id = db.Column(db.Integer, db.ForeignKey('camera.id'), nullable=False)
     camera = db.relationship('IndiAllSkyDbCameraTable', back_populates='panoramaimages')
 
@@ -691,7 +793,7 @@ class IndiAllSkyDbPanoramaVideoTable(IndiAllSkyDbFileBase):
     frames = db.Column(db.Integer, server_default='0', nullable=False)
     width = db.Column(db.Integer, nullable=True, index=True)  # this may never be populated
     height = db.Column(db.Integer, nullable=True, index=True)  # this may never be populated
-    data = db.Column(db.JSON, index=True)
+    data = db.Column(db.JSON)
     camera_id = db.Column(db.Integer, db.ForeignKey('camera.id'), nullable=False)
     camera = db.relationship('IndiAllSkyDbCameraTable', back_populates='panoramavideos')
 
@@ -802,7 +904,7 @@ class IndiAllSkyDbConfigTable(db.Model):
     level = db.Column(db.String(length=12), nullable=False)
     encrypted = db.Column(db.Boolean, server_default=expression.false(), nullable=False, index=True)
     note = db.Column(db.String(length=255), nullable=False)
-    data = db.Column(db.JSON, index=True)
+    data = db.Column(db.JSON)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)  # users can be deleted
     user = db.relationship('IndiAllSkyDbUserTable', back_populates='configs')
 
@@ -816,6 +918,30 @@ class IndiAllSkyDbStateTable(db.Model):
     encrypted = db.Column(db.Boolean, server_default=expression.false(), nullable=False)
 
 
+class IndiAllSkyDbMultipartUploadTable(db.Model):
+    __tablename__ = 'multipart_upload'
+
+    id = db.Column(db.Integer, primary_key=True)
+    createDate = db.Column(db.DateTime(), nullable=False, index=True, server_default=db.func.now())
+    classname = db.Column(db.String(length=32), nullable=False)
+    bucket = db.Column(db.String(length=255), nullable=False)
+    key = db.Column(db.String(length=255), nullable=False)
+    filename = db.Column(db.String(length=255), nullable=False)
+    size = db.Column(db.BigInteger, nullable=False)
+    mtime = db.Column(db.Float, nullable=False)
+    part_size = db.Column(db.Integer, nullable=False)
+    upload_id = db.Column(db.String(length=2048), nullable=False)  # gcp uses the key prefix of the parts
+    parts = db.Column(db.JSON)  # part number: etag
+
+
+    db.Index(
+        'idx_multipart_upload_classname_bucket_key',
+        classname,
+        bucket,
+        key,
+    )
+
+
 class IndiAllSkyDbUserTable(db.Model):
     __tablename__ = 'user'
 
@@ -833,7 +959,7 @@ class IndiAllSkyDbUserTable(db.Model):
     active = db.Column(db.Boolean, server_default=expression.true(), nullable=False, index=True)
     staff = db.Column(db.Boolean, server_default=expression.true(), nullable=False, index=True)
     admin = db.Column(db.Boolean, server_default=expression.false(), nullable=False, index=True)
-    data = db.Column(db.JSON, index=True)
+    data = db.Column(db.JSON)
     configs = db.relationship('IndiAllSkyDbConfigTable', back_populates='user')
 
 
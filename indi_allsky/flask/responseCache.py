@@ -0,0 +1,123 @@
+import io
+import time
+import hashlib
+import tempfile
+from pathlib import Path
+import logging
+
+
+logger = logging.getLogger('indi_allsky')
+
+
+class IndiAllSkyResponseCache(object):
+    # JSON responses of the polling views are shared by all of the web server
+    # workers through files in memory backed storage.  The generation changes
+    # when a new image is added to the DB, responses of older generations are
+    # never served.
+
+    if Path('/dev/shm').is_dir():
+        cache_folder = Path('/dev/shm').joinpath('indi_allsky_web')
+    else:
+        cache_folder = Path(tempfile.gettempdir()).joinpath('indi_allsky_web')
+
+    # expired entries are removed at this interval
+    sweep_seconds = 300
+
+    _last_sweep = 0
+
+
+    def generation(self):
+        generation_p = self.cache_folder.joinpath('generation')
+
+        try:
+            with io.open(str(generation_p), 'r') as f_gen:
+                return f_gen.read().strip()
+        except OSError:
+            return '0'
+
+
+    def key(self, *args):
+        key_str = '|'.join([str(x) for x in args])
+        return hashlib.md5(key_str.encode()).hexdigest()
+
+
+    def get(self, key, max_age):
+        # returns the etag and response body, or None
+        entry_p = self.cache_folder.joinpath('{0:s}.json'.format(key))
+
+        try:
+            if time.time() - entry_p.stat().st_mtime > max_age:
+                return None
+
+            with io.open(str(entry_p), 'rb') as f_entry:
+                etag = f_entry.readline().strip().decode()
+                body = f_entry.read()
+        except OSError:
+            return None
+
+        return etag, body
+
+
+    def put(self, key, body):
+        etag = hashlib.md5(body).hexdigest()
+
+        entry_p = self.cache_folder.joinpath('{0:s}.json'.format(key))
+        entry_tmp_p = self.cache_folder.joinpath('{0:s}.tmp'.format(key))
+
+        try:
+            if not self.cache_folder.exists():
+                self.cache_folder.mkdir(mode=0o755, parents=True)
+
+            with io.open(str(entry_tmp_p), 'wb') as f_entry:
+                f_entry.write(etag.encode() + b'\n')
+                f_entry.write(body)
+
+            entry_tmp_p.replace(entry_p)
+        except OSError as e:
+            logger.error('Unable to cache response: %s', str(e))
+
+        self._sweep()
+
+        return etag
+
+
+    def invalidate(self):
+        generation_p = self.cache_folder.joinpath('generation')
+        generation_tmp_p = self.cache_folder.joinpath('generation.tmp')
+
+        try:
+            if not self.cache_folder.exists():
+                self.cache_folder.mkdir(mode=0o755, parents=True)
+
+            with io.open(str(generation_tmp_p), 'w') as f_gen:
+                f_gen.write('{0:d}'.format(time.time_ns()))
+
+            generation_tmp_p.replace(generation_p)
+        except OSError as e:
+            logger.error('Unable to invalidate response cache: %s', str(e))
+            return
+
+
+        # entries of the old generation are not used
+        for entry_p in self.cache_folder.glob('*.json'):
+            try:
+                entry_p.unlink()
+            except OSError:
+                pass
+
+
+    def _sweep(self):
+        now = time.time()
+
+        if now - self.__class__._last_sweep < self.sweep_seconds:
+            return
+
+        self.__class__._last_sweep = now
+
+
+        for entry_p in self.cache_folder.glob('*.json'):
+            try:
+                if now - entry_p.stat().st_mtime > self.sweep_seconds:
+                    entry_p.unlink()
+            except OSError:
+                pass
@@ -203,7 +203,7 @@ class SyncApiBaseView(BaseView):
 
                 app.logger.warning('Removing orphaned video entry')
                 db.session.delete(old_entry)
-                db.session.commit()
+                self._miscDb.commit()
             except NoResultFound:
                 pass
 
@@ -221,7 +221,7 @@ class SyncApiBaseView(BaseView):
 
                 app.logger.warning('Removing old entry')
                 db.session.delete(old_entry)
-                db.session.commit()
+                self._miscDb.commit()
             except NoResultFound:
                 pass
 
@@ -270,6 +270,9 @@ class SyncApiBaseView(BaseView):
 
             entry.deleteFile()
 
+            if isinstance(entry, IndiAllSkyDbImageTable):
+                entry.deleteChart()
+
             app.logger.warning('Deleting entry %d', entry.id)
             db.session.delete(entry)
             db.session.commit()
@@ -391,7 +394,7 @@ class SyncApiBaseView(BaseView):
         if camera.utc_offset != metadata['utc_offset']:
             # update utc offset
             camera.utc_offset = int(metadata['utc_offset'])
-            db.session.commit()
+            self._miscDb.commit()
 
 
         return camera
@@ -490,8 +493,12 @@ class SyncApiImageView(SyncApiBaseView):
                     .one()
 
                 app.logger.warning('Removing orphaned image entry')
+
+                if isinstance(old_image_entry, IndiAllSkyDbImageTable):
+                    old_image_entry.deleteChart()
+
                 db.session.delete(old_image_entry)
-                db.session.commit()
+                self._miscDb.commit()
             except NoResultFound:
                 pass
 
@@ -509,8 +516,12 @@ class SyncApiImageView(SyncApiBaseView):
                     .one()
 
                 app.logger.warning('Removing old image entry')
+
+                if isinstance(old_image_entry, IndiAllSkyDbImageTable):
+                    old_image_entry.deleteChart()
+
                 db.session.delete(old_image_entry)
-                db.session.commit()
+                self._miscDb.commit()
             except NoResultFound:
                 pass
 
@@ -717,7 +728,7 @@ class SyncApiThumbnailView(SyncApiBaseView):
 
                 app.logger.warning('Removing orphaned thumbnail entry')
                 db.session.delete(old_thumbnail_entry)
-                db.session.commit()
+                self._miscDb.commit()
             except NoResultFound:
                 pass
 
@@ -736,7 +747,7 @@ class SyncApiThumbnailView(SyncApiBaseView):
 
                 app.logger.warning('Removing old image entry')
                 db.session.delete(old_image_entry)
-                db.session.commit()
+                self._miscDb.commit()
             except NoResultFound:
                 pass
 
@@ -769,6 +780,144 @@ class SyncApiThumbnailView(SyncApiBaseView):
         return new_entry
 
 
+class SyncApiBatchView(SyncApiBaseView):
+    # Multiple entries in a single request.  The metadata field is a manifest
+    # with a list of entries, each entry has the metadata of the asset and the
+    # name of the media field.  The request is authenticated once and the
+    # database entries are committed in a single transaction.
+    decorators = []
+
+    max_entries = 100
+
+
+    def __init__(self, **kwargs):
+        super(SyncApiBatchView, self).__init__(**kwargs)
+
+        self.view_classes = {
+            constants.CAMERA          : SyncApiCameraView,
+            constants.IMAGE           : SyncApiImageView,
+            constants.VIDEO           : SyncApiVideoView,
+            constants.MINI_VIDEO      : SyncApiMiniVideoView,
+            constants.KEOGRAM         : SyncApiKeogramView,
+            constants.STARTRAIL       : SyncApiStartrailView,
+            constants.STARTRAIL_VIDEO : SyncApiStartrailVideoView,
+            constants.RAW_IMAGE       : SyncApiRawImageView,
+            constants.FITS_IMAGE      : SyncApiFitsImageView,
+            constants.PANORAMA_IMAGE  : SyncApiPanoramaImageView,
+            constants.PANORAMA_VIDEO  : SyncApiPanoramaVideoView,
+            constants.THUMBNAIL       : SyncApiThumbnailView,
+        }
+
+        self._views = dict()
+        self._cameras = dict()
+
+
+    def post(self, overwrite=False):
+        manifest = self.saveMetadata(request.files['metadata'])
+
+        batch_entry_list = manifest.get('entries', [])
+        if len(batch_entry_list) > self.max_entries:
+            return jsonify({'error' : 'too many entries'}), 400
+
+
+        start = time.time()
+
+        result_list = list()
+        tmp_file_list = list()
+
+        self._miscDb.beginBatch()
+
+        try:
+            for batch_entry in batch_entry_list:
+                result_list.append(self.processBatchEntry(batch_entry, tmp_file_list, overwrite=overwrite))
+        finally:
+            try:
+                # processed entries are still committed
+                self._miscDb.commitBatch()
+            finally:
+                for tmp_file_p in tmp_file_list:
+                    try:
+                        tmp_file_p.unlink()
+                    except FileNotFoundError:
+                        # moved by processPost()
+                        pass
+
+
+        app.logger.info('Processed batch of %d entries in %0.4f s', len(batch_entry_list), time.time() - start)
+
+        return jsonify({
+            'results' : result_list,
+        })
+
+
+    def put(self, overwrite=True):
+        return self.post(overwrite=overwrite)
+
+
+    def delete(self):
+        return jsonify({'error' : 'not_implemented'}), 400
+
+
+    def get(self):
+        return jsonify({'error' : 'not_implemented'}), 400
+
+
+    def processBatchEntry(self, batch_entry, tmp_file_list, overwrite=False):
+        metadata = batch_entry['metadata']
+
+        view_class = self.view_classes.get(metadata.get('type'))
+        if not view_class:
+            return {'error' : 'unknown type'}
+
+
+        view = self._views.get(view_class)
+        if not view:
+            view = view_class()
+            self._views[view_class] = view
+
+
+        if view_class is SyncApiCameraView:
+            camera_entry = view.processPost(None, metadata, None, overwrite=True)
+            return {'id' : camera_entry.id}
+
+
+        media_file = request.files.get(batch_entry.get('media', ''))
+        if not media_file:
+            return {'error' : 'media missing'}
+
+
+        tmp_media_file_p = self.saveMedia(media_file)
+        tmp_file_list.append(tmp_media_file_p)
+
+        media_file_size = tmp_media_file_p.stat().st_size
+        if media_file_size != metadata.get('file_size', -1):
+            app.logger.error('Media file size does not match')
+            return {'error' : 'file size'}
+
+
+        camera = self._cameras.get(metadata['camera_uuid'])
+        if not camera:
+            try:
+                camera = view.getCamera(metadata)
+            except NoResultFound:
+                app.logger.error('Camera not found: %s', metadata['camera_uuid'])
+                return {'error' : 'camera not found'}
+
+            self._cameras[metadata['camera_uuid']] = camera
+
+
+        try:
+            file_entry = view.processPost(camera, metadata, tmp_media_file_p, overwrite=overwrite)
+        except EntryExists:
+            return {'error' : 'file_exists'}
+
+
+        return {
+            'id'   : file_entry.id,
+            'url'  : str(file_entry.getUrl(local=True)),
+        }
+
+
 class EntryExists(Exception):
     pass
 
@@ -793,4 +942,4 @@ bp_syncapi_allsky.add_url_rule('/sync/v1/fitsimage', view_func=SyncApiFitsImageV
 bp_syncapi_allsky.add_url_rule('/sync/v1/panoramaimage', view_func=SyncApiPanoramaImageView.as_view('syncapi_v1_panoramaimage_view'), methods=['GET', 'POST', 'PUT', 'DELETE'])
 bp_syncapi_allsky.add_url_rule('/sync/v1/panoramavideo', view_func=SyncApiPanoramaVideoView.as_view('syncapi_v1_panorama_video_view'), methods=['GET', 'POST', 'PUT', 'DELETE'])
 bp_syncapi_allsky.add_url_rule('/sync/v1/thumbnail', view_func=SyncApiThumbnailView.as_view('syncapi_v1_thumbnail_view'), methods=['GET', 'POST', 'PUT', 'DELETE'])
-
+bp_syncapi_allsky.add_url_rule('/sync/v1/batch', view_func=SyncApiBatchView.as_view('syncapi_v1_batch_view'), methods=['POST', 'PUT'])
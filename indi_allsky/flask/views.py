@@ -20,6 +20,7 @@ from passlib.hash import argon2
 from ..version import __version__
 from .. import constants
 from ..processing import ImageProcessor
+from ..latestHistogram import IndiAllSkyLatestHistogram
 
 from cryptography.fernet import InvalidToken
 
@@ -41,6 +42,7 @@ from . import db
 
 from .models import IndiAllSkyDbCameraTable
 from .models import IndiAllSkyDbImageTable
+from .models import IndiAllSkyDbChartTable
 from .models import IndiAllSkyDbVideoTable
 from .models import IndiAllSkyDbMiniVideoTable
 from .models import IndiAllSkyDbKeogramTable
@@ -102,6 +104,8 @@ from .base_views import TemplateView
 from .base_views import FormView
 from .base_views import JsonView
 
+from .dbProfiles import IndiAllSkyDbMetrics
+
 from .youtube_views import YoutubeAuthorizeView
 from .youtube_views import YoutubeCallbackView
 from .youtube_views import YoutubeRevokeAuthView
@@ -120,10 +124,11 @@ bp_allsky = Blueprint(
 )
 
 
-class AjaxStatusUpdateView(BaseView):
+class AjaxStatusUpdateView(JsonView):
     methods = ['GET']
+    cache_seconds = 15
 
-    def dispatch_request(self):
+    def get_objects(self):
         camera_id = int(request.args['camera_id'])
 
         self.cameraSetup(camera_id=camera_id)
@@ -140,7 +145,18 @@ class AjaxStatusUpdateView(BaseView):
             'status_text' : self.get_status_text(status_data) + self.get_web_extra_text(),
         }
 
-        return jsonify(data)
+        return data
+
+
+class JsonDbMetricsView(JsonView):
+    # SQLite lock contention counters of each role
+
+    def get_objects(self):
+        data = {
+            'db_metrics' : IndiAllSkyDbMetrics('web').load(),
+        }
+
+        return data
 
 
 class IndexView(TemplateView):
@@ -164,6 +180,8 @@ class IndexView(TemplateView):
 class JsonLatestImageView(JsonView):
     model = IndiAllSkyDbImageTable
     latest_image_t = 'images/latest.{0}'
+    cache_seconds = 15
+    cache_vary_admin_network = True
 
 
     def __init__(self, **kwargs):
@@ -880,6 +898,8 @@ class ImageLoopView(TemplateView):
 
 class JsonImageLoopView(JsonView):
     model = IndiAllSkyDbImageTable
+    cache_seconds = 15
+    cache_vary_admin_network = True
 
     def __init__(self, **kwargs):
         super(JsonImageLoopView, self).__init__(**kwargs)
@@ -1150,6 +1170,8 @@ class ChartView(TemplateView):
 
 
 class JsonChartView(JsonView):
+    cache_seconds = 15
+
     def __init__(self, **kwargs):
         super(JsonChartView, self).__init__(**kwargs)
 
@@ -1193,31 +1215,23 @@ class JsonChartView(JsonView):
 
         ts_minus_seconds = ts_dt - timedelta(seconds=history_seconds)
 
-        chart_query = IndiAllSkyDbImageTable.query\
-            .add_columns(
-                IndiAllSkyDbImageTable.createDate,
-                IndiAllSkyDbImageTable.sqm,
-                func.avg(IndiAllSkyDbImageTable.stars).over(order_by=IndiAllSkyDbImageTable.createDate, rows=(-5, 0)).label('stars_rolling'),
-                IndiAllSkyDbImageTable.temp,
-                IndiAllSkyDbImageTable.exposure,
-                IndiAllSkyDbImageTable.detections,
-                (IndiAllSkyDbImageTable.sqm - func.lag(IndiAllSkyDbImageTable.sqm).over(order_by=IndiAllSkyDbImageTable.createDate)).label('sqm_diff'),
-                IndiAllSkyDbImageTable.data,
-            )\
-            .join(IndiAllSkyDbCameraTable)\
+        # rollups are maintained when images are added
+        chart_query = IndiAllSkyDbChartTable.query\
             .filter(
                 and_(
-                    IndiAllSkyDbCameraTable.id == camera_id,
-                    IndiAllSkyDbImageTable.createDate > ts_minus_seconds,
-                    IndiAllSkyDbImageTable.createDate < ts_dt,
+                    IndiAllSkyDbChartTable.camera_id == camera_id,
+                    IndiAllSkyDbChartTable.createDate > ts_minus_seconds,
+                    IndiAllSkyDbChartTable.createDate < ts_dt,
                 )
             )\
-            .order_by(IndiAllSkyDbImageTable.createDate.desc())
+            .order_by(IndiAllSkyDbChartTable.createDate.asc())
 
 
         #app.logger.info('Chart SQL: %s', str(chart_query))
 
+        # columnar data, oldest to newest
         chart_data = {
+            'x'     : [],
             'sqm'   : [],
             'sqm_d' : [],
             'stars' : [],
@@ -1237,141 +1251,31 @@ class JsonChartView(JsonView):
         }
 
 
-        custom_1_index = self.indi_allsky_config.get('CHARTS', {}).get('CUSTOM_SLOT_1', 10)
-        custom_2_index = self.indi_allsky_config.get('CHARTS', {}).get('CUSTOM_SLOT_2', 11)
-        custom_3_index = self.indi_allsky_config.get('CHARTS', {}).get('CUSTOM_SLOT_3', 12)
-        custom_4_index = self.indi_allsky_config.get('CHARTS', {}).get('CUSTOM_SLOT_4', 13)
-
+        temp_display = self.indi_allsky_config.get('TEMP_DISPLAY')
 
         for i in chart_query:
-            x = i.createDate.strftime('%H:%M:%S')
-
-            sqm_data = {
-                'x' : x,
-                'y' : i.sqm,
-            }
-            chart_data['sqm'].append(sqm_data)
-
-            star_data = {
-                'x' : x,
-                'y' : int(i.stars_rolling),
-            }
-            chart_data['stars'].append(star_data)
-
-
-            if self.indi_allsky_config.get('TEMP_DISPLAY') == 'f':
+            chart_data['x'].append(i.createDate.strftime('%H:%M:%S'))
+            chart_data['sqm'].append(i.sqm)
+            chart_data['sqm_d'].append(i.sqm_diff)
+            chart_data['stars'].append(int(i.stars_rolling or 0))
+            chart_data['exp'].append(i.exposure)
+            chart_data['detection'].append(int(i.detections > 0))
+            chart_data['custom_1'].append(i.custom_1)
+            chart_data['custom_2'].append(i.custom_2)
+            chart_data['custom_3'].append(i.custom_3)
+            chart_data['custom_4'].append(i.custom_4)
+
+
+            if isinstance(i.temp, type(None)):
+                sensortemp = None
+            elif temp_display == 'f':
                 sensortemp = ((i.temp * 9.0) / 5.0) + 32
-            elif self.indi_allsky_config.get('TEMP_DISPLAY') == 'k':
+            elif temp_display == 'k':
                 sensortemp = i.temp + 273.15
             else:
                 sensortemp = i.temp
 
-            temp_data = {
-                'x' : x,
-                'y' : sensortemp,
-            }
-            chart_data['temp'].append(temp_data)
-
-            exp_data = {
-                'x' : x,
-                'y' : i.exposure,
-            }
-            chart_data['exp'].append(exp_data)
-
-            sqm_d_data = {
-                'x' : x,
-                'y' : i.sqm_diff,
-            }
-            chart_data['sqm_d'].append(sqm_d_data)
-
-
-            if i.detections > 0:
-                detection = 1
-            else:
-                detection = 0
-
-            detection_data = {
-                'x' : x,
-                'y' : detection,
-            }
-            chart_data['detection'].append(detection_data)
-
-
-            # custom chart 1
-            if custom_1_index < 100:
-                try:
-                    custom_1_y = i.data['sensor_user_{0:d}'.format(custom_1_index)]
-                except KeyError:
-                    custom_1_y = 0
-            else:
-                try:
-                    custom_1_y = i.data['sensor_temp_{0:d}'.format(custom_1_index - 100)]
-                except KeyError:
-                    custom_1_y = 0
-
-            custom_1_data = {
-                'x' : x,
-                'y' : custom_1_y,
-            }
-            chart_data['custom_1'].append(custom_1_data)
-
-
-            # custom chart 2
-            if custom_2_index < 100:
-                try:
-                    custom_2_y = i.data['sensor_user_{0:d}'.format(custom_2_index)]
-                except KeyError:
-                    custom_2_y = 0
-            else:
-                try:
-                    custom_2_y = i.data['sensor_temp_{0:d}'.format(custom_2_index - 100)]
-                except KeyError:
-                    custom_2_y = 0
-
-            custom_2_data = {
-                'x' : x,
-                'y' : custom_2_y,
-            }
-            chart_data['custom_2'].append(custom_2_data)
-
-
-            # custom chart 3
-            if custom_3_index < 100:
-                try:
-                    custom_3_y = i.data['sensor_user_{0:d}'.format(custom_3_index)]
-                except KeyError:
-                    custom_3_y = 0
-            else:
-                try:
-                    custom_3_y = i.data['sensor_temp_{0:d}'.format(custom_3_index - 100)]
-                except KeyError:
-                    custom_3_y = 0
-
-            custom_3_data = {
-                'x' : x,
-                'y' : custom_3_y,
-            }
-            chart_data['custom_3'].append(custom_3_data)
-
-
-            # custom chart 4
-            if custom_4_index < 100:
-                try:
-                    custom_4_y = i.data['sensor_user_{0:d}'.format(custom_4_index)]
-                except KeyError:
-                    custom_4_y = 0
-            else:
-                try:
-                    custom_4_y = i.data['sensor_temp_{0:d}'.format(custom_4_index - 100)]
-                except KeyError:
-                    custom_4_y = 0
-
-            custom_4_data = {
-                'x' : x,
-                'y' : custom_4_y,
-            }
-            chart_data['custom_4'].append(custom_4_data)
-
+            chart_data['temp'].append(sensortemp)
 
 
         # build last image histogram
@@ -1394,6 +1298,15 @@ class JsonChartView(JsonView):
             return chart_data
 
 
+        latest_histogram = IndiAllSkyLatestHistogram().load(latest_image.camera.uuid, latest_image.filename)
+        if latest_histogram:
+            # histogram calculated when the image was processed
+            chart_data['histogram'].update(latest_histogram)
+
+            return chart_data
+
+
+        # older images are read from the filesystem
         latest_image_p = latest_image.getFilesystemPath()
         if not latest_image_p.exists():
             app.logger.error('Image does not exist: %s', latest_image_p)
@@ -1453,14 +1366,7 @@ class JsonChartView(JsonView):
             gray_ma = numpy.ma.masked_array(image_data, mask=numpy_mask)
             h_numpy = numpy.histogram(gray_ma.compressed(), bins=256, range=(0, 256))
 
-            #for x, val in enumerate(h_numpy.tolist()):
-            for x, val in enumerate(h_numpy[0].tolist()):
-                h_data = {
-                    'x' : str(x),
-                    #'y' : val[0]
-                    'y' : val,
-                }
-                chart_data['histogram']['gray'].append(h_data)
+            chart_data['histogram']['gray'] = h_numpy[0].tolist()
 
         else:
             # color
@@ -1470,14 +1376,7 @@ class JsonChartView(JsonView):
                 col_ma = numpy.ma.masked_array(image_data[:, :, i], mask=numpy_mask)
                 h_numpy = numpy.histogram(col_ma.compressed(), bins=256, range=(0, 256))
 
-                #for x, val in enumerate(h_numpy.tolist()):
-                for x, val in enumerate(h_numpy[0].tolist()):
-                    h_data = {
-                        'x' : str(x),
-                        #'y' : val[0]
-                        'y' : val,
-                    }
-                    chart_data['histogram'][col].append(h_data)
+                chart_data['histogram'][col] = h_numpy[0].tolist()
 
 
         return chart_data
@@ -1643,6 +1542,7 @@ class ConfigView(FormView):
             'IMAGE_QUEUE_MAX'                : self.indi_allsky_config.get('IMAGE_QUEUE_MAX', 3),
             'IMAGE_QUEUE_MIN'                : self.indi_allsky_config.get('IMAGE_QUEUE_MIN', 1),
             'IMAGE_QUEUE_BACKOFF'            : self.indi_allsky_config.get('IMAGE_QUEUE_BACKOFF', 0.5),
+            'IMAGE_WORKERS'                  : self.indi_allsky_config.get('IMAGE_WORKERS', 1),
             'THUMBNAILS__IMAGES_AUTO'        : self.indi_allsky_config.get('THUMBNAILS', {}).get('IMAGES_AUTO', True),
             'IMAGE_EXPIRE_DAYS'              : self.indi_allsky_config.get('IMAGE_EXPIRE_DAYS', 10),
             'TIMELAPSE_EXPIRE_DAYS'          : self.indi_allsky_config.get('TIMELAPSE_EXPIRE_DAYS', 365),
@@ -1736,6 +1636,8 @@ class ConfigView(FormView):
             'S3UPLOAD__PORT'                 : self.indi_allsky_config.get('S3UPLOAD', {}).get('PORT', 0),
             'S3UPLOAD__CONNECT_TIMEOUT'      : self.indi_allsky_config.get('S3UPLOAD', {}).get('CONNECT_TIMEOUT', 10.0),
             'S3UPLOAD__TIMEOUT'              : self.indi_allsky_config.get('S3UPLOAD', {}).get('TIMEOUT', 60.0),
+            'S3UPLOAD__PART_SIZE'            : self.indi_allsky_config.get('S3UPLOAD', {}).get('PART_SIZE', 16),
+            'S3UPLOAD__PART_THREADS'         : self.indi_allsky_config.get('S3UPLOAD', {}).get('PART_THREADS', 4),
             'S3UPLOAD__URL_TEMPLATE'         : self.indi_allsky_config.get('S3UPLOAD', {}).get('URL_TEMPLATE', 'https://{bucket}.s3.{region}.{host}'),
             'S3UPLOAD__STORAGE_CLASS'        : self.indi_allsky_config.get('S3UPLOAD', {}).get('STORAGE_CLASS', 'STANDARD'),
             'S3UPLOAD__ACL'                  : self.indi_allsky_config.get('S3UPLOAD', {}).get('ACL', ''),
@@ -2362,6 +2264,7 @@ class AjaxConfigView(BaseView):
         self.indi_allsky_config['IMAGE_QUEUE_MAX']                      = int(request.json['IMAGE_QUEUE_MAX'])
         self.indi_allsky_config['IMAGE_QUEUE_MIN']                      = int(request.json['IMAGE_QUEUE_MIN'])
         self.indi_allsky_config['IMAGE_QUEUE_BACKOFF']                  = float(request.json['IMAGE_QUEUE_BACKOFF'])
+        self.indi_allsky_config['IMAGE_WORKERS']                        = int(request.json['IMAGE_WORKERS'])
         self.indi_allsky_config['THUMBNAILS']['IMAGES_AUTO']            = bool(request.json['THUMBNAILS__IMAGES_AUTO'])
         self.indi_allsky_config['IMAGE_EXPIRE_DAYS']                    = int(request.json['IMAGE_EXPIRE_DAYS'])
         self.indi_allsky_config['TIMELAPSE_EXPIRE_DAYS']                = int(request.json['TIMELAPSE_EXPIRE_DAYS'])
@@ -2455,6 +2358,8 @@ class AjaxConfigView(BaseView):
         self.indi_allsky_config['S3UPLOAD']['PORT']                     = int(request.json['S3UPLOAD__PORT'])
         self.indi_allsky_config['S3UPLOAD']['CONNECT_TIMEOUT']          = float(request.json['S3UPLOAD__CONNECT_TIMEOUT'])
         self.indi_allsky_config['S3UPLOAD']['TIMEOUT']                  = float(request.json['S3UPLOAD__TIMEOUT'])
+        self.indi_allsky_config['S3UPLOAD']['PART_SIZE']                = int(request.json['S3UPLOAD__PART_SIZE'])
+        self.indi_allsky_config['S3UPLOAD']['PART_THREADS']             = int(request.json['S3UPLOAD__PART_THREADS'])
         self.indi_allsky_config['S3UPLOAD']['URL_TEMPLATE']             = str(request.json['S3UPLOAD__URL_TEMPLATE'])
         self.indi_allsky_config['S3UPLOAD']['STORAGE_CLASS']            = str(request.json['S3UPLOAD__STORAGE_CLASS'])
         self.indi_allsky_config['S3UPLOAD']['ACL']                      = str(request.json['S3UPLOAD__ACL'])
@@ -4610,6 +4515,7 @@ class AjaxSystemInfoView(BaseView):
 
         ### DELETE ###
         message_list.append('<p>Removed {0:d} missing image entries</p>'.format(len(image_notfound_list)))
+        [i.deleteChart() for i in image_notfound_list]
         [db.session.delete(i) for i in image_notfound_list]
 
 
@@ -7149,6 +7055,7 @@ def images_folder(path):
 
 
 bp_allsky.add_url_rule('/ajax/status_update', view_func=AjaxStatusUpdateView.as_view('ajax_status_update_view'))
+bp_allsky.add_url_rule('/js/db_metrics', view_func=JsonDbMetricsView.as_view('js_db_metrics_view'))
 
 bp_allsky.add_url_rule('/', view_func=IndexView.as_view('index_view', template_name='index.html'))
 bp_allsky.add_url_rule('/js/latest', view_func=JsonLatestImageView.as_view('js_latest_image_view'))
@@ -0,0 +1,240 @@
+import time
+from pathlib import Path
+from multiprocessing import Array
+from multiprocessing import shared_memory
+from multiprocessing import resource_tracker
+import numpy
+import logging
+
+from .exceptions import BadImage
+
+
+logger = logging.getLogger('indi_allsky')
+
+
+class IndiAllSkyFrameRing(object):
+    # Frames are passed from the camera client to the image workers through
+    # shared memory slots, only a small description of the frame is put on the
+    # image queue.  Slots are allocated the first time they are used and are
+    # reallocated when the frame size grows.
+    #
+    # The segments belong to the ring, not to the process that created them,
+    # they are removed by the main process when indi-allsky exits.
+
+    name_prefix = 'indi_allsky_frame'
+
+    # a worker that crashes never releases its slot
+    slot_timeout = 900
+
+    # populated by astropy from the frame data
+    fits_structure_keys = ('SIMPLE', 'BITPIX', 'NAXIS', 'NAXIS1', 'NAXIS2', 'NAXIS3', 'EXTEND', 'BZERO', 'BSCALE')
+
+
+    def __init__(self, slots):
+        self.slots = int(slots)
+
+        # 0 when free, otherwise the time the slot was filled
+        self._slot_time_av = Array('d', [0.0 for x in range(self.slots)])
+
+        # incremented when a slot is reallocated
+        self._slot_gen_av = Array('l', [0 for x in range(self.slots)])
+
+        # segments attached in this process, slot: (name, shm)
+        self._shm = dict()
+
+
+    def put(self, data, header_str):
+        # returns None when a slot is not available, the caller should fall back to a file
+        slot = self._acquire()
+
+        if isinstance(slot, type(None)):
+            logger.warning('No free frame slots, using temporary file')
+            return None
+
+
+        dtype = data.dtype.newbyteorder('=')  # FITS data is big endian
+
+        try:
+            shm = self._allocate(slot, data.nbytes)
+
+            slot_data = numpy.ndarray(data.shape, dtype=dtype, buffer=shm.buf)
+            slot_data[:] = data
+            del slot_data  # the segment cannot be closed while views exist
+        except OSError as e:
+            logger.error('Shared memory error: %s', str(e))
+            self._slot_time_av[slot] = 0.0
+            return None
+
+
+        frame = {
+            'slot'   : slot,
+            'name'   : shm.name,
+            'token'  : self._slot_time_av[slot],
+            'shape'  : data.shape,
+            'dtype'  : dtype.str,
+            'header' : header_str,
+        }
+
+        return frame
+
+
+    def get(self, frame):
+        # returns a view of the frame data, it is only valid until the frame is released
+        slot = frame['slot']
+
+        if self._slot_time_av[slot] != frame['token']:
+            raise BadImage('Frame slot {0:d} was reclaimed'.format(slot))
+
+
+        shm = self._attach(slot, frame['name'])
+
+        if not shm:
+            raise BadImage('Frame slot {0:d} not found'.format(slot))
+
+
+        return numpy.ndarray(frame['shape'], dtype=numpy.dtype(frame['dtype']), buffer=shm.buf)
+
+
+    def hdulist(self, frame):
+        from astropy.io import fits
+
+        data = self.get(frame)
+
+        hdu = fits.PrimaryHDU(data)
+        hdulist = fits.HDUList([hdu])
+
+        hdu.update_header()  # populates BITPIX, NAXIS, etc
+
+        # repopulate headers
+        header = fits.Header.fromstring(frame['header'])
+        for k, v in header.items():
+            if k in self.fits_structure_keys:
+                continue
+
+            hdulist[0].header[k] = v
+
+        return hdulist
+
+
+    def release(self, frame):
+        slot = frame['slot']
+
+        with self._slot_time_av.get_lock():
+            if self._slot_time_av[slot] == frame['token']:
+                self._slot_time_av[slot] = 0.0
+
+
+    def close(self):
+        for slot in list(self._shm.keys()):
+            self._detach(slot)
+
+
+    def cleanup(self):
+        # remove all segments, only call this when no other process is using the ring
+        self.close()
+
+        shm_p = Path('/dev/shm')
+        if not shm_p.is_dir():
+            return
+
+        for seg_p in shm_p.glob('{0:s}_*'.format(self.name_prefix)):
+            logger.info('Removing shared memory segment: %s', seg_p.name)
+
+            try:
+                seg_p.unlink()
+            except OSError as e:
+                logger.error('Unable to remove shared memory segment: %s', str(e))
+
+
+    def _acquire(self):
+        now = time.time()
+
+        with self._slot_time_av.get_lock():
+            for slot in range(self.slots):
+                slot_time = self._slot_time_av[slot]
+
+                if slot_time:
+                    if now - slot_time < self.slot_timeout:
+                        continue
+
+                    logger.warning('Reclaiming frame slot %d', slot)
+
+                self._slot_time_av[slot] = now
+                return slot
+
+        return None
+
+
+    def _allocate(self, slot, nbytes):
+        name = self._name(slot, self._slot_gen_av[slot])
+
+        shm = self._attach(slot, name)
+        if shm:
+            if shm.size >= nbytes:
+                return shm
+
+            # frame size increased
+            self._detach(slot)
+
+            try:
+                shared_memory.SharedMemory(name=name).unlink()
+            except FileNotFoundError:
+                pass
+
+
+        self._slot_gen_av[slot] += 1
+        name = self._name(slot, self._slot_gen_av[slot])
+
+        logger.info('Allocating frame slot %d: %0.1f MB', slot, nbytes / 1024 / 1024)
+        shm = shared_memory.SharedMemory(name=name, create=True, size=nbytes)
+        self._untrack(shm)
+
+        self._shm[slot] = (name, shm)
+
+        return shm
+
+
+    def _attach(self, slot, name):
+        slot_shm = self._shm.get(slot)
+
+        if slot_shm:
+            if slot_shm[0] == name:
+                return slot_shm[1]
+
+            # slot was reallocated
+            self._detach(slot)
+
+
+        try:
+            shm = shared_memory.SharedMemory(name=name)
+        except FileNotFoundError:
+            return None
+
+        self._untrack(shm)
+
+        self._shm[slot] = (name, shm)
+
+        return shm
+
+
+    def _detach(self, slot):
+        name, shm = self._shm.pop(slot)
+
+        try:
+            shm.close()
+        except BufferError:
+            # views of the data still exist, the segment is unmapped when they are freed
+            pass
+
+
+    def _untrack(self, shm):
+        # the resource tracker would remove the segment when this process exits
+        try:
+            resource_tracker.unregister(shm._name, 'shared_memory')
+        except Exception as e:
+            logger.warning('Unable to unregister shared memory segment: %s', str(e))
+
+
+    def _name(self, slot, gen):
+        return '{0:s}_{1:d}_{2:d}'.format(self.name_prefix, slot, gen)
+
@@ -31,7 +31,12 @@ from fractions import Fraction
 from . import constants
 
 from .processing import ImageProcessor
+from .imageSequencer import IndiAllSkyImageSequencer
+from .keogram import KeogramGenerator
+from .starTrails import StarTrailGenerator
 from .miscUpload import miscUpload
+from .uploadScheduler import IndiAllSkyUploadScheduler
+from .latestHistogram import IndiAllSkyLatestHistogram
 
 from .flask import create_app
 from .flask import db
@@ -51,7 +56,7 @@ from .exceptions import BadImage
 
 
 
-app = create_app()
+app = create_app(role='writer')
 
 logger = logging.getLogger('indi_allsky')
 
@@ -62,6 +67,9 @@ class ImageWorker(Process):
     sqm_history_minutes = 30
     stars_history_minutes = 30
 
+    # passive WAL checkpoints between frames, the log is truncated by the main process
+    db_checkpoint_period = 900
+
 
     def __init__(
         self,
@@ -78,6 +86,8 @@ class ImageWorker(Process):
         sensors_user_av,
         night_v,
         moonmode_v,
+        sequencer=None,
+        frame_ring=None,
     ):
         super(ImageWorker, self).__init__()
 
@@ -99,6 +109,19 @@ class ImageWorker(Process):
         self.night_v = night_v
         self.moonmode_v = moonmode_v
 
+
+        # orders frames between multiple image workers
+        if sequencer:
+            self._sequencer = sequencer
+        else:
+            self._sequencer = IndiAllSkyImageSequencer()
+
+        self._pipeline_metrics = dict()
+
+        # frames received in shared memory
+        self._frame_ring = frame_ring
+
+
         # shared between objects
         self.astrometric_data = {
             'sun_alt'       : 0.0,
@@ -160,6 +183,17 @@ class ImageWorker(Process):
         self._miscDb = miscDb(self.config)
         self._miscUpload = miscUpload(self.config, self.upload_q)
 
+        self._db_checkpoint_time = time.time() + self.db_checkpoint_period
+
+        # keogram is built as images are processed
+        self._keogram_gen = None
+        self._keogram_partial_p = None
+
+        # star trail is built as night images are processed
+        self._startrail_gen = None
+        self._startrail_partial_p = None
+        self._startrail_shape = None
+
 
         self._libcamera_raw = False
 
@@ -206,6 +240,27 @@ class ImageWorker(Process):
         raise TimeOutException()
 
 
+    def _loadExposureState(self):
+        # exposure state is shared between image workers
+        state = self._sequencer.loadExposureState()
+
+        self.target_adu_found = state['target_adu_found']
+        self.current_adu_target = state['current_adu_target']
+        self.generate_mask_base = state['generate_mask_base']
+        self.hist_adu = state['hist_adu']
+
+
+    def _saveExposureState(self):
+        state = {
+            'target_adu_found'   : self.target_adu_found,
+            'current_adu_target' : self.current_adu_target,
+            'generate_mask_base' : self.generate_mask_base,
+            'hist_adu'           : self.hist_adu,
+        }
+
+        self._sequencer.saveExposureState(state)
+
+
 
     def run(self):
         # setup signal handling after detaching from the main process
@@ -230,7 +285,7 @@ class ImageWorker(Process):
 
         while True:
             try:
-                i_dict = self.image_q.get(timeout=23)  # prime number
+                i_dict = self._sequencer.get(self.image_q, timeout=23)  # prime number
             except queue.Empty:
                 continue
 
@@ -250,6 +305,21 @@ class ImageWorker(Process):
 
 
     def processImage(self, i_dict):
+        try:
+            self._processImage(i_dict)
+        finally:
+            try:
+                # entries of a failed frame are still committed
+                self._miscDb.commitBatch()
+            finally:
+                if i_dict.get('frame'):
+                    self._frame_ring.release(i_dict['frame'])
+
+                # dropped frames must not block the ordered stages of the other workers
+                self._sequencer.release(i_dict['seq'])
+
+
+    def _processImage(self, i_dict):
         ### Not using DB task queue for image processing to reduce database I/O
         #task_id = i_dict['task_id']
 
@@ -276,12 +346,13 @@ class ImageWorker(Process):
         #filename_t = task.data.get('filename_t')
         ###
 
-        filename_p = Path(i_dict['filename'])
+        frame = i_dict.get('frame')
         exposure = i_dict['exposure']
         exp_date = datetime.fromtimestamp(i_dict['exp_time'])
         exp_elapsed = i_dict['exp_elapsed']
         camera_id = i_dict['camera_id']
         filename_t = i_dict.get('filename_t')
+        seq = i_dict['seq']
 
 
         # libcamera
@@ -290,6 +361,12 @@ class ImageWorker(Process):
         libcamera_ccm = i_dict.get('libcamera_ccm')
 
 
+        if frame:
+            filename_p = None
+        else:
+            filename_p = Path(i_dict['filename'])
+
+
         if self.config['CAMERA_INTERFACE'].startswith('libcamera'):
             if filename_p.suffix == '.dng':
                 self.libcamera_raw = True
@@ -303,16 +380,17 @@ class ImageWorker(Process):
             self.filename_t = filename_t
 
 
-        if not filename_p.exists():
-            logger.error('Frame not found: %s', filename_p)
-            #task.setFailed('Frame not found: {0:s}'.format(str(filename_p)))
-            return
+        if filename_p:
+            if not filename_p.exists():
+                logger.error('Frame not found: %s', filename_p)
+                #task.setFailed('Frame not found: {0:s}'.format(str(filename_p)))
+                return
 
 
-        if filename_p.stat().st_size == 0:
-            logger.error('Frame is empty: %s', filename_p)
-            filename_p.unlink()
-            return
+            if filename_p.stat().st_size == 0:
+                logger.error('Frame is empty: %s', filename_p)
+                filename_p.unlink()
+                return
 
 
         camera = IndiAllSkyDbCameraTable.query\
@@ -331,15 +409,28 @@ class ImageWorker(Process):
 
 
         try:
-            i_ref = self.image_processor.add(filename_p, exposure, exp_date, exp_elapsed, camera)
+            if frame:
+                hdulist = self._frame_ring.hdulist(frame)
+
+                if self.image_processor.stack_count > 1:
+                    # stacked images are kept after the frame slot is released
+                    hdulist[0].data = hdulist[0].data.copy()
+
+                i_ref = self.image_processor.add(None, exposure, exp_date, exp_elapsed, camera, hdulist=hdulist)
+            else:
+                i_ref = self.image_processor.add(filename_p, exposure, exp_date, exp_elapsed, camera)
         except BadImage as e:
             logger.error('Bad Image: %s', str(e))
-            filename_p.unlink()
+
+            if filename_p:
+                filename_p.unlink()
+
             #task.setFailed('Bad Image: {0:s}'.format(str(filename_p)))
             return
 
 
-        filename_p.unlink()  # original file is no longer needed
+        if filename_p:
+            filename_p.unlink()  # original file is no longer needed
 
 
         self.image_count += 1
@@ -507,6 +598,11 @@ class ImageWorker(Process):
         #logger.info('Wrote Numpy data: /tmp/indi_allsky_numpy.npy')
 
 
+        # exposure calculation depends on frame order
+        exposure_wait_s = self._sequencer.wait('exposure', seq)
+        self._loadExposureState()
+
+
         # adu calculate (before processing)
         adu, adu_average = self.calculate_exposure(adu, exposure)
 
@@ -518,6 +614,10 @@ class ImageWorker(Process):
             self.write_mask_base_img(self.image_processor.image)
 
 
+        self._saveExposureState()
+        self._sequencer.done('exposure', seq)
+
+
         # line detection
         if self.night_v.value and self.config.get('DETECT_METEORS'):
             self.image_processor.detectLines()
@@ -602,7 +702,7 @@ class ImageWorker(Process):
 
 
         if self.config.get('FISH2PANO', {}).get('ENABLE'):
-            if not self.image_count % self.config.get('FISH2PANO', {}).get('MODULUS', 4):
+            if not seq % self.config.get('FISH2PANO', {}).get('MODULUS', 4):
                 pano_data = self.image_processor.fish2pano()
 
 
@@ -632,13 +732,35 @@ class ImageWorker(Process):
         final_height, final_width = self.image_processor.image.shape[:2]
 
 
+        # compress before waiting for the commit stage
+        tmpfile_name = self.encode_img(self.image_processor.image, jpeg_exif=jpeg_exif)
+
+        histogram = self.image_processor.histogram()
+
+
+        # files and DB entries are written in frame order
+        commit_wait_s = self._sequencer.wait('commit', seq)
+        commit_start = time.time()
+
+        self._pipeline_metrics = {
+            'seq'             : seq,
+            'queue_depth'     : i_dict['queue_depth'],
+            'process_s'       : round(processing_elapsed_s, 3),
+            'exposure_wait_s' : round(exposure_wait_s, 3),
+            'commit_wait_s'   : round(commit_wait_s, 3),
+        }
+
+
         #task.setSuccess('Image processed')
 
         self.write_status_json(i_ref, adu, adu_average)  # write json status file
 
-        latest_file, new_filename = self.write_img(self.image_processor.image, i_ref, camera, jpeg_exif=jpeg_exif)
+        latest_file, new_filename = self.store_img(tmpfile_name, i_ref, camera)
 
         if new_filename:
+            # only the latest histogram is kept for the charts
+            IndiAllSkyLatestHistogram().save(camera.uuid, new_filename.relative_to(self.image_dir), histogram)
+
             image_metadata = {
                 'type'            : constants.IMAGE,
                 'createDate'      : exp_date.timestamp(),
@@ -680,11 +802,8 @@ class ImageWorker(Process):
             image_metadata['data'] = image_add_data
 
 
-            image_entry = self._miscDb.addImage(
-                new_filename.relative_to(self.image_dir),
-                camera_id,
-                image_metadata,
-            )
+            self.updateKeogram(self.image_processor.image, i_ref, new_filename)
+            self.updateStarTrails(self.image_processor.image, i_ref, new_filename, adu)
 
 
             image_thumbnail_metadata = {
@@ -697,19 +816,16 @@ class ImageWorker(Process):
                 'camera_uuid': camera.uuid,
             }
 
-            image_thumbnail_entry = self._miscDb.addThumbnailImageAuto(
-                image_entry,
-                image_metadata,
-                camera.id,
+            # the thumbnail file is written before the DB transaction
+            image_thumbnail_p = self._miscDb.writeThumbnailImageAuto(
                 image_thumbnail_metadata,
                 numpy_data=self.image_processor.image,
             )
         else:
             # images not being saved
-            image_entry = None
             image_metadata = {}
-            image_thumbnail_entry = None
             image_thumbnail_metadata = {}
+            image_thumbnail_p = None
 
 
         if latest_file:
@@ -841,12 +957,44 @@ class ImageWorker(Process):
                 mqtt_data[sensor_topic] = round(v, 1)
 
 
+            # image processing pipeline
+            for k, v in self._pipeline_metrics.items():
+                mqtt_data['image/{0:s}'.format(k)] = v
+
+
             if new_filename:
                 upload_filename = new_filename
             else:
                 upload_filename = latest_file
 
 
+        # one DB transaction for the image, thumbnail and task entries, the
+        # write lock is only held for the inserts
+        self._miscDb.beginBatch()
+
+        if new_filename:
+            image_entry = self._miscDb.addImage(
+                new_filename.relative_to(self.image_dir),
+                camera_id,
+                image_metadata,
+            )
+
+            if image_thumbnail_p:
+                image_thumbnail_entry = self._miscDb.addThumbnailEntry(
+                    image_entry,
+                    image_metadata,
+                    camera.id,
+                    image_thumbnail_p,
+                    image_thumbnail_metadata,
+                )
+            else:
+                image_thumbnail_entry = None
+        else:
+            image_entry = None
+            image_thumbnail_entry = None
+
+
+        if latest_file:
             ### upload thumbnail first
             if image_thumbnail_entry:
                 self._miscUpload.syncapi_thumbnail(image_thumbnail_entry, image_thumbnail_metadata)  # syncapi before s3
@@ -861,6 +1009,101 @@ class ImageWorker(Process):
             self.upload_metadata(i_ref, adu, adu_average)
 
 
+        self._miscDb.commitBatch()
+
+        if time.time() > self._db_checkpoint_time:
+            # passive checkpoints do not wait for readers, the next frame is not blocked
+            self._db_checkpoint_time = time.time() + self.db_checkpoint_period
+            self._miscDb.walCheckpoint(mode='PASSIVE')
+
+        self._sequencer.done('commit', seq)
+
+        commit_elapsed_s = time.time() - commit_start
+        logger.info('Image %d committed in %0.4f s (queue depth %d, waited %0.4f s)', seq, commit_elapsed_s, i_dict['queue_depth'], commit_wait_s)
+
+
+    def updateKeogram(self, data, i_ref, filename):
+        if not self.config.get('TIMELAPSE_ENABLE', True):
+            return
+
+        if not self.night_v.value and not self.config.get('DAYTIME_TIMELAPSE', True):
+            return
+
+
+        partial_p = KeogramGenerator.partialPath(i_ref['camera_id'], i_ref['day_date'], self.night_v.value)
+
+        if partial_p != self._keogram_partial_p:
+            self._keogram_gen = KeogramGenerator(self.config)
+            self._keogram_gen.angle = self.config['KEOGRAM_ANGLE']
+
+            try:
+                self._keogram_gen.openPartial(partial_p, data.shape, append_only=True)
+            except OSError as e:
+                logger.error('Unable to open partial keogram: %s', str(e))
+                self._keogram_gen = None
+
+            self._keogram_partial_p = partial_p
+
+
+        if not self._keogram_gen:
+            return
+
+
+        self._keogram_gen.processImage(filename, data, timestamp=filename.stat().st_mtime)
+
+
+    def updateStarTrails(self, data, i_ref, filename, adu):
+        if not self.config.get('TIMELAPSE_ENABLE', True):
+            return
+
+        if not self.night_v.value:
+            # release the trail buffer during the day
+            self._startrail_gen = None
+            self._startrail_partial_p = None
+            return
+
+
+        partial_p = StarTrailGenerator.partialPath(i_ref['camera_id'], i_ref['day_date'])
+
+        if partial_p != self._startrail_partial_p or data.shape != self._startrail_shape:
+            self._startrail_gen = StarTrailGenerator(
+                self.config,
+                self.bin_v,
+                mask=self.image_processor._detection_mask,
+                mask_registry=self.image_processor._mask_registry,
+            )
+            self._startrail_gen.setupThresholds(self.position_av[0], self.position_av[1])
+
+            try:
+                self._startrail_gen.openPartial(partial_p, data.shape)
+            except OSError as e:
+                logger.error('Unable to open partial star trail: %s', str(e))
+                self._startrail_gen = None
+
+            self._startrail_partial_p = partial_p
+            self._startrail_shape = data.shape
+        elif self._startrail_gen and self._sequencer.workers > 1:
+            # other image workers also update the partial star trail
+            try:
+                self._startrail_gen.openPartial(partial_p, data.shape)
+            except OSError as e:
+                logger.error('Unable to open partial star trail: %s', str(e))
+                self._startrail_gen = None
+
+
+        if not self._startrail_gen:
+            return
+
+
+        if self.config.get('STARTRAILS_USE_DB_DATA', True):
+            # same values that are stored in the DB
+            star_count = len(i_ref['stars'])
+        else:
+            adu, star_count = None, None
+
+        self._startrail_gen.processImage(filename, data, adu=adu, star_count=star_count)
+
+
     def decdeg2dms(self, dd):
         is_positive = dd >= 0
         dd = abs(dd)
@@ -881,7 +1124,7 @@ class ImageWorker(Process):
             return
 
 
-        self.metadata_count += 1
+        self.metadata_count = self._sequencer.nextMetadataCount()
 
         metadata_remain = self.metadata_count % int(self.config['FILETRANSFER']['UPLOAD_IMAGE'])
         if metadata_remain != 0:
@@ -955,9 +1198,9 @@ class ImageWorker(Process):
             data=jobdata,
         )
         db.session.add(upload_task)
-        db.session.commit()
+        self._miscDb.commit()
 
-        self.upload_q.put({'task_id' : upload_task.id})
+        self._miscDb.afterCommit(self.upload_q.put, IndiAllSkyUploadScheduler.message(upload_task))
 
 
 
@@ -1292,6 +1535,12 @@ class ImageWorker(Process):
 
 
     def write_img(self, data, i_ref, camera, jpeg_exif=None):
+        tmpfile_name = self.encode_img(data, jpeg_exif=jpeg_exif)
+
+        return self.store_img(tmpfile_name, i_ref, camera)
+
+
+    def encode_img(self, data, jpeg_exif=None):
         f_tmpfile = tempfile.NamedTemporaryFile(mode='w+b', delete=False, suffix='.{0}'.format(self.config['IMAGE_FILE_TYPE']))
         f_tmpfile.close()
 
@@ -1325,7 +1574,10 @@ class ImageWorker(Process):
         write_img_elapsed_s = time.time() - write_img_start
         logger.info('Image compressed in %0.4f s', write_img_elapsed_s)
 
+        return tmpfile_name
+
 
+    def store_img(self, tmpfile_name, i_ref, camera):
         ### Always write the latest file for web access
         latest_file = self.image_dir.joinpath('latest.{0:s}'.format(self.config['IMAGE_FILE_TYPE']))
 
@@ -1401,6 +1653,7 @@ class ImageWorker(Process):
             'latitude'            : self.position_av[0],
             'longitude'           : self.position_av[1],
             'elevation'           : int(self.position_av[2]),
+            'image_pipeline'      : self._pipeline_metrics,
         }
 
 
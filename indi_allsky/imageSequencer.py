@@ -0,0 +1,138 @@
+import time
+import queue
+from multiprocessing import Array
+from multiprocessing import Condition
+from multiprocessing import Lock
+from multiprocessing import Value
+import logging
+
+
+logger = logging.getLogger('indi_allsky')
+
+
+class IndiAllSkyImageSequencer(object):
+    # Image workers process frames in parallel.  Frames are numbered as they
+    # are removed from the image queue and the stages that depend on frame
+    # order (exposure calculation, writing files and DB entries) are run one
+    # frame at a time in sequence.
+
+    stages = ('exposure', 'commit')
+
+    # a worker that crashes never releases its frame
+    stage_timeout = 300
+
+    history_max = 10
+
+
+    def __init__(self, workers=1):
+        self.workers = int(workers)
+
+        self._dequeue_lock = Lock()
+        self._cond = Condition()
+
+        self._next_seq_v = Value('l', 0)
+
+        self._stage_seq = dict()
+        for stage in self.stages:
+            self._stage_seq[stage] = Value('l', 0)
+
+
+        # exposure state shared by the workers
+        # 0 target adu found
+        # 1 current adu target
+        # 2 generate mask base
+        # 3 adu history length
+        # 4+ adu history
+        self._exposure_state_av = Array('d', [0.0 for x in range(4 + self.history_max)])
+        self._exposure_state_av[2] = 1.0
+
+        self._metadata_count_v = Value('l', 0)
+
+
+    def get(self, image_q, timeout=None):
+        # frames must be numbered in the order they are removed from the queue
+        if not self._dequeue_lock.acquire(timeout=timeout):
+            raise queue.Empty
+
+        try:
+            i_dict = image_q.get(timeout=timeout)
+
+            if not i_dict.get('stop'):
+                i_dict['queue_depth'] = image_q.qsize()
+
+                with self._next_seq_v.get_lock():
+                    i_dict['seq'] = self._next_seq_v.value
+                    self._next_seq_v.value += 1
+        finally:
+            self._dequeue_lock.release()
+
+        return i_dict
+
+
+    def release(self, seq):
+        # release the stages a frame did not complete, dropped frames must not block the following frames
+        for stage in self.stages:
+            if self._stage_seq[stage].value > seq:
+                continue
+
+            self.wait(stage, seq)
+            self.done(stage, seq)
+
+
+    def wait(self, stage, seq):
+        stage_seq_v = self._stage_seq[stage]
+
+        start = time.time()
+
+        with self._cond:
+            if not self._cond.wait_for(lambda: stage_seq_v.value >= seq, timeout=self.stage_timeout):
+                logger.error('Timeout waiting for frame %d in %s stage, skipping', stage_seq_v.value, stage)
+                stage_seq_v.value = seq
+
+            if stage_seq_v.value > seq:
+                logger.warning('Frame %d is late for %s stage', seq, stage)
+
+        return time.time() - start
+
+
+    def done(self, stage, seq):
+        stage_seq_v = self._stage_seq[stage]
+
+        with self._cond:
+            if stage_seq_v.value <= seq:
+                stage_seq_v.value = seq + 1
+
+            self._cond.notify_all()
+
+
+    def loadExposureState(self):
+        with self._exposure_state_av.get_lock():
+            hist_len = int(self._exposure_state_av[3])
+
+            state = {
+                'target_adu_found'   : bool(self._exposure_state_av[0]),
+                'current_adu_target' : self._exposure_state_av[1],
+                'generate_mask_base' : bool(self._exposure_state_av[2]),
+                'hist_adu'           : list(self._exposure_state_av[4:4 + hist_len]),
+            }
+
+        return state
+
+
+    def saveExposureState(self, state):
+        hist_adu = state['hist_adu'][(self.history_max * -1):]
+
+        with self._exposure_state_av.get_lock():
+            self._exposure_state_av[0] = float(state['target_adu_found'])
+            self._exposure_state_av[1] = float(state['current_adu_target'])
+            self._exposure_state_av[2] = float(state['generate_mask_base'])
+            self._exposure_state_av[3] = float(len(hist_adu))
+
+            for i, v in enumerate(hist_adu):
+                self._exposure_state_av[4 + i] = float(v)
+
+
+    def nextMetadataCount(self):
+        with self._metadata_count_v.get_lock():
+            self._metadata_count_v.value += 1
+            return self._metadata_count_v.value
@@ -1,3 +1,5 @@
+import io
+import json
 import cv2
 import numpy
 #import PIL
@@ -24,6 +26,12 @@ class KeogramGenerator(object):
     line_thickness = 2
     line_length = 35
 
+    # keogram buffer grows by at least this many columns
+    buffer_chunk_columns = 500
+
+    # partial keograms are built as images are captured
+    partial_folder = Path('/var/lib/indi-allsky/keogram')
+
 
     def __init__(self, config):
         self.config = config
@@ -41,9 +49,17 @@ class KeogramGenerator(object):
         self.rotated_width = None
         self.rotated_height = None
 
-        self.keogram_data = None
+        self._keogram_buffer = None
+        self._keogram_columns = 0
         self.keogram_final = None  # will contain final resized keogram
 
+        # sampling map for the center line of the rotated image
+        self._map_x = None
+        self._map_y = None
+
+        self._partial_p = None
+        self._append_only = False  # do not hold the keogram in memory
+
         self.timestamps_list = list()
         self.image_processing_elapsed_s = 0
 
@@ -96,6 +112,27 @@ class KeogramGenerator(object):
         self._crop_bottom = int(new_crop)
 
 
+    @property
+    def keogram_data(self):
+        if isinstance(self._keogram_buffer, type(None)):
+            return None
+
+        return self._keogram_buffer[:, :self._keogram_columns]
+
+    @keogram_data.setter
+    def keogram_data(self, *args):
+        pass  # read only
+
+
+    @property
+    def columns(self):
+        return self._keogram_columns
+
+    @columns.setter
+    def columns(self, *args):
+        pass  # read only
+
+
     @property
     def shape(self):
         return self.keogram_final.shape
@@ -136,47 +173,299 @@ class KeogramGenerator(object):
     #    logger.warning('Total keogram processing in %0.1f s', processing_elapsed_s)
 
 
-    def processImage(self, filename, image):
+    def processImage(self, filename, image, timestamp=None):
         image_processing_start = time.time()
 
-        self.timestamps_list.append(filename.stat().st_mtime)
-
         height, width = image.shape[:2]
 
 
-        rotated_image = self.rotate(image)
+        if isinstance(self._map_x, type(None)):
+            # this only happens on the first image
+            self.original_height = height
+            self.original_width = width
 
+            self._generateSampleMap(height, width)
 
-        rot_height, rot_width = rotated_image.shape[:2]
-        self.rotated_height = rot_height
-        self.rotated_width = rot_width
 
-        rotated_center_line = rotated_image[:, [int(rot_width / 2)]]
+        if height != self.original_height or width != self.original_width:
+            # all images have to match dimensions of the first image
+            logger.error('Image with dimension mismatch: %s', filename)
+            return
 
-        if isinstance(self.keogram_data, type(None)):
-            # this only happens on the first image
 
-            self.original_height = height
-            self.original_width = width
+        if isinstance(timestamp, type(None)):
+            timestamp = filename.stat().st_mtime
+
+
+        # only the center line of the rotated image is sampled
+        rotated_center_line = cv2.remap(image, self._map_x, self._map_y, cv2.INTER_LINEAR)
+
+        if len(rotated_center_line.shape) == 2:
+            # mono
+            rotated_center_line = rotated_center_line.reshape((self.rotated_height, 1))
+
+
+        if not self._append_only:
+            self._addColumn(rotated_center_line, timestamp)
+        else:
+            self._keogram_columns += 1
+
 
-            new_shape = rotated_center_line.shape
+        if self._partial_p:
+            self._appendPartial(rotated_center_line, timestamp)
+
+
+        self.image_processing_elapsed_s += time.time() - image_processing_start
+
+
+    def _generateSampleMap(self, height, width):
+        # Generate a remap table for the center line of the rotated image
+        center_x = int(width / 2)
+        center_y = int(height / 2)
+
+        rot = cv2.getRotationMatrix2D((center_x, center_y), self.angle, 1.0)
+
+        abs_cos = abs(rot[0, 0])
+        abs_sin = abs(rot[0, 1])
+
+        bound_w = int(height * abs_sin + width * abs_cos)
+        bound_h = int(height * abs_cos + width * abs_sin)
+
+        rot[0, 2] += bound_w / 2 - center_x
+        rot[1, 2] += bound_h / 2 - center_y
+
+        self.rotated_height = bound_h
+        self.rotated_width = bound_w
+
+
+        # map destination coordinates back to the source image
+        rot_inv = cv2.invertAffineTransform(rot)
+
+        line_x = int(bound_w / 2)
+        line_y = numpy.arange(bound_h, dtype=numpy.float32)
+
+        map_x = rot_inv[0, 0] * line_x + rot_inv[0, 1] * line_y + rot_inv[0, 2]
+        map_y = rot_inv[1, 0] * line_x + rot_inv[1, 1] * line_y + rot_inv[1, 2]
+
+        self._map_x = map_x.astype(numpy.float32).reshape((bound_h, 1))
+        self._map_y = map_y.astype(numpy.float32).reshape((bound_h, 1))
+
+
+    def _addColumn(self, column, timestamp):
+        if isinstance(self._keogram_buffer, type(None)):
+            new_shape = list(column.shape)
+            new_shape[1] = self.buffer_chunk_columns
             logger.info('New Shape: %s', pformat(new_shape))
 
-            new_dtype = rotated_center_line.dtype
+            new_dtype = column.dtype
             logger.info('New dtype: %s', new_dtype)
 
-            self.keogram_data = numpy.empty(new_shape, dtype=new_dtype)
+            self._keogram_buffer = numpy.zeros(new_shape, dtype=new_dtype)
+        elif self._keogram_columns >= self._keogram_buffer.shape[1]:
+            # grow buffer geometrically to avoid copying on every image
+            grow_columns = max(self.buffer_chunk_columns, self._keogram_buffer.shape[1])
 
+            new_shape = list(self._keogram_buffer.shape)
+            new_shape[1] = self._keogram_buffer.shape[1] + grow_columns
+
+            new_buffer = numpy.zeros(new_shape, dtype=self._keogram_buffer.dtype)
+            new_buffer[:, :self._keogram_columns] = self._keogram_buffer[:, :self._keogram_columns]
+            self._keogram_buffer = new_buffer
+
+
+        self._keogram_buffer[:, self._keogram_columns] = column[:, 0]
+        self._keogram_columns += 1
+
+        self.timestamps_list.append(timestamp)
+
+
+    def openPartial(self, partial_p, image_shape, append_only=False):
+        # A partial keogram is stored as a raw file of columns that is appended as images are captured
+        self._partial_p = Path(partial_p)
+        self._append_only = bool(append_only)
+
+        height, width = image_shape[:2]
+
+        if len(image_shape) == 2:
+            channels = 1
+        else:
+            channels = image_shape[2]
+
+        header_p = self._partial_p.with_suffix('.json')
+        data_p = self._partial_p.with_suffix('.dat')
+        ts_p = self._partial_p.with_suffix('.ts')
+
+
+        if self._loadPartial(self._partial_p, height=height, width=width, channels=channels):
+            logger.info('Resuming partial keogram with %d columns: %s', self._keogram_columns, self._partial_p)
+
+            if self._append_only:
+                self._keogram_buffer = None
 
-        if height != self.original_height or width != self.original_width:
-            # all images have to match dimensions of the first image
-            logger.error('Image with dimension mismatch: %s', filename)
             return
 
 
-        self.keogram_data = numpy.append(self.keogram_data, rotated_center_line, 1)
+        # start over
+        self._keogram_buffer = None
+        self._keogram_columns = 0
+        self.timestamps_list = list()
 
-        self.image_processing_elapsed_s += time.time() - image_processing_start
+        self.original_height = height
+        self.original_width = width
+        self._generateSampleMap(height, width)
+
+
+        if not self._partial_p.parent.exists():
+            self._partial_p.parent.mkdir(mode=0o755, parents=True)
+
+
+        header = {
+            'angle'    : self.angle,
+            'height'   : height,
+            'width'    : width,
+            'channels' : channels,
+        }
+
+        with io.open(str(header_p), 'w') as f_header:
+            json.dump(header, f_header)
+
+        for p in (data_p, ts_p):
+            try:
+                p.unlink()
+            except FileNotFoundError:
+                pass
+
+
+    def _appendPartial(self, column, timestamp):
+        data_p = self._partial_p.with_suffix('.dat')
+        ts_p = self._partial_p.with_suffix('.ts')
+
+        try:
+            with io.open(str(data_p), 'ab') as f_data:
+                f_data.write(numpy.ascontiguousarray(column).tobytes())
+
+            with io.open(str(ts_p), 'a') as f_ts:
+                f_ts.write('{0:f}\n'.format(timestamp))
+        except OSError as e:
+            logger.error('Unable to write partial keogram: %s', str(e))
+            self._partial_p = None
+
+
+    def loadPartial(self, partial_p):
+        # load a partial keogram for finalizing
+        return self._loadPartial(partial_p)
+
+
+    def _loadPartial(self, partial_p, height=None, width=None, channels=None):
+        partial_p = Path(partial_p)
+
+        header_p = partial_p.with_suffix('.json')
+        data_p = partial_p.with_suffix('.dat')
+        ts_p = partial_p.with_suffix('.ts')
+
+        try:
+            with io.open(str(header_p), 'r') as f_header:
+                header = json.load(f_header)
+        except FileNotFoundError:
+            return False
+        except json.JSONDecodeError:
+            logger.error('Invalid partial keogram header: %s', header_p)
+            return False
+
+
+        if header.get('angle') != self.angle:
+            logger.warning('Keogram angle changed, discarding partial keogram')
+            return False
+
+
+        if isinstance(height, type(None)):
+            height = header['height']
+            width = header['width']
+            channels = header['channels']
+
+        if header.get('height') != height or header.get('width') != width or header.get('channels') != channels:
+            logger.warning('Image dimensions changed, discarding partial keogram')
+            return False
+
+
+        self.original_height = height
+        self.original_width = width
+        self._generateSampleMap(height, width)
+
+
+        try:
+            with io.open(str(ts_p), 'r') as f_ts:
+                timestamps_list = [float(x) for x in f_ts.read().split()]
+
+            raw_data = numpy.fromfile(str(data_p), dtype=numpy.uint8)
+        except FileNotFoundError:
+            timestamps_list = list()
+            raw_data = numpy.zeros(0, dtype=numpy.uint8)
+        except ValueError:
+            logger.error('Invalid partial keogram timestamps: %s', ts_p)
+            return False
+
+
+        column_bytes = self.rotated_height * channels
+
+
+        # an interrupted write may leave the files with different lengths
+        columns = min(int(raw_data.shape[0] / column_bytes), len(timestamps_list))
+
+        self._keogram_buffer = None
+        self._keogram_columns = 0
+        self.timestamps_list = list()
+
+        if not columns:
+            return True
+
+
+        if channels == 1:
+            column_data = raw_data[:columns * column_bytes].reshape((columns, self.rotated_height))
+            self._keogram_buffer = numpy.zeros((self.rotated_height, columns + self.buffer_chunk_columns), dtype=numpy.uint8)
+        else:
+            column_data = raw_data[:columns * column_bytes].reshape((columns, self.rotated_height, channels))
+            self._keogram_buffer = numpy.zeros((self.rotated_height, columns + self.buffer_chunk_columns, channels), dtype=numpy.uint8)
+
+
+        self._keogram_buffer[:, :columns] = numpy.swapaxes(column_data, 0, 1)
+        self._keogram_columns = columns
+        self.timestamps_list = timestamps_list[:columns]
+
+
+        if columns * column_bytes != raw_data.shape[0] or columns != len(timestamps_list):
+            # truncate files to the consistent length
+            with io.open(str(data_p), 'r+b') as f_data:
+                f_data.truncate(columns * column_bytes)
+
+            with io.open(str(ts_p), 'w') as f_ts:
+                f_ts.write(''.join(['{0:f}\n'.format(x) for x in self.timestamps_list]))
+
+
+        return True
+
+
+    def removePartial(self, partial_p):
+        partial_p = Path(partial_p)
+
+        for suffix in ('.json', '.dat', '.ts'):
+            try:
+                partial_p.with_suffix(suffix).unlink()
+            except FileNotFoundError:
+                pass
+
+        if self._partial_p == partial_p:
+            self._partial_p = None
+
+
+    @classmethod
+    def partialPath(cls, camera_id, day_date, night):
+        if night:
+            timeofday = 'night'
+        else:
+            timeofday = 'day'
+
+        return cls.partial_folder.joinpath('keogram_ccd{0:d}_{1:s}_{2:s}'.format(int(camera_id), day_date.strftime('%Y%m%d'), timeofday))
 
 
     def finalize(self, outfile, camera):
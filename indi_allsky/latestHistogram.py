@@ -0,0 +1,59 @@
+import io
+import json
+import tempfile
+from pathlib import Path
+import logging
+
+
+logger = logging.getLogger('indi_allsky')
+
+
+class IndiAllSkyLatestHistogram(object):
+    # Histogram of the latest image of each camera, served by the charts.
+    # Only the latest histogram is kept, older images are read from the
+    # filesystem.
+
+    if Path('/dev/shm').is_dir():
+        histogram_folder = Path('/dev/shm').joinpath('indi_allsky_histogram')
+    else:
+        histogram_folder = Path(tempfile.gettempdir()).joinpath('indi_allsky_histogram')
+
+
+    def _path(self, camera_uuid):
+        return self.histogram_folder.joinpath('{0:s}.json'.format(str(camera_uuid)))
+
+
+    def save(self, camera_uuid, filename, histogram):
+        histogram_p = self._path(camera_uuid)
+        histogram_tmp_p = histogram_p.with_suffix('.json_tmp')
+
+        data = {
+            'filename'  : str(filename),
+            'histogram' : histogram,
+        }
+
+        try:
+            if not self.histogram_folder.exists():
+                self.histogram_folder.mkdir(mode=0o755, parents=True)
+
+            with io.open(str(histogram_tmp_p), 'w') as f_histogram:
+                json.dump(data, f_histogram)
+
+            histogram_tmp_p.replace(histogram_p)
+        except OSError as e:
+            logger.error('Unable to write histogram: %s', str(e))
+
+
+    def load(self, camera_uuid, filename):
+        # returns None if the latest histogram is not for this image
+        try:
+            with io.open(str(self._path(camera_uuid)), 'r') as f_histogram:
+                data = json.load(f_histogram)
+        except (OSError, ValueError):
+            return None
+
+
+        if data.get('filename') != str(filename):
+            return None
+
+        return data.get('histogram')
@@ -0,0 +1,158 @@
+import cv2
+import numpy
+import logging
+
+
+logger = logging.getLogger('indi_allsky')
+
+
+class IndiAllSkyMaskRegistry(object):
+    # The detection mask and SQM_ROI geometry is shared by the detection,
+    # SQM, stretch, stacking and star trail objects.  Each representation is
+    # generated once per image size and binning and is read-only.  A new
+    # registry is created when the config is reloaded.
+
+    def __init__(self, config, bin_v, detection_mask=None):
+        self.config = config
+        self.bin_v = bin_v
+
+        # full resolution DETECT_MASK, may be None
+        self.detection_mask = detection_mask
+
+        self._cache = dict()
+
+
+    def mask(self, shape):
+        # uint8 mask, 255 is kept, the detection mask or the SQM_ROI
+        detection_mask = self.detectionMask(shape)
+
+        if not isinstance(detection_mask, type(None)):
+            return detection_mask
+
+        return self.roiMask(shape)
+
+
+    def detectionMask(self, shape):
+        if isinstance(self.detection_mask, type(None)):
+            return None
+
+        return self._get('detection', shape, self._generateDetectionMask)
+
+
+    def roiMask(self, shape):
+        # uint8 SQM_ROI rectangle
+        return self._get('roi', shape, self._generateRoiMask)
+
+
+    def boundingRect(self, shape):
+        # x, y, w, h of the kept area
+        return self._get('rect', shape, lambda s: cv2.boundingRect(self.mask(s)))
+
+
+    def gradient(self, shape, kernel_size, split=False):
+        # blurred uint8 mask, mask edges are not detected as edges
+        return self._get(('gradient', kernel_size, split), shape, lambda s: self._generateGradient(s, kernel_size, split))
+
+
+    def flatIndex(self, shape, subsample=1):
+        # uint32 indices of every Nth kept pixel in the flattened image
+        return self._get(('index', subsample), shape, lambda s: self._generateFlatIndex(s, subsample))
+
+
+    def clear(self):
+        self._cache.clear()
+
+
+    def _get(self, name, shape, generate):
+        key = (name, int(shape[0]), int(shape[1]), int(self.bin_v.value))
+
+        value = self._cache.get(key)
+        if not isinstance(value, type(None)):
+            return value
+
+
+        value = generate(shape)
+
+        if isinstance(value, numpy.ndarray):
+            value.flags.writeable = False  # shared
+
+        self._cache[key] = value
+
+        return value
+
+
+    def _generateDetectionMask(self, shape):
+        image_height, image_width = shape[:2]
+
+        if self.detection_mask.shape[:2] == (image_height, image_width):
+            return self.detection_mask.copy()
+
+
+        logger.warning('Detection mask does not match image dimensions, resizing')
+        return cv2.resize(self.detection_mask, (image_width, image_height), interpolation=cv2.INTER_NEAREST)
+
+
+    def _generateRoiMask(self, shape):
+        logger.info('Generating mask based on SQM_ROI')
+
+        image_height, image_width = shape[:2]
+
+        # create a black background
+        mask = numpy.zeros((image_height, image_width), dtype=numpy.uint8)
+
+        sqm_roi = self.config.get('SQM_ROI', [])
+
+        try:
+            x1 = int(sqm_roi[0] / self.bin_v.value)
+            y1 = int(sqm_roi[1] / self.bin_v.value)
+            x2 = int(sqm_roi[2] / self.bin_v.value)
+            y2 = int(sqm_roi[3] / self.bin_v.value)
+        except IndexError:
+            logger.warning('Using central ROI')
+            sqm_fov_div = self.config.get('SQM_FOV_DIV', 4)
+            x1 = int((image_width / 2) - (image_width / sqm_fov_div))
+            y1 = int((image_height / 2) - (image_height / sqm_fov_div))
+            x2 = int((image_width / 2) + (image_width / sqm_fov_div))
+            y2 = int((image_height / 2) + (image_height / sqm_fov_div))
+
+        # The white area is what we keep
+        cv2.rectangle(
+            img=mask,
+            pt1=(x1, y1),
+            pt2=(x2, y2),
+            color=(255),  # mono
+            thickness=cv2.FILLED,
+        )
+
+        return mask
+
+
+    def _generateGradient(self, shape, kernel_size, split):
+        image_height, image_width = shape[:2]
+
+        mask = self.mask(shape).copy()
+
+        if split:
+            # mask center line split between panes
+            half_width = int(image_width / 2)
+            cv2.line(
+                img=mask,
+                pt1=(half_width, 0),
+                pt2=(half_width, image_height),
+                color=(0),  # mono
+                thickness=71,
+            )
+
+        return cv2.blur(mask, (kernel_size, kernel_size), cv2.BORDER_DEFAULT)
+
+
+    def _generateFlatIndex(self, shape, subsample):
+        image_height, image_width = shape[:2]
+
+        mask_idx = numpy.flatnonzero(self.mask(shape))[::subsample]
+
+        if mask_idx.shape[0] == 0:
+            logger.warning('Mask is empty, using the full image')
+            mask_idx = numpy.arange(0, image_height * image_width, subsample)
+
+        return mask_idx.astype(numpy.uint32)
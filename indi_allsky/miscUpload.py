@@ -5,11 +5,14 @@ import logging
 from . import constants
 
 from .flask import db
+from .flask.miscDb import miscDb
 
 from .flask.models import TaskQueueState
 from .flask.models import TaskQueueQueue
 from .flask.models import IndiAllSkyDbTaskQueueTable
 
+from .uploadScheduler import IndiAllSkyUploadScheduler
+
 logger = logging.getLogger('indi_allsky')
 
 
@@ -24,6 +27,8 @@ class miscUpload(object):
         self.config = config
         self.upload_q = upload_q
 
+        self._miscDb = miscDb(self.config)
+
 
     def upload_image(self, image_entry):
         ### upload images
@@ -80,10 +85,7 @@ class miscUpload(object):
             state=TaskQueueState.QUEUED,
             data=jobdata,
         )
-        db.session.add(upload_task)
-        db.session.commit()
-
-        self.upload_q.put({'task_id' : upload_task.id})
+        self._queueTask(upload_task)
 
 
     def upload_video(self, video_entry):
@@ -122,10 +124,7 @@ class miscUpload(object):
             state=TaskQueueState.QUEUED,
             data=jobdata,
         )
-        db.session.add(upload_task)
-        db.session.commit()
-
-        self.upload_q.put({'task_id' : upload_task.id})
+        self._queueTask(upload_task)
 
 
     def upload_mini_video(self, video_entry):
@@ -164,10 +163,7 @@ class miscUpload(object):
             state=TaskQueueState.QUEUED,
             data=jobdata,
         )
-        db.session.add(upload_task)
-        db.session.commit()
-
-        self.upload_q.put({'task_id' : upload_task.id})
+        self._queueTask(upload_task)
 
 
     def upload_panorama_video(self, video_entry):
@@ -206,10 +202,7 @@ class miscUpload(object):
             state=TaskQueueState.QUEUED,
             data=jobdata,
         )
-        db.session.add(upload_task)
-        db.session.commit()
-
-        self.upload_q.put({'task_id' : upload_task.id})
+        self._queueTask(upload_task)
 
 
     def upload_keogram(self, keogram_entry):
@@ -250,10 +243,7 @@ class miscUpload(object):
             state=TaskQueueState.QUEUED,
             data=jobdata,
         )
-        db.session.add(upload_task)
-        db.session.commit()
-
-        self.upload_q.put({'task_id' : upload_task.id})
+        self._queueTask(upload_task)
 
 
     def upload_startrail(self, startrail_entry):
@@ -293,10 +283,7 @@ class miscUpload(object):
             state=TaskQueueState.QUEUED,
             data=jobdata,
         )
-        db.session.add(upload_task)
-        db.session.commit()
-
-        self.upload_q.put({'task_id' : upload_task.id})
+        self._queueTask(upload_task)
 
 
     def upload_startrail_video(self, startrail_video_entry):
@@ -336,10 +323,7 @@ class miscUpload(object):
             state=TaskQueueState.QUEUED,
             data=jobdata,
         )
-        db.session.add(upload_task)
-        db.session.commit()
-
-        self.upload_q.put({'task_id' : upload_task.id})
+        self._queueTask(upload_task)
 
 
     def upload_panorama(self, panorama_entry):
@@ -392,10 +376,7 @@ class miscUpload(object):
             state=TaskQueueState.QUEUED,
             data=jobdata,
         )
-        db.session.add(upload_task)
-        db.session.commit()
-
-        self.upload_q.put({'task_id' : upload_task.id})
+        self._queueTask(upload_task)
 
 
     def upload_raw_image(self, raw_image_entry):
@@ -435,10 +416,7 @@ class miscUpload(object):
             state=TaskQueueState.QUEUED,
             data=jobdata,
         )
-        db.session.add(upload_task)
-        db.session.commit()
-
-        self.upload_q.put({'task_id' : upload_task.id})
+        self._queueTask(upload_task)
 
 
     def upload_fits_image(self, fits_image_entry):
@@ -478,10 +456,7 @@ class miscUpload(object):
             state=TaskQueueState.QUEUED,
             data=jobdata,
         )
-        db.session.add(upload_task)
-        db.session.commit()
-
-        self.upload_q.put({'task_id' : upload_task.id})
+        self._queueTask(upload_task)
 
 
     def mqtt_publish_image(self, upload_filename, image_topic, mq_data):
@@ -502,10 +477,7 @@ class miscUpload(object):
             state=TaskQueueState.QUEUED,
             data=jobdata,
         )
-        db.session.add(mqtt_task)
-        db.session.commit()
-
-        self.upload_q.put({'task_id' : mqtt_task.id})
+        self._queueTask(mqtt_task)
 
 
     def s3_upload_asset(self, asset_entry, asset_metadata):
@@ -532,10 +504,7 @@ class miscUpload(object):
             state=TaskQueueState.QUEUED,
             data=jobdata,
         )
-        db.session.add(s3_task)
-        db.session.commit()
-
-        self.upload_q.put({'task_id' : s3_task.id})
+        self._queueTask(s3_task)
 
 
     def s3_upload_image(self, *args):
@@ -638,10 +607,7 @@ class miscUpload(object):
             state=TaskQueueState.QUEUED,
             data=jobdata,
         )
-        db.session.add(upload_task)
-        db.session.commit()
-
-        self.upload_q.put({'task_id' : upload_task.id})
+        self._queueTask(upload_task)
 
 
     def syncapi_video(self, asset_entry, metadata):
@@ -673,10 +639,7 @@ class miscUpload(object):
             state=TaskQueueState.QUEUED,
             data=jobdata,
         )
-        db.session.add(upload_task)
-        db.session.commit()
-
-        self.upload_q.put({'task_id' : upload_task.id})
+        self._queueTask(upload_task)
 
 
     def syncapi_mini_video(self, *args):
@@ -747,10 +710,7 @@ class miscUpload(object):
             state=TaskQueueState.QUEUED,
             data=jobdata,
         )
-        db.session.add(upload_task)
-        db.session.commit()
-
-        self.upload_q.put({'task_id' : upload_task.id})
+        self._queueTask(upload_task)
 
 
     def _youtube_upload(self, video_entry, metadata):
@@ -772,10 +732,7 @@ class miscUpload(object):
             data=jobdata,
         )
 
-        db.session.add(upload_task)
-        db.session.commit()
-
-        self.upload_q.put({'task_id' : upload_task.id})
+        self._queueTask(upload_task)
 
 
     def youtube_upload_video(self, video_entry, metadata):
@@ -813,3 +770,10 @@ class miscUpload(object):
 
         self._youtube_upload(video_entry, metadata)
 
+
+    def _queueTask(self, task):
+        db.session.add(task)
+        self._miscDb.commit()
+
+        # the task must be committed before the upload worker reads it
+        self._miscDb.afterCommit(self.upload_q.put, IndiAllSkyUploadScheduler.message(task))
@@ -0,0 +1,114 @@
+from datetime import datetime
+from datetime import timedelta
+import logging
+
+from .flask import db
+from .flask.models import IndiAllSkyDbMultipartUploadTable
+
+from .filetransfer.multipart import MultipartState
+
+
+logger = logging.getLogger('indi_allsky')
+
+
+class IndiAllSkyMultipartState(MultipartState):
+    # Multipart upload progress stored in the database, uploads continue after
+    # the daemon is restarted.  Only used by the upload worker threads, the
+    # part threads do not access the database.
+
+    expire_days = 7  # incomplete uploads are not resumed after this
+
+
+    def _query(self, identity):
+        return IndiAllSkyDbMultipartUploadTable.query\
+            .filter(IndiAllSkyDbMultipartUploadTable.classname == identity['classname'])\
+            .filter(IndiAllSkyDbMultipartUploadTable.bucket == identity['bucket'])\
+            .filter(IndiAllSkyDbMultipartUploadTable.key == identity['key'])
+
+
+    def _match(self, entry, identity):
+        if entry.filename != identity['filename']:
+            return False
+
+        if entry.size != identity['size']:
+            return False
+
+        if entry.mtime != identity['mtime']:
+            return False
+
+        if entry.part_size != identity['part_size']:
+            return False
+
+        return True
+
+
+    def load(self, identity):
+        expire_date = datetime.now() - timedelta(days=self.expire_days)
+
+        for entry in self._query(identity).filter(IndiAllSkyDbMultipartUploadTable.createDate > expire_date):
+            if not self._match(entry, identity):
+                continue
+
+            # json keys are strings
+            parts = {int(n): etag for n, etag in (entry.parts or {}).items()}
+
+            return entry.upload_id, parts
+
+        return None
+
+
+    def stale(self, identity):
+        # entries are removed, the caller aborts the uploads
+        expire_date = datetime.now() - timedelta(days=self.expire_days)
+
+        upload_id_list = list()
+        for entry in self._query(identity):
+            if entry.createDate > expire_date and self._match(entry, identity):
+                continue
+
+            upload_id_list.append(entry.upload_id)
+            db.session.delete(entry)
+
+        db.session.commit()
+
+        return upload_id_list
+
+
+    def save(self, identity, upload_id, parts):
+        entry = self._query(identity)\
+            .filter(IndiAllSkyDbMultipartUploadTable.upload_id == upload_id)\
+            .first()
+
+        if not entry:
+            entry = IndiAllSkyDbMultipartUploadTable(
+                classname=identity['classname'],
+                bucket=identity['bucket'],
+                key=identity['key'],
+                filename=identity['filename'],
+                size=identity['size'],
+                mtime=identity['mtime'],
+                part_size=identity['part_size'],
+                upload_id=upload_id,
+            )
+
+            db.session.add(entry)
+
+
+        entry.parts = {str(n): etag for n, etag in parts.items()}
+        db.session.commit()
+
+
+    def remove(self, identity):
+        self._query(identity)\
+            .delete(synchronize_session=False)
+        db.session.commit()
+
+
+    def expire(self):
+        # remote parts of abandoned uploads are removed by the bucket lifecycle rules
+        expire_date = datetime.now() - timedelta(days=self.expire_days)
+
+        IndiAllSkyDbMultipartUploadTable.query\
+            .filter(IndiAllSkyDbMultipartUploadTable.createDate < expire_date)\
+            .delete(synchronize_session=False)
+        db.session.commit()
@@ -29,7 +29,10 @@ from .detectLines import IndiAllskyDetectLines
 from .draw import IndiAllSkyDraw
 from .scnr import IndiAllskyScnr
 from .stack import IndiAllskyStacker
+from .maskRegistry import IndiAllSkyMaskRegistry
+from .calibrationCache import IndiAllskyCalibrationCache
 from .cardinalDirsLabel import IndiAllskyCardinalDirsLabel
+from .fish2panoMap import IndiAllskyFish2PanoMap
 from .utils import IndiAllSkyDateCalcs
 
 from .flask.models import IndiAllSkyDbBadPixelMapTable
@@ -122,6 +125,9 @@ class ImageProcessor(object):
         self._detection_mask = self._load_detection_mask()
         self._adu_mask = self._detection_mask  # reuse detection mask for ADU mask (if defined)
 
+        # mask geometry shared by the stretch, SQM, detection and stacking
+        self._mask_registry = IndiAllSkyMaskRegistry(self.config, self.bin_v, detection_mask=self._detection_mask)
+
         self._image_circle_alpha_mask = None
 
         self._overlay = None
@@ -149,20 +155,23 @@ class ImageProcessor(object):
 
         self._dateCalcs = IndiAllSkyDateCalcs(self.config, self.position_av)
 
+        self._calibration_cache = IndiAllskyCalibrationCache(self.dark_temperature_range)
+
 
         if self.config['IMAGE_STRETCH'].get('CLASSNAME'):
             stretch_class = getattr(stretch, self.config['IMAGE_STRETCH']['CLASSNAME'])
-            self._stretch = stretch_class(self.config, self.bin_v, mask=self._detection_mask)
+            self._stretch = stretch_class(self.config, self.bin_v, mask=self._detection_mask, mask_registry=self._mask_registry)
         else:
             self._stretch = None
 
 
-        self._sqm = IndiAllskySqm(self.config, self.bin_v, mask=None)
-        self._stars_detect = IndiAllSkyStars(self.config, self.bin_v, mask=self._detection_mask)
-        self._lineDetect = IndiAllskyDetectLines(self.config, self.bin_v, mask=self._detection_mask)
-        self._draw = IndiAllSkyDraw(self.config, self.bin_v, mask=self._detection_mask)
+        self._sqm = IndiAllskySqm(self.config, self.bin_v, mask=None, mask_registry=self._mask_registry)
+        self._stars_detect = IndiAllSkyStars(self.config, self.bin_v, mask=self._detection_mask, mask_registry=self._mask_registry)
+        self._lineDetect = IndiAllskyDetectLines(self.config, self.bin_v, mask=self._detection_mask, mask_registry=self._mask_registry)
+        self._draw = IndiAllSkyDraw(self.config, self.bin_v, mask=self._detection_mask, mask_registry=self._mask_registry)
         self._scnr = IndiAllskyScnr(self.config)
         self._cardinal_dirs_label = IndiAllskyCardinalDirsLabel(self.config)
+        self._fish2pano_map = IndiAllskyFish2PanoMap(self.config)
 
         self._orb = IndiAllskyOrbGenerator(self.config)
         self._orb.sun_alt_deg = self.config['NIGHT_SUN_ALT_DEG']
@@ -171,7 +180,7 @@ class ImageProcessor(object):
         self._orb.sun_color_rgb = self.config['ORB_PROPERTIES']['SUN_COLOR']
         self._orb.moon_color_rgb = self.config['ORB_PROPERTIES']['MOON_COLOR']
 
-        self._stacker = IndiAllskyStacker(self.config, self.bin_v, mask=self._detection_mask)
+        self._stacker = IndiAllskyStacker(self.config, self.bin_v, mask=self._detection_mask, mask_registry=self._mask_registry)
         self._stacker.detection_sigma = self.config.get('IMAGE_ALIGN_DETECTSIGMA', 5)
         self._stacker.max_control_points = self.config.get('IMAGE_ALIGN_POINTS', 50)
         self._stacker.min_area = self.config.get('IMAGE_ALIGN_SOURCEMINAREA', 10)
@@ -309,10 +318,14 @@ class ImageProcessor(object):
         self._text_font_height = int(new_height)
 
 
-    def add(self, filename, exposure, exp_date, exp_elapsed, camera):
+    def add(self, filename, exposure, exp_date, exp_elapsed, camera, hdulist=None):
+        # hdulist is provided when the frame was not written to a file
         from astropy.io import fits
 
-        filename_p = Path(filename)
+        if isinstance(hdulist, type(None)):
+            filename_p = Path(filename)
+        else:
+            filename_p = None
 
 
         # clear old data as soon as possible
@@ -330,11 +343,12 @@ class ImageProcessor(object):
 
 
         ### Open file
-        if filename_p.suffix in ['.fit', '.fits']:
-            try:
-                hdulist = fits.open(filename_p)
-            except OSError as e:
-                raise BadImage(str(e)) from e
+        if isinstance(filename_p, type(None)) or filename_p.suffix in ['.fit', '.fits']:
+            if isinstance(hdulist, type(None)):
+                try:
+                    hdulist = fits.open(filename_p)
+                except OSError as e:
+                    raise BadImage(str(e)) from e
 
             #logger.info('Initial HDU Header = %s', pformat(hdulist[0].header))
             image_bitpix = hdulist[0].header['BITPIX']
@@ -745,6 +759,61 @@ class ImageProcessor(object):
 
 
     def _apply_calibration(self, data, exposure, camera_id, image_bitpix):
+        calibration_key = self._calibration_cache.key(
+            camera_id,
+            image_bitpix,
+            self.gain_v.value,
+            self.bin_v.value,
+            exposure,
+            self.sensors_temp_av[0],
+        )
+
+        cache_entry = self._calibration_cache.get(calibration_key, self.sensors_temp_av[0])
+
+        if cache_entry:
+            logger.info('Using cached master dark (dark %s, bpm %s)', str(cache_entry['dark_id']), str(cache_entry['bpm_id']))
+            master_dark = cache_entry['master_dark']
+
+            if isinstance(master_dark, type(None)):
+                raise CalibrationNotFound('Dark not found')
+        else:
+            # not catching CalibrationNotFound
+            master_dark, dark_frame_entry, bpm_entry, dark_temp_matched, bpm_temp_matched = self._load_master_dark(exposure, camera_id, image_bitpix)
+
+            # a missing dark is also cached until the calibration frames change
+            self._calibration_cache.add(calibration_key, master_dark, dark_frame_entry, bpm_entry, dark_temp_matched, bpm_temp_matched)
+
+            if isinstance(master_dark, type(None)):
+                raise CalibrationNotFound('Dark not found')
+
+
+        if master_dark.shape != data.shape:
+            logger.error('Dark frame calibration dimensions mismatch')
+            raise CalibrationNotFound('Dark frame calibration dimension mismatch')
+
+
+        if data.dtype.type == numpy.float32:
+            ### cv2 does not support float32
+            data_calibrated = numpy.subtract(data, master_dark)
+
+            # cutoff values less than 0
+            data_calibrated[data_calibrated < 0] = 0
+        elif data.dtype.type == numpy.uint32:
+            ### cv2 does not support uint32
+            # cast to float so we can deal with negative numbers
+            data_calibrated = numpy.subtract(data.astype(numpy.float32), master_dark)
+
+            # cutoff values less than 0
+            data_calibrated[data_calibrated < 0] = 0
+
+            data_calibrated = data_calibrated.astype(numpy.uint32)
+        else:
+            data_calibrated = cv2.subtract(data, master_dark)
+
+        return data_calibrated
+
+
+    def _load_master_dark(self, exposure, camera_id, image_bitpix):
         from astropy.io import fits
 
         # pick a bad pixel map that is closest to the exposure and temperature
@@ -765,6 +834,8 @@ class ImageProcessor(object):
             )\
             .first()
 
+        bpm_temp_matched = bool(bpm_entry)
+
         if not bpm_entry:
             logger.warning('Temperature matched bad pixel map not found: %0.2fc', self.sensors_temp_av[0])
 
@@ -814,6 +885,8 @@ class ImageProcessor(object):
             )\
             .first()
 
+        dark_temp_matched = bool(dark_frame_entry)
+
         if not dark_frame_entry:
             logger.warning('Temperature matched dark not found: %0.2fc', self.sensors_temp_av[0])
 
@@ -844,7 +917,7 @@ class ImageProcessor(object):
                     self.sensors_temp_av[0],
                 )
 
-                raise CalibrationNotFound('Dark not found')
+                return None, None, bpm_entry, False, bpm_temp_matched
 
 
         if bpm_entry:
@@ -869,7 +942,8 @@ class ImageProcessor(object):
         logger.info('Matched dark: %s', p_dark_frame)
 
         with fits.open(p_dark_frame) as dark_f:
-            dark = dark_f[0].data
+            # copy the data out of the memory map, the master dark is cached
+            dark = numpy.array(dark_f[0].data)
 
 
         if not isinstance(bpm, type(None)):
@@ -879,30 +953,7 @@ class ImageProcessor(object):
             master_dark = dark
 
 
-        if master_dark.shape != data.shape:
-            logger.error('Dark frame calibration dimensions mismatch')
-            raise CalibrationNotFound('Dark frame calibration dimension mismatch')
-
-
-        if data.dtype.type == numpy.float32:
-            ### cv2 does not support float32
-            data_calibrated = numpy.subtract(data, master_dark)
-
-            # cutoff values less than 0
-            data_calibrated[data_calibrated < 0] = 0
-        elif data.dtype.type == numpy.uint32:
-            ### cv2 does not support uint32
-            # cast to float so we can deal with negative numbers
-            data_calibrated = numpy.subtract(data.astype(numpy.float32), master_dark)
-
-            # cutoff values less than 0
-            data_calibrated[data_calibrated < 0] = 0
-
-            data_calibrated = data_calibrated.astype(numpy.uint32)
-        else:
-            data_calibrated = cv2.subtract(data, master_dark)
-
-        return data_calibrated
+        return master_dark, dark_frame_entry, bpm_entry, dark_temp_matched, bpm_temp_matched
 
 
     def calculate_8bit_adu(self):
@@ -960,6 +1011,27 @@ class ImageProcessor(object):
         i_ref['sqm_value'] = self._sqm.calculate(i_ref['opencv_data'], i_ref['exposure'], self.gain_v.value)
 
 
+    def histogram(self):
+        # 256 bin histograms of the final 8-bit image in the mask, served by the charts
+        mask = self._mask_registry.mask(self.image.shape)
+
+        if len(self.image.shape) == 2:
+            # mono
+            h_numpy = cv2.calcHist([self.image], [0], mask, [256], [0, 256])
+            return {
+                'gray' : h_numpy.reshape(-1).astype(numpy.uint32).tolist(),
+            }
+
+
+        # color
+        histogram = dict()
+        for i, col in enumerate(('blue', 'green', 'red')):
+            h_numpy = cv2.calcHist([self.image], [i], mask, [256], [0, 256])
+            histogram[col] = h_numpy.reshape(-1).astype(numpy.uint32).tolist()
+
+        return histogram
+
+
     def stack(self):
         # self.image and self.non_stacked_image are first populated by this method
         i_ref = self.getLatestImage()
@@ -1022,17 +1094,28 @@ class ImageProcessor(object):
                 stack_data_list = [x['opencv_data'] for x in stack_i_ref_list]
 
             signal.alarm(0)
+
+            stack_key_list = None
         else:
             # stack unaligned images
             stack_data_list = [x['opencv_data'] for x in stack_i_ref_list]
 
+            # unaligned frames do not change, the stack is updated incrementally
+            stack_key_list = [x['exp_date'].timestamp() for x in stack_i_ref_list]
+
 
         stack_start = time.time()
 
 
         try:
-            stacker_method = getattr(self._stacker, self.stack_method)
-            self.image = stacker_method(stack_data_list, numpy_type)
+            if stack_key_list:
+                self.image = self._stacker.stackWindow(self.stack_method, stack_key_list, stack_data_list, numpy_type)
+            else:
+                # registered frames are aligned to a new reference every time
+                self._stacker.resetWindow()
+
+                stacker_method = getattr(self._stacker, self.stack_method)
+                self.image = stacker_method(stack_data_list, numpy_type)
         except AttributeError:
             logger.error('Unknown stacking method: %s', self.stack_method)
             self.image = i_ref['opencv_data']
@@ -2419,154 +2502,9 @@ class ImageProcessor(object):
         self.image = stretched_image
 
 
-    def fish2pano_purepython(self):
-        ### Courtesy of Russell Valentine <russell.valentine@gmail.com>
-        ### https://github.com/bluthen/fish2pano
-
-        angle = self.config.get('FISH2PANO', {}).get('ROTATE_ANGLE', 0)
-        if angle:
-            height, width = self.image.shape[:2]
-            center_x = int(width / 2)
-            center_y = int(height / 2)
-
-            rot = cv2.getRotationMatrix2D((center_x, center_y), int(angle), 1.0)
-
-            abs_cos = abs(rot[0, 0])
-            abs_sin = abs(rot[0, 1])
-
-            bound_w = int(height * abs_sin + width * abs_cos)
-            bound_h = int(height * abs_cos + width * abs_sin)
-
-            rot[0, 2] += bound_w / 2 - center_x
-            rot[1, 2] += bound_h / 2 - center_y
-
-            rotated_image = cv2.warpAffine(self.image, rot, (bound_w, bound_h))
-        else:
-            rotated_image = self.image
-
-
-        rot_height, rot_width = rotated_image.shape[:2]
-
-        x_offset = self.config.get('FISH2PANO', {}).get('OFFSET_X', 0)
-        y_offset = self.config.get('FISH2PANO', {}).get('OFFSET_Y', 0)
-        center_x = int(rot_width / 2) + x_offset
-        center_y = int(rot_height / 2) - y_offset  # note minus for y
-
-        radius = self.config.get('FISH2PANO', {}).get('DIAMETER', 3000) / 2
-        scale = self.config.get('FISH2PANO', {}).get('SCALE', 0.3)
-
-
-        w = int(scale * 2 * math.pi * radius + 0.5)
-        h = int(scale * radius + 0.5)
-        img_pano = numpy.zeros((h, w, 3), dtype=numpy.uint8)
-
-
-        fish2pano_start = time.time()
-
-        for x in range(w):
-            theta = (2.0 * math.pi) * x / w
-
-            for y in range(h):
-                r_0 = radius * y / h
-
-                x_ = r_0 * math.cos(theta) + center_x
-                y_ = r_0 * math.sin(theta) + center_y
-
-                ix_ = int(x_ + 0.5)
-                iy_ = int(y_ + 0.5)
-
-                if x_ > 0 and ix_ < rot_width and y_ > 0 and iy_ < rot_height:
-                    img_pano[y][x] = rotated_image[iy_][ix_]
-                else:
-                    img_pano[y][x] = [0, 0, 0]
-
-
-        pano_height, pano_width = img_pano.shape[:2]
-        mod_height = pano_height % 2
-        mod_width = pano_width % 2
-
-        if mod_height or mod_width:
-            # width and height needs to be divisible by 2 for timelapse
-            crop_width = pano_width - mod_width
-
-            img_pano = img_pano[
-                mod_height:pano_height,  # trim the top
-                0:crop_width,
-            ]
-
-
-        fish2pano_elapsed_s = time.time() - fish2pano_start
-        logger.info('Panorama in %0.4f s', fish2pano_elapsed_s)
-
-
-        # original image not replaced
-        return img_pano
-
-
-    def fish2pano_module(self):
-        import fish2pano
-
-        angle = self.config.get('FISH2PANO', {}).get('ROTATE_ANGLE', 0)
-        if angle:
-            height, width = self.image.shape[:2]
-            center_x = int(width / 2)
-            center_y = int(height / 2)
-
-            rot = cv2.getRotationMatrix2D((center_x, center_y), int(angle), 1.0)
-
-            abs_cos = abs(rot[0, 0])
-            abs_sin = abs(rot[0, 1])
-
-            bound_w = int(height * abs_sin + width * abs_cos)
-            bound_h = int(height * abs_cos + width * abs_sin)
-
-            rot[0, 2] += bound_w / 2 - center_x
-            rot[1, 2] += bound_h / 2 - center_y
-
-            rotated_image = cv2.warpAffine(self.image, rot, (bound_w, bound_h))
-        else:
-            rotated_image = self.image
-
-
-        rot_height, rot_width = rotated_image.shape[:2]
-
-        x_offset = self.config.get('FISH2PANO', {}).get('OFFSET_X', 0)
-        y_offset = self.config.get('FISH2PANO', {}).get('OFFSET_Y', 0)
-        center_x = int(rot_width / 2) + x_offset
-        center_y = int(rot_height / 2) - y_offset  # note minus for y
-
-        radius = self.config.get('FISH2PANO', {}).get('DIAMETER', 3000) / 2
-        scale = self.config.get('FISH2PANO', {}).get('SCALE', 0.3)
-
-
-        fish2pano_start = time.time()
-
-        img_pano = fish2pano.fish2pano(rotated_image, radius, [center_x, center_y], scale)
-
-
-        pano_height, pano_width = img_pano.shape[:2]
-        mod_height = pano_height % 2
-        mod_width = pano_width % 2
-
-        if mod_height or mod_width:
-            # width and height needs to be divisible by 2 for timelapse
-            crop_width = pano_width - mod_width
-
-            img_pano = img_pano[
-                mod_height:pano_height,  # trim the top
-                0:crop_width,
-            ]
-
-
-        fish2pano_elapsed_s = time.time() - fish2pano_start
-        logger.info('Panorama in %0.4f s', fish2pano_elapsed_s)
-
-        # original image not replaced
-        return img_pano
-
-
     def fish2pano(self):
-        return self.fish2pano_module()
+        # original image not replaced
+        return self._fish2pano_map.remap(self.image)
 
 
     def fish2pano_cardinal_dirs_label(self, pano_data):
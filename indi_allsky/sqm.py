@@ -1,17 +1,23 @@
 import cv2
-import numpy
 import logging
 
+from .maskRegistry import IndiAllSkyMaskRegistry
+
 
 logger = logging.getLogger('indi_allsky')
 
 
 class IndiAllskySqm(object):
 
-    def __init__(self, config, bin_v, mask=None):
+    def __init__(self, config, bin_v, mask=None, mask_registry=None):
         self.config = config
         self.bin_v = bin_v
 
+        if mask_registry:
+            self._masks = mask_registry
+        else:
+            self._masks = IndiAllSkyMaskRegistry(self.config, self.bin_v)
+
         # both masks will be combined
         self._external_mask = mask
         self._sqm_mask = None
@@ -20,8 +26,7 @@ class IndiAllskySqm(object):
     def calculate(self, img, exposure, gain):
         logger.info('Exposure: %0.6f, gain: %d', exposure, gain)
 
-        if isinstance(self._sqm_mask, type(None)):
-            # This only needs to be done once if a mask is not provided
+        if isinstance(self._sqm_mask, type(None)) or self._sqm_mask.shape[:2] != img.shape[:2]:
             self._generateSqmMask(img)
 
 
@@ -45,37 +50,7 @@ class IndiAllskySqm(object):
 
 
     def _generateSqmMask(self, img):
-        logger.info('Generating mask based on SQM_ROI')
-
-        image_height, image_width = img.shape[:2]
-
-        # create a black background
-        mask = numpy.zeros((image_height, image_width), dtype=numpy.uint8)
-
-        sqm_roi = self.config.get('SQM_ROI', [])
-
-        try:
-            x1 = int(sqm_roi[0] / self.bin_v.value)
-            y1 = int(sqm_roi[1] / self.bin_v.value)
-            x2 = int(sqm_roi[2] / self.bin_v.value)
-            y2 = int(sqm_roi[3] / self.bin_v.value)
-        except IndexError:
-            logger.warning('Using central ROI for SQM calculations')
-            sqm_fov_div = self.config.get('SQM_FOV_DIV', 4)
-            x1 = int((image_width / 2) - (image_width / sqm_fov_div))
-            y1 = int((image_height / 2) - (image_height / sqm_fov_div))
-            x2 = int((image_width / 2) + (image_width / sqm_fov_div))
-            y2 = int((image_height / 2) + (image_height / sqm_fov_div))
-
-        # The white area is what we keep
-        cv2.rectangle(
-            img=mask,
-            pt1=(x1, y1),
-            pt2=(x2, y2),
-            color=(255),  # mono
-            thickness=cv2.FILLED,
-        )
-
+        mask = self._masks.roiMask(img.shape)
 
         # combine masks in case there is overlapping regions
         if not isinstance(self._external_mask, type(None)):
@@ -1,19 +1,32 @@
 import time
+import math
 import numpy
 import cv2
 import astroalign
 import logging
 
+from .maskRegistry import IndiAllSkyMaskRegistry
+
 logger = logging.getLogger('indi_allsky')
 
 
 class IndiAllskyStacker(object):
 
-    def __init__(self, config, bin_v, mask=None):
+    sidereal_rate = (2 * math.pi) / 86164.0905  # radians per second
+
+    # matches between the predicted and detected control points (pixels)
+    warm_start_tolerance = 5.0
+    warm_start_min_matches = 8
+
+
+    def __init__(self, config, bin_v, mask=None, mask_registry=None):
         self.config = config
         self.bin_v = bin_v
 
-        self._sqm_mask = mask
+        if mask_registry:
+            self._masks = mask_registry
+        else:
+            self._masks = IndiAllSkyMaskRegistry(self.config, self.bin_v, detection_mask=mask)
 
         self._detection_sigma = 5
         self._max_control_points = 50
@@ -23,6 +36,13 @@ class IndiAllskyStacker(object):
         self._rotation_dev = 3  # rotation may not exceed this deviation
         self._history_min_vals = 15
 
+        # control points and transforms to the reference of previously registered frames
+        self._reg_cache = dict()
+        self._reg_ref_key = None
+        self._reg_last_step = None
+
+        self.resetWindow()
+
 
     @property
     def detection_sigma(self):
@@ -88,122 +108,211 @@ class IndiAllskyStacker(object):
 
 
     def average(self, stack_data_list, numpy_type):
-        mean_image = numpy.mean(stack_data_list, axis=0)
-        return numpy.floor(mean_image).astype(numpy_type)  # no floats
+        stack_sum = stack_data_list[0].astype(numpy.uint32)
+
+        for i in stack_data_list[1:]:
+            numpy.add(stack_sum, i, out=stack_sum)
+
+        return (stack_sum // len(stack_data_list)).astype(numpy_type)  # no floats
 
 
     def maximum(self, stack_data_list, numpy_type):
-        image_max = stack_data_list[0]  # start with first image
+        image_max = stack_data_list[0].copy()  # start with first image
 
         # compare with remaining images
         for i in stack_data_list[1:]:
-            image_max = numpy.maximum(image_max, i)
+            numpy.maximum(image_max, i, out=image_max)
 
         return image_max
 
+
     def minimum(self, stack_data_list, numpy_type):
-        image_min = stack_data_list[0]  # start with first image
+        image_min = stack_data_list[0].copy()  # start with first image
 
         # compare with remaining images
         for i in stack_data_list[1:]:
-            image_min = numpy.minimum(image_min, i)
+            numpy.minimum(image_min, i, out=image_min)
 
         return image_min
 
 
-    def register(self, stack_i_ref_list):
-        # first image is the reference
-        reference_i_ref = stack_i_ref_list[0]
+    def stackWindow(self, method, stack_key_list, stack_data_list, numpy_type):
+        # Stack the most recent frames (newest first) without restacking every
+        # frame.  Frames normally enter and leave the window one at a time,
+        # average keeps a running sum and maximum/minimum use a two stack
+        # sliding window.
+        if method == 'mean':
+            method = 'average'
 
+        if method not in ('average', 'maximum', 'minimum'):
+            raise AttributeError('Unknown stacking method: {0:s}'.format(method))
 
-        if isinstance(self._sqm_mask, type(None)):
-            # This only needs to be done once if a mask is not provided
-            self._generateSqmMask(reference_i_ref['hdulist'][0].data)
 
+        # oldest first
+        key_list = list(reversed(stack_key_list))
+        data_list = list(reversed(stack_data_list))
 
-        reg_data_list = [reference_i_ref['hdulist'][0].data]  # add target to final list
 
-        #reference_masked = self._crop(reference_i_ref['hdulist'][0].data)
-        reference_masked = cv2.bitwise_and(reference_i_ref['hdulist'][0].data, reference_i_ref['hdulist'][0].data, mask=self._sqm_mask)
+        remaining = [k for k in self._window_keys if k in key_list]
+        evict_count = len(self._window_keys) - len(remaining)
 
-        reg_start = time.time()
+        if method != self._window_method\
+                or (data_list[0].shape, data_list[0].dtype) != self._window_shape\
+                or not remaining\
+                or self._window_keys[evict_count:] != remaining\
+                or key_list[:len(remaining)] != remaining:
+            # frames were not added and removed in order
+            self.resetWindow()
+            self._window_method = method
+            self._window_shape = (data_list[0].shape, data_list[0].dtype)
+            evict_count = 0
+            remaining = list()
 
 
-        last_rotation = 0
+        for x in range(evict_count):
+            self._windowPop()
 
-        for i_ref in stack_i_ref_list[1:]:
-            #i_masked = self._crop(i_ref['hdulist'][0].data)
-            i_masked = cv2.bitwise_and(i_ref['hdulist'][0].data, i_ref['hdulist'][0].data, mask=self._sqm_mask)
+        for key, data in zip(key_list[len(remaining):], data_list[len(remaining):]):
+            self._windowPush(key, data)
 
-            # detection_sigma default = 5
-            # max_control_points default = 50
-            # min_area default = 5
 
-            try:
-                ### Find transform using a crop of the image
-                transform, (source_list, target_list) = astroalign.find_transform(
-                    i_masked,
-                    reference_masked,
-                    detection_sigma=self.detection_sigma,
-                    max_control_points=self.max_control_points,
-                    min_area=self.min_area,
-                )
+        if method == 'average':
+            return (self._window_sum // len(self._window_keys)).astype(numpy_type)  # no floats
 
-                logger.info(
-                    'Registration Matches: %d, Rotation: %0.6f, Translation: (%0.6f, %0.6f), Scale: %0.6f',
-                    len(target_list),
-                    transform.rotation,
-                    transform.translation[0], transform.translation[1],
-                    transform.scale,
-                )
 
+        op = self._windowOp()
+
+        if self._window_out_agg and not isinstance(self._window_in_agg, type(None)):
+            return op(self._window_out_agg[0], self._window_in_agg)
+        elif self._window_out_agg:
+            return self._window_out_agg[0].copy()
 
-                # add new rotation value
-                rotation = transform.rotation - last_rotation
-                #logger.info('Last rotation: %0.8f', rotation)
+        return self._window_in_agg.copy()
 
 
-                if len(self.hist_rotation) >= self._history_min_vals:
-                    # need at least this many values to establish an average
-                    rotation_mean = numpy.mean(self.hist_rotation)
-                    rotation_std = numpy.std(self.hist_rotation)
+    def resetWindow(self):
+        self._window_method = None
+        self._window_shape = None  # shape and dtype
+        self._window_keys = list()  # oldest first
+        self._window_frames = list()  # oldest first
 
-                    #logger.info('Rotation standard deviation: %0.8f', rotation_std)
+        # average
+        self._window_sum = None
 
-                    rotation_stddev_limit = rotation_std * self._rotation_dev
+        # maximum/minimum, older frames are aggregated from the newest to the
+        # oldest when they are moved out of the pending frames
+        self._window_out_agg = list()
+        self._window_in_agg = None
 
 
-                    # if the new rotation exceeds the deviation limit, do not apply the transform
-                    if rotation > (rotation_mean + rotation_stddev_limit)\
-                            or rotation < (rotation_mean - rotation_stddev_limit):
+    def _windowOp(self):
+        if self._window_method == 'maximum':
+            return numpy.maximum
 
-                        logger.error('Rotation exceeded limit of +/- %0.8f', rotation_stddev_limit)
-                        last_rotation += rotation_mean  # skipping a frame, need to account for rotation difference
-                        continue
+        return numpy.minimum
 
 
-                self.hist_rotation.append(rotation)  # only add known good rotation values
-                last_rotation = transform.rotation
+    def _windowPush(self, key, data):
+        self._window_keys.append(key)
+        self._window_frames.append(data)
 
+        if self._window_method == 'average':
+            if isinstance(self._window_sum, type(None)):
+                self._window_sum = data.astype(numpy.uint32)
+            else:
+                numpy.add(self._window_sum, data, out=self._window_sum)
 
+            return
+
+
+        if isinstance(self._window_in_agg, type(None)):
+            self._window_in_agg = data.copy()
+        else:
+            self._windowOp()(self._window_in_agg, data, out=self._window_in_agg)
+
+
+    def _windowPop(self):
+        self._window_keys.pop(0)
+        data = self._window_frames.pop(0)
+
+        if self._window_method == 'average':
+            numpy.subtract(self._window_sum, data, out=self._window_sum)
+            return
+
+
+        if not self._window_out_agg:
+            # aggregate the pending frames from newest to oldest
+            op = self._windowOp()
+
+            agg = None
+            out_agg = list()
+            for frame in reversed([data] + self._window_frames):
+                if isinstance(agg, type(None)):
+                    agg = frame.copy()
+                else:
+                    agg = op(agg, frame)
+
+                out_agg.insert(0, agg)
+
+            self._window_out_agg = out_agg
+            self._window_in_agg = None
+
+
+        self._window_out_agg.pop(0)
+
+
+    def register(self, stack_i_ref_list):
+        # Control points are only detected once per frame.  The newest frame is
+        # matched to the previous reference and the cached transforms of the
+        # older frames are chained to the new reference.
+
+        # first image is the reference
+        reference_i_ref = stack_i_ref_list[0]
 
+
+        reg_data_list = [reference_i_ref['hdulist'][0].data]  # add target to final list
+
+        reg_start = time.time()
+
+
+        key_list = [self._registrationKey(x) for x in stack_i_ref_list]
+
+        # forget frames that are no longer stacked
+        for key in list(self._reg_cache.keys()):
+            if key not in key_list:
+                del self._reg_cache[key]
+
+
+        reference_key = key_list[0]
+        if reference_key != self._reg_ref_key:
+            self._updateReference(reference_i_ref)
+
+        reference_entry = self._reg_cache[reference_key]
+
+
+        for i_ref, key in zip(stack_i_ref_list[1:], key_list[1:]):
+            entry = self._reg_cache.get(key)
+
+            if not entry:
+                # frame was not registered before
+                entry = self._registrationEntry(i_ref)
+                self._reg_cache[key] = entry
+
+
+            if isinstance(entry['transform'], type(None)):
+                # match directly to the reference
+                entry['transform'] = self._findTransform(entry, reference_entry)
+
+                if isinstance(entry['transform'], type(None)):
+                    continue
+
+
+            try:
                 reg_data, footprint = astroalign.apply_transform(
-                    transform,
+                    entry['transform'],
                     i_ref['hdulist'][0],
                     reference_i_ref['hdulist'][0],
                 )
-
-                ### Register full image
-                #reg_data, footprint = astroalign.register(
-                #    i_ref['hdulist'][0],
-                #    reference_i_ref['hdulist'][0],
-                #    detection_sigma=self.detection_simga,
-                #    max_control_points=self.max_control_points,
-                #    min_area=self.min_area,
-                #)
-            except astroalign.MaxIterError as e:
-                logger.error('Image registration failure: %s', str(e))
-                continue
             except ValueError as e:
                 logger.error('Image registration failure: %s', str(e))
                 continue
@@ -217,53 +326,249 @@ class IndiAllskyStacker(object):
         return reg_data_list
 
 
-    def _crop(self, image):
-        image_height, image_width = image.shape[:2]
+    def _registrationKey(self, i_ref):
+        return i_ref['exp_date'].timestamp()
 
-        x1 = int((image_width / 2) - (image_width / 4))
-        y1 = int((image_height / 2) - (image_height / 4))
-        x2 = int((image_width / 2) + (image_width / 4))
-        y2 = int((image_height / 2) + (image_height / 4))
 
+    def _registrationEntry(self, i_ref):
+        data = i_ref['hdulist'][0].data
 
-        return image[
-            y1:y2,
-            x1:x2,
-        ]
+        #i_masked = self._crop(data)
+        i_masked = cv2.bitwise_and(data, data, mask=self._masks.mask(data.shape))
+
+        entry = {
+            'exp_time'  : i_ref['exp_date'].timestamp(),
+            'transform' : None,  # to the current reference
+        }
+
+
+        try:
+            # brightest sources first
+            sources = astroalign._find_sources(
+                i_masked,
+                detection_sigma=self.detection_sigma,
+                min_area=self.min_area,
+            )
 
+            entry['points'] = sources[:self.max_control_points]
+            entry['sources'] = True
+        except AttributeError:
+            # astroalign will detect the sources for every match
+            entry['points'] = i_masked
+            entry['sources'] = False
 
-    def _generateSqmMask(self, img):
-        logger.info('Generating mask based on SQM_ROI')
 
-        image_height, image_width = img.shape[:2]
+        return entry
 
-        # create a black background
-        mask = numpy.zeros((image_height, image_width), dtype=numpy.uint8)
 
-        sqm_roi = self.config.get('SQM_ROI', [])
+    def _updateReference(self, reference_i_ref):
+        reference_key = self._registrationKey(reference_i_ref)
+
+        reference_entry = self._registrationEntry(reference_i_ref)
+        self._reg_cache[reference_key] = reference_entry
+
+
+        previous_entry = self._reg_cache.get(self._reg_ref_key)
+        self._reg_ref_key = reference_key
+
+        if not previous_entry:
+            self._reg_last_step = None
+            return
+
+
+        step = self._stepTransform(previous_entry, reference_entry)
+
+        for key, entry in self._reg_cache.items():
+            if key == reference_key:
+                continue
+
+            if isinstance(step, type(None)):
+                # older frames will be matched directly to the new reference
+                entry['transform'] = None
+            elif entry is previous_entry:
+                entry['transform'] = step
+            elif not isinstance(entry['transform'], type(None)):
+                entry['transform'] = entry['transform'] + step  # transform to the previous reference, then the step
+
+
+    def _stepTransform(self, previous_entry, reference_entry):
+        elapsed_s = reference_entry['exp_time'] - previous_entry['exp_time']
+
+        transform = self._warmStartTransform(previous_entry, reference_entry, elapsed_s)
+
+        if isinstance(transform, type(None)):
+            transform = self._findTransform(previous_entry, reference_entry)
+
+        if isinstance(transform, type(None)):
+            self._reg_last_step = None
+            return None
+
+
+        rotation = transform.rotation
+
+        if len(self.hist_rotation) >= self._history_min_vals:
+            # need at least this many values to establish an average
+            rotation_mean = numpy.mean(self.hist_rotation)
+            rotation_std = numpy.std(self.hist_rotation)
+
+            #logger.info('Rotation standard deviation: %0.8f', rotation_std)
+
+            rotation_stddev_limit = rotation_std * self._rotation_dev
+
+
+            # if the new rotation exceeds the deviation limit, do not apply the transform
+            if rotation > (rotation_mean + rotation_stddev_limit)\
+                    or rotation < (rotation_mean - rotation_stddev_limit):
+
+                logger.error('Rotation exceeded limit of +/- %0.8f', rotation_stddev_limit)
+                self._reg_last_step = None
+                return None
+
+
+        self.hist_rotation.append(rotation)  # only add known good rotation values
+        self.hist_rotation = self.hist_rotation[-100:]
+
+        self._reg_last_step = transform
+
+        return transform
+
+
+    def _findTransform(self, source_entry, target_entry):
+        # detection_sigma default = 5
+        # max_control_points default = 50
+        # min_area default = 5
 
         try:
-            x1 = int(sqm_roi[0] / self.bin_v.value)
-            y1 = int(sqm_roi[1] / self.bin_v.value)
-            x2 = int(sqm_roi[2] / self.bin_v.value)
-            y2 = int(sqm_roi[3] / self.bin_v.value)
-        except IndexError:
-            logger.warning('Using central ROI for registration')
-            sqm_fov_div = self.config.get('SQM_FOV_DIV', 4)
-            x1 = int((image_width / 2) - (image_width / sqm_fov_div))
-            y1 = int((image_height / 2) - (image_height / sqm_fov_div))
-            x2 = int((image_width / 2) + (image_width / sqm_fov_div))
-            y2 = int((image_height / 2) + (image_height / sqm_fov_div))
-
-        # The white area is what we keep
-        cv2.rectangle(
-            img=mask,
-            pt1=(x1, y1),
-            pt2=(x2, y2),
-            color=(255),  # mono
-            thickness=cv2.FILLED,
+            transform, (source_list, target_list) = astroalign.find_transform(
+                source_entry['points'],
+                target_entry['points'],
+                detection_sigma=self.detection_sigma,
+                max_control_points=self.max_control_points,
+                min_area=self.min_area,
+            )
+        except astroalign.MaxIterError as e:
+            logger.error('Image registration failure: %s', str(e))
+            return None
+        except ValueError as e:
+            logger.error('Image registration failure: %s', str(e))
+            return None
+
+
+        logger.info(
+            'Registration Matches: %d, Rotation: %0.6f, Translation: (%0.6f, %0.6f), Scale: %0.6f',
+            len(target_list),
+            transform.rotation,
+            transform.translation[0], transform.translation[1],
+            transform.scale,
         )
 
-        self._sqm_mask = mask
+        return transform
 
 
+    def _warmStartTransform(self, previous_entry, reference_entry, elapsed_s):
+        # The sky rotates around the same point at the sidereal rate, predict
+        # where the control points moved and only match the nearest points.
+        from skimage.transform import SimilarityTransform
+
+        last_step = self._reg_last_step
+
+        if isinstance(last_step, type(None)):
+            return None
+
+        if not previous_entry['sources'] or not reference_entry['sources']:
+            return None
+
+        if abs(last_step.rotation) < 1e-6:
+            # center of rotation cannot be determined
+            return None
+
+
+        # center of rotation is the point that the last step did not move
+        matrix = last_step.params[:2, :2]
+        translation = last_step.params[:2, 2]
+
+        try:
+            center = numpy.linalg.solve(numpy.eye(2) - matrix, translation)
+        except numpy.linalg.LinAlgError:
+            return None
+
+
+        rotation = math.copysign(self.sidereal_rate * elapsed_s, last_step.rotation)
+
+        rot_matrix = numpy.array([
+            [math.cos(rotation), -1 * math.sin(rotation)],
+            [math.sin(rotation), math.cos(rotation)],
+        ])
+
+        predicted = SimilarityTransform(rotation=rotation, translation=center - rot_matrix @ center)
+
+
+        source_points = numpy.asarray(previous_entry['points'], dtype=numpy.float64)
+        target_points = numpy.asarray(reference_entry['points'], dtype=numpy.float64)
+
+        if source_points.shape[0] < self.warm_start_min_matches or target_points.shape[0] < self.warm_start_min_matches:
+            return None
+
+
+        # nearest detected point to every predicted point
+        predicted_points = predicted(source_points)
+        distances = numpy.sqrt(((predicted_points[:, None, :] - target_points[None, :, :]) ** 2).sum(axis=2))
+
+        nearest_idx = distances.argmin(axis=1)
+        nearest_dist = distances[numpy.arange(source_points.shape[0]), nearest_idx]
+
+        matched = nearest_dist < self.warm_start_tolerance
+
+        # target points may only be matched once
+        _, unique_idx = numpy.unique(nearest_idx[matched], return_index=True)
+        source_matched = source_points[matched][unique_idx]
+        target_matched = target_points[nearest_idx[matched]][unique_idx]
+
+
+        min_matches = max(self.warm_start_min_matches, int(self.MIN_MATCHES_FRACTION * min(source_points.shape[0], target_points.shape[0])))
+        if source_matched.shape[0] < min_matches:
+            logger.info('Registration warm start failed: %d matches', source_matched.shape[0])
+            return None
+
+
+        if hasattr(SimilarityTransform, 'from_estimate'):
+            # scikit-image >= 0.26
+            transform = SimilarityTransform.from_estimate(source_matched, target_matched)
+            if not transform:
+                return None
+        else:
+            transform = SimilarityTransform()
+            if not transform.estimate(source_matched, target_matched):
+                return None
+
+
+        residuals = numpy.sqrt(((transform(source_matched) - target_matched) ** 2).sum(axis=1))
+        if (residuals < self.PIXEL_TOL).sum() < min_matches:
+            logger.info('Registration warm start failed: residuals exceed tolerance')
+            return None
+
+
+        logger.info(
+            'Registration Matches (warm start): %d, Rotation: %0.6f, Translation: (%0.6f, %0.6f), Scale: %0.6f',
+            source_matched.shape[0],
+            transform.rotation,
+            transform.translation[0], transform.translation[1],
+            transform.scale,
+        )
+
+        return transform
+
+
+    def _crop(self, image):
+        image_height, image_width = image.shape[:2]
+
+        x1 = int((image_width / 2) - (image_width / 4))
+        y1 = int((image_height / 2) - (image_height / 4))
+        x2 = int((image_width / 2) + (image_width / 4))
+        y2 = int((image_height / 2) + (image_height / 4))
+
+
+        return image[
+            y1:y2,
+            x1:x2,
+        ]
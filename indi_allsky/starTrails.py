@@ -1,4 +1,6 @@
 import os
+import io
+import json
 import cv2
 from fractions import Fraction
 import math
@@ -15,6 +17,9 @@ import ephem
 import logging
 
 from .stars import IndiAllSkyStars
+from .maskRegistry import IndiAllSkyMaskRegistry
+
+from .exceptions import TimelapseException
 
 
 logger = logging.getLogger('indi_allsky')
@@ -23,7 +28,14 @@ logger = logging.getLogger('indi_allsky')
 
 class StarTrailGenerator(object):
 
-    def __init__(self, config, bin_v, mask=None):
+    # partial star trails are built as images are captured
+    partial_folder = Path('/var/lib/indi-allsky/startrail')
+
+    # flush the trail buffer to disk every N images
+    checkpoint_interval = 10
+
+
+    def __init__(self, config, bin_v, mask=None, mask_registry=None):
         self.config = config
         self.bin_v = bin_v
 
@@ -64,18 +76,31 @@ class StarTrailGenerator(object):
 
         self.image_processing_elapsed_s = 0
 
-        self._sqm_mask = mask
+        if mask_registry:
+            self._masks = mask_registry
+        else:
+            self._masks = IndiAllSkyMaskRegistry(self.config, self.bin_v, detection_mask=mask)
 
         # this is a default image that is used in case all images are excluded
         self.placeholder_image = None
         self.placeholder_adu = 255
 
 
+        self._image_count = 0
         self._trail_count = 0
         self._timelapse_frame_count = 0
         self._timelapse_frame_list = list()
 
 
+        self._timelapse_stream = None
+        self._timelapse_stream_file = None
+        self._timelapse_stream_error = None
+
+
+        self._partial_p = None
+        self._placeholder_changed = False
+
+
         if self.config['IMAGE_FOLDER']:
             self.image_dir = Path(self.config['IMAGE_FOLDER']).absolute()
         else:
@@ -119,6 +144,14 @@ class StarTrailGenerator(object):
     def min_stars(self, new_min_stars):
         self._min_stars = int(new_min_stars)
 
+    @property
+    def image_count(self):
+        return self._image_count
+
+    @image_count.setter
+    def image_count(self, new_image_count):
+        return  # read only
+
     @property
     def trail_count(self):
         return self._trail_count
@@ -143,6 +176,14 @@ class StarTrailGenerator(object):
     def timelapse_frame_list(self, new_frame_list):
         return  # read only
 
+    @property
+    def timelapse_streaming(self):
+        return bool(self._timelapse_stream)
+
+    @timelapse_streaming.setter
+    def timelapse_streaming(self, *args):
+        return  # read only
+
     @property
     def latitude(self):
         return self._latitude
@@ -244,6 +285,13 @@ class StarTrailGenerator(object):
 
 
     def processImage(self, file_p, image, adu=None, star_count=None):
+        self._processImage(file_p, image, adu=adu, star_count=star_count)
+
+        if self._partial_p:
+            self._savePartial()
+
+
+    def _processImage(self, file_p, image, adu=None, star_count=None):
         image_processing_start = time.time()
 
         image_height, image_width = image.shape[:2]
@@ -269,11 +317,11 @@ class StarTrailGenerator(object):
             return
 
 
-        if isinstance(self._sqm_mask, type(None)):
-            self._generateSqmMask(image)
+        self._image_count += 1
+
 
         if isinstance(self._stars_detect, type(None)):
-            self._stars_detect = IndiAllSkyStars(self.config, self.bin_v, mask=self._sqm_mask)
+            self._stars_detect = IndiAllSkyStars(self.config, self.bin_v, mask_registry=self._masks)
 
 
         # need grayscale image for mask generation
@@ -284,7 +332,7 @@ class StarTrailGenerator(object):
 
 
         if isinstance(adu, type(None)):
-            m_avg = cv2.mean(image_gray, mask=self._sqm_mask)[0]
+            m_avg = cv2.mean(image_gray, mask=self._masks.mask(image_gray.shape))[0]
         else:
             m_avg = adu
 
@@ -293,6 +341,7 @@ class StarTrailGenerator(object):
             # placeholder should be the image with the lowest calculated ADU
             self.placeholder_image = image
             self.placeholder_adu = m_avg
+            self._placeholder_changed = True
 
 
         mtime_datetime_utc = datetime.fromtimestamp(file_p.stat().st_mtime).astimezone(tz=timezone.utc)
@@ -350,11 +399,20 @@ class StarTrailGenerator(object):
 
 
         ### Here is the magic
-        self.trail_image = cv2.max(self.trail_image, image)
+        if isinstance(self.trail_image, numpy.memmap):
+            # update the partial trail buffer in place
+            numpy.maximum(self.trail_image, image, out=self.trail_image)
+        else:
+            self.trail_image = cv2.max(self.trail_image, image)
 
 
         # Star trail timelapse processing
-        if self.config.get('STARTRAILS_TIMELAPSE', True):
+        if self._partial_p:
+            # the live partial only keeps the trail image, the video worker builds the frames from the source images
+            pass
+        elif self.config.get('STARTRAILS_TIMELAPSE', True) and self._timelapse_stream:
+            self._streamTimelapseFrame()
+        elif self.config.get('STARTRAILS_TIMELAPSE', True):
             image_mtime = file_p.stat().st_mtime
 
             f_tmp_frame = tempfile.NamedTemporaryFile(dir=self.timelapse_tmpdir_p, suffix='.{0:s}'.format(self.config['IMAGE_FILE_TYPE']), delete=False)
@@ -499,47 +557,270 @@ class StarTrailGenerator(object):
         outfile_p.chmod(0o644)
 
 
-    def decdeg2dms(self, dd):
-        is_positive = dd >= 0
-        dd = abs(dd)
-        minutes, seconds = divmod(dd * 3600, 60)
-        degrees, minutes = divmod(minutes, 60)
-        degrees = degrees if is_positive else -degrees
-        return degrees, minutes, seconds
+    def streamTimelapse(self, tg, video_file):
+        # trail frames are piped to ffmpeg instead of being written to temporary files
+        self._timelapse_stream = tg
+        self._timelapse_stream_file = Path(video_file)
+        self._timelapse_stream_error = None
 
 
-    def _generateSqmMask(self, img):
-        logger.info('Generating mask based on SQM_ROI')
+    def _streamTimelapseFrame(self):
+        if self._timelapse_stream_error:
+            return
 
-        image_height, image_width = img.shape[:2]
+        try:
+            if self._timelapse_frame_count == 0:
+                # ffmpeg is started with the first frame
+                self._timelapse_stream.openStream(self._timelapse_stream_file, self.trail_image.shape)
+
+            self._timelapse_stream.writeFrame(self.trail_image)
+        except TimelapseException as e:
+            logger.error('Star trail timelapse stream failed: %s', str(e))
+            self._timelapse_stream_error = str(e)
+            return
 
-        # create a black background
-        mask = numpy.zeros((image_height, image_width), dtype=numpy.uint8)
+        self._timelapse_frame_count += 1
 
-        ### Not going to use the user defined SQM_ROI for now
-        sqm_roi = self.config.get('SQM_ROI', [])
 
-        try:
-            x1 = int(sqm_roi[0] / self.bin_v.value)
-            y1 = int(sqm_roi[1] / self.bin_v.value)
-            x2 = int(sqm_roi[2] / self.bin_v.value)
-            y2 = int(sqm_roi[3] / self.bin_v.value)
-        except IndexError:
-            logger.warning('Using central ROI for ADU mask')
-            sqm_fov_div = self.config.get('SQM_FOV_DIV', 4)
-            x1 = int((image_width / 2) - (image_width / sqm_fov_div))
-            y1 = int((image_height / 2) - (image_height / sqm_fov_div))
-            x2 = int((image_width / 2) + (image_width / sqm_fov_div))
-            y2 = int((image_height / 2) + (image_height / sqm_fov_div))
-
-        # The white area is what we keep
-        cv2.rectangle(
-            img=mask,
-            pt1=(x1, y1),
-            pt2=(x2, y2),
-            color=(255),  # mono
-            thickness=cv2.FILLED,
+    def finishTimelapseStream(self):
+        if self._timelapse_stream_error:
+            raise TimelapseException(self._timelapse_stream_error)
+
+        self._timelapse_stream.closeStream()
+
+
+    def abortTimelapseStream(self):
+        if not self._timelapse_stream:
+            return
+
+        self._timelapse_stream.abortStream()
+
+
+    def setupThresholds(self, latitude, longitude):
+        # shared by the image and video workers so live and replayed star trails match
+        self.max_adu = self.config['STARTRAILS_MAX_ADU']
+        self.mask_threshold = self.config['STARTRAILS_MASK_THOLD']
+        self.pixel_cutoff_threshold = self.config['STARTRAILS_PIXEL_THOLD']
+        self.min_stars = self.config.get('STARTRAILS_MIN_STARS', 0)
+        self.latitude = latitude
+        self.longitude = longitude
+        self.sun_alt_threshold = self.config['STARTRAILS_SUN_ALT_THOLD']
+
+        if self.config['STARTRAILS_MOONMODE_THOLD']:
+            self.moonmode_alt = self.config['NIGHT_MOONMODE_ALT_DEG']
+            self.moonmode_phase = self.config['NIGHT_MOONMODE_PHASE']
+        else:
+            self.moon_alt_threshold = self.config['STARTRAILS_MOON_ALT_THOLD']
+            self.moon_phase_threshold = self.config['STARTRAILS_MOON_PHASE_THOLD']
+
+
+    def openPartial(self, partial_p, image_shape):
+        # The trail buffer is a memory mapped numpy file that is updated as images are captured
+        self._partial_p = Path(partial_p)
+
+        if self._loadPartial(self._partial_p, image_shape=image_shape, writable=True):
+            logger.info('Resuming partial star trail with %d images: %s', self._image_count, self._partial_p)
+            return
+
+
+        # start over
+        image_height, image_width = image_shape[:2]
+
+        self.original_height = image_height
+        self.original_width = image_width
+
+        self.pixels_cutoff = (image_height * image_width) * (self.pixel_cutoff_threshold / 100)
+
+
+        if not self._partial_p.parent.exists():
+            self._partial_p.parent.mkdir(mode=0o755, parents=True)
+
+
+        self.removePartial(self._partial_p)
+
+        self._partial_p = Path(partial_p)  # reset by removePartial
+
+
+        # new files are zero filled
+        self.trail_image = numpy.lib.format.open_memmap(
+            str(self._partial_p.with_suffix('.npy')),
+            mode='w+',
+            dtype=numpy.uint8,
+            shape=tuple(image_shape),
         )
 
-        self._sqm_mask = mask
+        self._savePartial(flush=True)
+
+
+    def _savePartial(self, flush=False):
+        state_p = self._partial_p.with_suffix('.json')
+        state_tmp_p = self._partial_p.with_suffix('.json_tmp')
+
+        state = {
+            'settings'              : self._partialSettings(),
+            'image_count'           : self._image_count,
+            'trail_count'           : self._trail_count,
+            'excluded_images'       : self.excluded_images,
+            'placeholder_adu'       : self.placeholder_adu,
+        }
+
+        try:
+            if flush or self._image_count % self.checkpoint_interval == 0:
+                self.trail_image.flush()
+
+
+            if self._placeholder_changed and not isinstance(self.placeholder_image, type(None)):
+                numpy.save(str(self._partialPlaceholderPath(self._partial_p)), self.placeholder_image)
+                self._placeholder_changed = False
+
+
+            # state is replaced atomically, an interrupted write leaves the previous state
+            with io.open(str(state_tmp_p), 'w') as f_state:
+                json.dump(state, f_state)
+
+            state_tmp_p.replace(state_p)
+        except OSError as e:
+            logger.error('Unable to write partial star trail: %s', str(e))
+            self._partial_p = None
+
+
+    def loadPartial(self, partial_p):
+        # load a partial star trail for finalizing
+        return self._loadPartial(partial_p)
+
+
+    def _loadPartial(self, partial_p, image_shape=None, writable=False):
+        partial_p = Path(partial_p)
+
+        state_p = partial_p.with_suffix('.json')
+        trail_p = partial_p.with_suffix('.npy')
+
+        try:
+            with io.open(str(state_p), 'r') as f_state:
+                state = json.load(f_state)
+        except FileNotFoundError:
+            return False
+        except json.JSONDecodeError:
+            logger.error('Invalid partial star trail state: %s', state_p)
+            return False
+
+
+        if state.get('settings') != self._partialSettings():
+            logger.warning('Star trail settings changed, discarding partial star trail')
+            return False
+
+
+        if writable:
+            trail_mode = 'r+'
+        else:
+            trail_mode = 'r'
+
+        try:
+            trail_image = numpy.lib.format.open_memmap(str(trail_p), mode=trail_mode)
+        except FileNotFoundError:
+            return False
+        except ValueError:
+            logger.error('Invalid partial star trail: %s', trail_p)
+            return False
+
+
+        if trail_image.dtype != numpy.uint8:
+            logger.error('Invalid partial star trail: %s', trail_p)
+            return False
+
+        if not isinstance(image_shape, type(None)):
+            if trail_image.shape != tuple(image_shape):
+                logger.warning('Image dimensions changed, discarding partial star trail')
+                return False
+
+
+        try:
+            image_count = int(state['image_count'])
+            trail_count = int(state['trail_count'])
+            excluded_images = int(state['excluded_images'])
+            placeholder_adu = float(state['placeholder_adu'])
+        except (KeyError, TypeError, ValueError):
+            logger.error('Invalid partial star trail state: %s', state_p)
+            return False
+
+
+        placeholder_p = self._partialPlaceholderPath(partial_p)
+
+        if not placeholder_p.exists():
+            placeholder_image = None
+            placeholder_adu = 255
+        elif writable:
+            # placeholder image is only needed for finalizing, a new image is saved if the adu is lower
+            placeholder_image = None
+        else:
+            try:
+                placeholder_image = numpy.load(str(placeholder_p))
+            except ValueError:
+                logger.error('Invalid partial star trail placeholder')
+                placeholder_image = None
+
+
+        image_height, image_width = trail_image.shape[:2]
+
+        self.original_height = image_height
+        self.original_width = image_width
+
+        self.pixels_cutoff = (image_height * image_width) * (self.pixel_cutoff_threshold / 100)
+
+        self.trail_image = trail_image
+        self.placeholder_image = placeholder_image
+        self.placeholder_adu = placeholder_adu
+
+        self._image_count = image_count
+        self._trail_count = trail_count
+        self.excluded_images = excluded_images
+
+
+        return True
+
+
+    def removePartial(self, partial_p):
+        partial_p = Path(partial_p)
+
+        for p in (partial_p.with_suffix('.json'), partial_p.with_suffix('.npy'), self._partialPlaceholderPath(partial_p)):
+            try:
+                p.unlink()
+            except FileNotFoundError:
+                pass
+
+        if self._partial_p == partial_p:
+            self._partial_p = None
+
+
+    def _partialSettings(self):
+        # partial data is only valid if the exclusion settings have not changed
+        return {
+            'max_adu'               : self.max_adu,
+            'mask_threshold'        : self.mask_threshold,
+            'pixel_cutoff_threshold': self.pixel_cutoff_threshold,
+            'min_stars'             : self.min_stars,
+            'sun_alt_threshold'     : self.sun_alt_threshold,
+            'moonmode_alt'          : self.moonmode_alt,
+            'moonmode_phase'        : self.moonmode_phase,
+            'moon_alt_threshold'    : self.moon_alt_threshold,
+            'moon_phase_threshold'  : self.moon_phase_threshold,
+        }
+
+
+    def _partialPlaceholderPath(self, partial_p):
+        return partial_p.parent.joinpath('{0:s}_placeholder.npy'.format(partial_p.name))
+
+
+    @classmethod
+    def partialPath(cls, camera_id, day_date):
+        return cls.partial_folder.joinpath('startrail_ccd{0:d}_{1:s}_night'.format(int(camera_id), day_date.strftime('%Y%m%d')))
+
+
+    def decdeg2dms(self, dd):
+        is_positive = dd >= 0
+        dd = abs(dd)
+        minutes, seconds = divmod(dd * 3600, 60)
+        degrees, minutes = divmod(minutes, 60)
+        degrees = degrees if is_positive else -degrees
+        return degrees, minutes, seconds
 
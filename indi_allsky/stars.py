@@ -4,6 +4,8 @@ import cv2
 import numpy
 import logging
 
+from .maskRegistry import IndiAllSkyMaskRegistry
+
 
 logger = logging.getLogger('indi_allsky')
 
@@ -13,11 +15,14 @@ class IndiAllSkyStars(object):
     _distanceThreshold = 10
 
 
-    def __init__(self, config, bin_v, mask=None):
+    def __init__(self, config, bin_v, mask=None, mask_registry=None):
         self.config = config
         self.bin_v = bin_v
 
-        self._sqm_mask = mask
+        if mask_registry:
+            self._masks = mask_registry
+        else:
+            self._masks = IndiAllSkyMaskRegistry(self.config, self.bin_v, detection_mask=mask)
 
         self._detectionThreshold = self.config.get('DETECT_STARS_THOLD', 0.6)
 
@@ -47,82 +52,120 @@ class IndiAllSkyStars(object):
 
         self.star_template_w, self.star_template_h = self.star_template.shape[::-1]
 
+        # detections closer than the distance threshold are suppressed
+        self._peak_kernel = numpy.ones(((self._distanceThreshold * 2) - 1, (self._distanceThreshold * 2) - 1), dtype=numpy.uint8)
+
 
     def detectObjects(self, original_data):
-        if isinstance(self._sqm_mask, type(None)):
-            # This only needs to be done once if a mask is not provided
-            self._generateSqmMask(original_data)
+        stars = self.detectStars(original_data)
+
+        blobs = list(zip(numpy.rint(stars['x']).astype(int).tolist(), numpy.rint(stars['y']).astype(int).tolist()))
+
+        self._drawCircles(original_data, blobs)
+
+        return blobs
+
+
+    def detectStars(self, original_data):
+        sep_start = time.time()
+
+
+        # only the area inside the mask is searched
+        x1, y1, w, h = self._masks.boundingRect(original_data.shape)
+
+        if w < self.star_template_w or h < self.star_template_h:
+            logger.warning('Star detection mask is empty')
+            return self._starData([], [], [], [])
 
-        masked_img = cv2.bitwise_and(original_data, original_data, mask=self._sqm_mask)
+
+        roi_data = original_data[y1:y1 + h, x1:x1 + w]
+        roi_mask = self._masks.mask(original_data.shape)[y1:y1 + h, x1:x1 + w]
 
         if len(original_data.shape) == 2:
             # gray scale or bayered
-            grey_img = masked_img
+            grey_img = roi_data
         else:
             # assume color
-            grey_img = cv2.cvtColor(masked_img, cv2.COLOR_BGR2GRAY)
-
+            grey_img = cv2.cvtColor(roi_data, cv2.COLOR_BGR2GRAY)
 
-        sep_start = time.time()
+        grey_img = cv2.bitwise_and(grey_img, grey_img, mask=roi_mask)
 
 
         result = cv2.matchTemplate(grey_img, self.star_template, cv2.TM_CCOEFF_NORMED)
-        result_filter = numpy.where(result >= self._detectionThreshold)
 
-        blobs = list()
-        for pt in zip(*result_filter[::-1]):
-            for blob in blobs:
-                if (abs(pt[0] - blob[0]) < self._distanceThreshold) and (abs(pt[1] - blob[1]) < self._distanceThreshold):
-                    break
+        # local maximums are the detections at least _distanceThreshold apart
+        result_max = cv2.dilate(result, self._peak_kernel)
+        peak_map = numpy.logical_and(result >= self._detectionThreshold, result >= result_max)
 
-            else:
-                # if none of the points are under the distance threshold, then add it
-                blobs.append(pt)
+        # neighboring pixels with the same value are one detection
+        _, peak_labels = cv2.connectedComponents(peak_map.astype(numpy.uint8), connectivity=8)
 
+        ry, rx = numpy.nonzero(peak_map)
+        _, first_idx = numpy.unique(peak_labels[ry, rx], return_index=True)
+        ry = ry[first_idx]
+        rx = rx[first_idx]
 
-        sep_elapsed_s = time.time() - sep_start
-        logger.info('Star detection in %0.4f s', sep_elapsed_s)
 
-        logger.info('Found %d objects', len(blobs))
+        # match positions are the top left corner of the template
+        half_w = self.star_template_w // 2
+        half_h = self.star_template_h // 2
+        cy = ry + half_h
+        cx = rx + half_w
 
-        self._drawCircles(original_data, blobs)
 
-        return blobs
+        # gather a template sized patch around every detection
+        patch_y = cy[:, None, None] + numpy.arange(-half_h, half_h + 1)[None, :, None]
+        patch_x = cx[:, None, None] + numpy.arange(-half_w, half_w + 1)[None, None, :]
+        patches = grey_img[patch_y, patch_x].astype(numpy.float32)
 
 
-    def _generateSqmMask(self, img):
-        logger.info('Generating mask based on SQM_ROI')
+        # the patch edges are the local background
+        edges = numpy.concatenate((patches[:, 0, :], patches[:, -1, :], patches[:, 1:-1, 0], patches[:, 1:-1, -1]), axis=1)
+        background = numpy.median(edges, axis=1)
 
-        image_height, image_width = img.shape[:2]
+        peak = patches.max(axis=(1, 2))
+        signal = numpy.clip(patches - background[:, None, None], 0, None)
 
-        # create a black background
-        mask = numpy.zeros((image_height, image_width), dtype=numpy.uint8)
 
-        sqm_roi = self.config.get('SQM_ROI', [])
+        # intensity weighted centroid
+        signal_sum = signal.sum(axis=(1, 2))
+        signal_sum[signal_sum == 0] = 1
 
-        try:
-            x1 = int(sqm_roi[0] / self.bin_v.value)
-            y1 = int(sqm_roi[1] / self.bin_v.value)
-            x2 = int(sqm_roi[2] / self.bin_v.value)
-            y2 = int(sqm_roi[3] / self.bin_v.value)
-        except IndexError:
-            logger.warning('Using central ROI for star detection')
-            sqm_fov_div = self.config.get('SQM_FOV_DIV', 4)
-            x1 = int((image_width / 2) - (image_width / sqm_fov_div))
-            y1 = int((image_height / 2) - (image_height / sqm_fov_div))
-            x2 = int((image_width / 2) + (image_width / sqm_fov_div))
-            y2 = int((image_height / 2) + (image_height / sqm_fov_div))
+        offset_y = (signal.sum(axis=2) * numpy.arange(-half_h, half_h + 1)).sum(axis=1) / signal_sum
+        offset_x = (signal.sum(axis=1) * numpy.arange(-half_w, half_w + 1)).sum(axis=1) / signal_sum
 
-        # The white area is what we keep
-        cv2.rectangle(
-            img=mask,
-            pt1=(x1, y1),
-            pt2=(x2, y2),
-            color=(255),  # mono
-            thickness=cv2.FILLED,
+
+        # area above half maximum is treated as a circle
+        half_max = (peak - background) / 2
+        half_max_area = (signal >= half_max[:, None, None]).sum(axis=(1, 2))
+        fwhm = 2 * numpy.sqrt(half_max_area / numpy.pi)
+
+
+        stars = self._starData(
+            x=cx + offset_x + x1,
+            y=cy + offset_y + y1,
+            peak=peak,
+            fwhm=fwhm,
         )
 
-        self._sqm_mask = mask
+
+        sep_elapsed_s = time.time() - sep_start
+        logger.info('Star detection in %0.4f s', sep_elapsed_s)
+
+        logger.info('Found %d objects', stars['x'].shape[0])
+
+        return stars
+
+
+    def _starData(self, x, y, peak, fwhm):
+        star_data = {
+            'x'    : numpy.asarray(x, dtype=numpy.float32),
+            'y'    : numpy.asarray(y, dtype=numpy.float32),
+            'peak' : numpy.asarray(peak, dtype=numpy.float32),
+            'fwhm' : numpy.asarray(fwhm, dtype=numpy.float32),
+        }
+
+        return star_data
 
 
     def _drawCircles(self, sep_data, blob_list):
@@ -136,16 +179,9 @@ class IndiAllSkyStars(object):
 
         logger.info('Draw circles around objects')
         for blob in blob_list:
-            x, y = blob
-
-            center = (
-                int(x + (self.star_template_w / 2)) + 1,
-                int(y + (self.star_template_h / 2)) + 1,
-            )
-
             cv2.circle(
                 img=sep_data,
-                center=center,
+                center=tuple(blob),
                 radius=6,
                 color=tuple(color_bgr),
                 #thickness=cv2.FILLED,
@@ -1,7 +1,6 @@
 ### Mode 1 stretch is based on C code provided by a fellow astronomy enthusiast
 
 import time
-import numpy
 import logging
 
 from .stretchBase import IndiAllSky_Stretch_Base
@@ -14,75 +13,66 @@ class IndiAllSky_Mode1_Stretch(IndiAllSky_Stretch_Base):
 
     def __init__(self, *args, **kwargs):
         super(IndiAllSky_Mode1_Stretch, self).__init__(*args, **kwargs)
-        self._sqm_mask = kwargs['mask']
-
 
         self.gamma = self.config.get('IMAGE_STRETCH', {}).get('MODE1_GAMMA', 3.0)
         self.stddevs = self.config.get('IMAGE_STRETCH', {}).get('MODE1_STDDEVS', 3.0)
 
 
-        self._numpy_mask = None
+        self._gamma_lut = dict()  # per bit depth
 
 
     def stretch(self, data, image_bit_depth):
-        if isinstance(self._numpy_mask, type(None)):
-            # This only needs to be done once
-            self._generateNumpyMask(data)
-
-
-        data = self.mode1_apply_gamma(data, image_bit_depth)
+        stretch_start = time.time()
 
-        data = self.mode1_adjustImageLevels(data, image_bit_depth)
+        gamma_lut = self.mode1_gamma_lut(image_bit_depth)
 
-        return data
 
+        # image statistics after the gamma correction
+        hist_list = self._maskHistograms(data, image_bit_depth)
 
-    def mode1_apply_gamma(self, data, image_bit_depth):
-        if not self.gamma:
-            return data
+        stats_list = [self._histogramStats(hist, lut=gamma_lut) for hist in hist_list]
+        mean = sum([x[0] for x in stats_list]) / len(stats_list)
+        stddev = sum([x[1] for x in stats_list]) / len(stats_list)
 
-        logger.info('Applying gamma correction')
+        logger.info('Mean: %0.2f, StdDev: %0.2f', mean, stddev)
 
-        gamma_start = time.time()
 
+        levels_lut = self.mode1_levels_lut(mean, stddev, image_bit_depth)
 
-        if image_bit_depth == 8:
-            numpy_dtype = numpy.uint8
+        if not isinstance(gamma_lut, type(None)):
+            # gamma and levels in one pass
+            lut = levels_lut.take(gamma_lut)
         else:
-            numpy_dtype = numpy.uint16
-
+            lut = levels_lut
 
-        data_max = (2 ** image_bit_depth) - 1
 
+        stretched_image = self._applyLut(data, lut)
 
-        range_array = numpy.arange(0, data_max + 1, dtype=numpy.float32)
-        lut = (((range_array / data_max) ** (1 / float(self.gamma))) * data_max).astype(numpy_dtype)
+        stretch_elapsed_s = time.time() - stretch_start
+        logger.info('Stretch in %0.4f s', stretch_elapsed_s)
 
+        return stretched_image
 
-        # apply lookup table
-        gamma_data = lut.take(data, mode='raise')
-
-        gamma_elapsed_s = time.time() - gamma_start
-        logger.info('Image gamma in %0.4f s', gamma_elapsed_s)
-
-        return gamma_data
 
+    def mode1_gamma_lut(self, image_bit_depth):
+        if not self.gamma:
+            return None
 
-    def mode1_adjustImageLevels(self, data, image_bit_depth):
-        mean, stddev = self._get_image_stddev(data)
-        logger.info('Mean: %0.2f, StdDev: %0.2f', mean, stddev)
+        gamma_lut = self._gamma_lut.get(image_bit_depth)
+        if not isinstance(gamma_lut, type(None)):
+            return gamma_lut
 
 
-        levels_start = time.time()
+        range_array, data_max = self._lutRange(image_bit_depth)
+        gamma_lut = (((range_array / data_max) ** (1 / float(self.gamma))) * data_max).astype(self._lutDtype(image_bit_depth))
 
+        self._gamma_lut[image_bit_depth] = gamma_lut
 
-        if image_bit_depth == 8:
-            numpy_dtype = numpy.uint8
-        else:
-            numpy_dtype = numpy.uint16
+        return gamma_lut
 
 
-        data_max = (2 ** image_bit_depth) - 1
+    def mode1_levels_lut(self, mean, stddev, image_bit_depth):
+        range_array, data_max = self._lutRange(image_bit_depth)
 
         low = int(mean - (self.stddevs * stddev))
 
@@ -93,92 +83,6 @@ class IndiAllSky_Mode1_Stretch(IndiAllSky_Stretch_Base):
         highIndex = int((highPercent / 100) * data_max)
 
 
-        range_array = numpy.arange(0, data_max + 1, dtype=numpy.float32)
         lut = (((range_array - lowIndex) * data_max) / (highIndex - lowIndex))  # floating point math, results in negative numbers
 
-        lut[lut < 0] = 0  # clip low end
-        lut[lut > data_max] = data_max  # clip high end
-
-        lut = lut.astype(numpy_dtype)  # this must come after clipping
-
-
-        # apply lookup table
-        stretched_image = lut.take(data, mode='raise')
-
-        levels_elapsed_s = time.time() - levels_start
-        logger.info('Image levels in %0.4f s', levels_elapsed_s)
-
-
-        return stretched_image
-
-
-    def _get_image_stddev(self, data):
-        mean_std_start = time.time()
-
-
-        # mask arrays allow using the detection mask to perform calculations on
-        # arbitrary boundaries in the image
-        if len(data.shape) == 2:
-            ma = numpy.ma.masked_array(data, mask=self._numpy_mask)
-
-            # mono
-            mean = numpy.ma.mean(ma)
-            stddev = numpy.ma.std(ma)
-        else:
-            # color
-            b_ma = numpy.ma.masked_array(data[:, :, 0], mask=self._numpy_mask)
-            g_ma = numpy.ma.masked_array(data[:, :, 1], mask=self._numpy_mask)
-            r_ma = numpy.ma.masked_array(data[:, :, 2], mask=self._numpy_mask)
-
-            b_mean = numpy.ma.mean(b_ma)
-            g_mean = numpy.ma.mean(g_ma)
-            r_mean = numpy.ma.mean(r_ma)
-
-            b_stddev = numpy.ma.std(b_ma)
-            g_stddev = numpy.ma.std(g_ma)
-            r_stddev = numpy.ma.std(r_ma)
-
-            mean = (b_mean + g_mean + r_mean) / 3
-            stddev = (b_stddev + g_stddev + r_stddev) / 3
-
-
-        mean_std_elapsed_s = time.time() - mean_std_start
-        logger.info('Mean and std dev in %0.4f s', mean_std_elapsed_s)
-
-        return mean, stddev
-
-
-    def _generateNumpyMask(self, img):
-        if isinstance(self._sqm_mask, type(None)):
-            logger.info('Generating mask based on SQM_ROI')
-
-            image_height, image_width = img.shape[:2]
-
-            mask = numpy.full((image_height, image_width), True, dtype=numpy.bool_)
-
-            sqm_roi = self.config.get('SQM_ROI', [])
-
-            try:
-                x1 = int(sqm_roi[0] / self.bin_v.value)
-                y1 = int(sqm_roi[1] / self.bin_v.value)
-                x2 = int(sqm_roi[2] / self.bin_v.value)
-                y2 = int(sqm_roi[3] / self.bin_v.value)
-            except IndexError:
-                logger.warning('Using central ROI for blob calculations')
-                sqm_fov_div = self.config.get('SQM_FOV_DIV', 4)
-                x1 = int((image_width / 2) - (image_width / sqm_fov_div))
-                y1 = int((image_height / 2) - (image_height / sqm_fov_div))
-                x2 = int((image_width / 2) + (image_width / sqm_fov_div))
-                y2 = int((image_height / 2) + (image_height / sqm_fov_div))
-
-
-            # True values will be masked
-            mask[y1:y2, x1:x2] = False
-
-        else:
-            # True values will be masked
-            mask = self._sqm_mask == 0
-
-
-        self._numpy_mask = mask
-
+        return self._clipLut(lut, image_bit_depth)
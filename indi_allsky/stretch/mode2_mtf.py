@@ -4,7 +4,6 @@
 ### https://siril.readthedocs.io/en/latest/processing/stretching.html
 
 import time
-import numpy
 import logging
 
 from .stretchBase import IndiAllSky_Stretch_Base
@@ -21,7 +20,7 @@ class IndiAllSky_Mode2_MTF_Stretch(IndiAllSky_Stretch_Base):
         self.midtones = self.config.get('IMAGE_STRETCH', {}).get('MODE2_MIDTONES', 0.35)
         self.highlights = self.config.get('IMAGE_STRETCH', {}).get('MODE2_HIGHLIGHTS', 1.0)
 
-        self._mtf_lut = None
+        self._mtf_lut = dict()  # per bit depth
 
 
     def stretch(self, data, image_bit_depth):
@@ -30,18 +29,12 @@ class IndiAllSky_Mode2_MTF_Stretch(IndiAllSky_Stretch_Base):
         mtf_start = time.time()
 
 
-        if isinstance(self._mtf_lut, type(None)):
-            # only need to generate the lookup table once
-            if image_bit_depth == 8:
-                numpy_dtype = numpy.uint8
-            else:
-                numpy_dtype = numpy.uint16
-
-
-            data_max = (2 ** image_bit_depth) - 1
+        lut = self._mtf_lut.get(image_bit_depth)
 
+        if isinstance(lut, type(None)):
+            # only need to generate the lookup table once
+            range_array, data_max = self._lutRange(image_bit_depth)
 
-            range_array = numpy.arange(0, data_max + 1, dtype=numpy.float32)
             shadows_val = int(self.shadows * data_max)
             highlights_val = int(self.highlights * data_max)
 
@@ -52,24 +45,17 @@ class IndiAllSky_Mode2_MTF_Stretch(IndiAllSky_Stretch_Base):
             # back to real values
             lut = lut * data_max
 
-
-            lut[lut < 0] = 0  # clip low end
-            lut[lut > data_max] = data_max  # clip high end
-
-            lut = lut.astype(numpy_dtype)  # this must come after clipping
+            lut = self._clipLut(lut, image_bit_depth)
 
             #logger.info('Min: %d, Max: %d', numpy.min(lut), numpy.max(lut))
 
-            self._mtf_lut = lut
+            self._mtf_lut[image_bit_depth] = lut
 
 
-        stretched_image = self._mtf_lut.take(data, mode='raise')
+        stretched_image = self._applyLut(data, lut)
 
 
         levels_elapsed_s = time.time() - mtf_start
         logger.info('Stretch in %0.4f s', levels_elapsed_s)
 
         return stretched_image
-
-
-
@@ -1,10 +1,86 @@
+import numpy
 import logging
 
+from ..maskRegistry import IndiAllSkyMaskRegistry
+
 logger = logging.getLogger('indi_allsky')
 
 
 class IndiAllSky_Stretch_Base(object):
+    # Stretches are applied as a single lookup table.  Image statistics are
+    # calculated from a histogram of a subsample of the pixels in the mask.
+
+    stats_subsample = 4  # every Nth pixel in the mask is sampled
+
+
     def __init__(self, *args, **kwargs):
         self.config = args[0]
         self.bin_v = args[1]
 
+        if kwargs.get('mask_registry'):
+            self._masks = kwargs['mask_registry']
+        else:
+            self._masks = IndiAllSkyMaskRegistry(self.config, self.bin_v, detection_mask=kwargs.get('mask'))
+
+
+    def _lutDtype(self, image_bit_depth):
+        if image_bit_depth == 8:
+            return numpy.uint8
+
+        return numpy.uint16
+
+
+    def _lutRange(self, image_bit_depth):
+        data_max = (2 ** image_bit_depth) - 1
+
+        return numpy.arange(0, data_max + 1, dtype=numpy.float32), data_max
+
+
+    def _clipLut(self, lut, image_bit_depth):
+        data_max = (2 ** image_bit_depth) - 1
+
+        lut[lut < 0] = 0  # clip low end
+        lut[lut > data_max] = data_max  # clip high end
+
+        return lut.astype(self._lutDtype(image_bit_depth))  # this must come after clipping
+
+
+    def _applyLut(self, data, lut):
+        return lut.take(data, mode='raise')
+
+
+    def _maskHistograms(self, data, image_bit_depth):
+        # one histogram per channel of the sampled pixels
+        mask_idx = self._masks.flatIndex(data.shape, subsample=self.stats_subsample)
+
+        lut_size = 2 ** image_bit_depth
+
+        if len(data.shape) == 2:
+            samples = data.reshape(-1)[mask_idx]
+            return [numpy.bincount(samples, minlength=lut_size)[:lut_size]]
+
+
+        samples = data.reshape(-1, data.shape[2])[mask_idx]
+
+        hist_list = list()
+        for c in range(data.shape[2]):
+            hist_list.append(numpy.bincount(samples[:, c], minlength=lut_size)[:lut_size])
+
+        return hist_list
+
+
+    def _histogramStats(self, hist, lut=None):
+        # statistics of the data after the lookup table is applied
+        if isinstance(lut, type(None)):
+            values = numpy.arange(0, hist.shape[0], dtype=numpy.float64)
+        else:
+            values = lut.astype(numpy.float64)
+
+        count = hist.sum()
+        if not count:
+            return 0.0, 0.0
+
+        mean = float((hist * values).sum() / count)
+        stddev = float(numpy.sqrt((hist * ((values - mean) ** 2)).sum() / count))
+
+        return mean, stddev
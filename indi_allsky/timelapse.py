@@ -3,6 +3,7 @@ import time
 import tempfile
 from pathlib import Path
 import subprocess
+import numpy
 import logging
 
 from .exceptions import TimelapseException
@@ -14,6 +15,10 @@ logger = logging.getLogger('indi_allsky')
 
 class TimelapseGenerator(object):
 
+    # seconds to wait for ffmpeg to finish encoding after the last streamed frame
+    stream_close_timeout = 900
+
+
     def __init__(self, config):
         self.config = config
 
@@ -29,6 +34,13 @@ class TimelapseGenerator(object):
         self._vf_scale = ''
         self._ffmpeg_extra_options = ''
 
+        self._stream_proc = None
+        self._stream_log = None
+        self._stream_file_p = None
+        self._stream_shape = None
+        self._stream_frames = 0
+        self._stream_start = 0
+
 
     @property
     def codec(self):
@@ -70,6 +82,14 @@ class TimelapseGenerator(object):
     def ffmpeg_extra_options(self, new_ffmpeg_extra_options):
         self._ffmpeg_extra_options = str(new_ffmpeg_extra_options)
 
+    @property
+    def stream_frames(self):
+        return self._stream_frames
+
+    @stream_frames.setter
+    def stream_frames(self, *args):
+        pass  # read only
+
 
     def generate(self, video_file, file_list, skip_frames=0):
         video_file_p = Path(video_file)
@@ -102,28 +122,9 @@ class TimelapseGenerator(object):
             #'-start_number', '0',
             #'-pattern_type', 'glob',
             '-i', '{0:s}/%05d.{1:s}'.format(str(self.seqfolder_p), self.config['IMAGE_FILE_TYPE']),
-            '-vcodec', '{0:s}'.format(self.codec),
-            '-b:v', '{0:s}'.format(self.bitrate),
-            #'-filter:v', 'setpts=50*PTS',
-            '-pix_fmt', 'yuv420p',
-            '-movflags', '+faststart',
         ]
 
-
-        # add scaling option if defined
-        if self.vf_scale:
-            logger.warning('Setting FFMPEG scaling option: %s', self.vf_scale)
-            cmd.append('-vf')
-            cmd.append('scale={0:s}'.format(self.vf_scale))
-
-
-        # add extra options
-        if self.ffmpeg_extra_options:
-            cmd.extend(self.ffmpeg_extra_options.split(' '))
-
-
-        # finally add filename
-        cmd.append('{0:s}'.format(str(video_file_p)))
+        cmd.extend(self._outputOptions(video_file_p))
 
         logger.info('FFmpeg command: %s', ' '.join(cmd))
 
@@ -157,3 +158,201 @@ class TimelapseGenerator(object):
         # set default permissions
         video_file_p.chmod(0o644)
 
+
+    def generateFrames(self, video_file, frame_list):
+        # encode a sequence of in-memory frames without intermediate files
+        try:
+            for frame in frame_list:
+                if not self._stream_proc:
+                    self.openStream(video_file, frame.shape)
+
+                self.writeFrame(frame)
+        except TimelapseException:
+            self.abortStream()
+            raise
+
+
+        if not self._stream_proc:
+            raise TimelapseException('No frames for timelapse')
+
+        self.closeStream()
+
+
+    def openStream(self, video_file, image_shape):
+        # Raw frames are piped directly to ffmpeg
+        self._stream_file_p = Path(video_file)
+        self._stream_shape = tuple(image_shape)
+        self._stream_frames = 0
+
+        height, width = image_shape[:2]
+
+        if len(image_shape) == 2:
+            pix_fmt = 'gray'
+        else:
+            pix_fmt = 'bgr24'
+
+
+        cmd = [
+            'ffmpeg',
+            '-y',
+            '-loglevel', 'level+warning',
+            '-f', 'rawvideo',
+            '-pix_fmt', pix_fmt,
+            '-s', '{0:d}x{1:d}'.format(width, height),
+            '-r', '{0:0.2f}'.format(self.framerate),
+            '-i', '-',
+        ]
+
+        cmd.extend(self._outputOptions(self._stream_file_p))
+
+        logger.info('FFmpeg command: %s', ' '.join(cmd))
+
+
+        # ffmpeg output is written to a file, an unread pipe would eventually block ffmpeg
+        self._stream_log = tempfile.TemporaryFile()
+
+        self._stream_start = time.time()
+
+        try:
+            self._stream_proc = subprocess.Popen(
+                cmd,
+                stdin=subprocess.PIPE,
+                stdout=self._stream_log,
+                stderr=subprocess.STDOUT,
+                preexec_fn=lambda: os.nice(19),
+            )
+        except OSError as e:
+            self._stream_log.close()
+            self._stream_log = None
+            raise TimelapseException('Unable to start FFMPEG: {0:s}'.format(str(e)))
+
+
+    def writeFrame(self, frame):
+        if not self._stream_proc:
+            raise TimelapseException('Timelapse stream not open')
+
+
+        if frame.shape != self._stream_shape:
+            logger.error('Frame with dimension mismatch, skipping')
+            return
+
+
+        if not isinstance(self._stream_proc.poll(), type(None)):
+            self._streamFailed()
+
+
+        try:
+            # writes block while ffmpeg is busy encoding
+            self._stream_proc.stdin.write(numpy.ascontiguousarray(frame).data)
+        except (BrokenPipeError, ValueError):
+            self._streamFailed()
+
+        self._stream_frames += 1
+
+
+    def closeStream(self):
+        if not self._stream_proc:
+            return
+
+        try:
+            self._stream_proc.stdin.close()
+        except BrokenPipeError:
+            pass
+
+
+        try:
+            self._stream_proc.wait(timeout=self.stream_close_timeout)
+        except subprocess.TimeoutExpired:
+            logger.error('FFMPEG timed out')
+            self._stream_proc.kill()
+            self._stream_proc.wait()
+
+
+        if self._stream_proc.returncode != 0:
+            self._streamFailed()
+
+
+        elapsed_s = time.time() - self._stream_start
+        logger.info('Timelapse generated from %d frames in %0.4f s', self._stream_frames, elapsed_s)
+
+        logger.info('FFMPEG output: %s', self._readStreamLog())
+
+        self._stream_proc = None
+
+
+        # set default permissions
+        self._stream_file_p.chmod(0o644)
+
+
+    def abortStream(self):
+        if not self._stream_proc:
+            return
+
+        self._stream_proc.kill()
+        self._stream_proc.wait()
+        self._stream_proc = None
+
+        self._readStreamLog()
+
+        if self._stream_file_p.is_file():
+            self._stream_file_p.unlink()
+
+
+    def _streamFailed(self):
+        self._stream_proc.kill()
+        returncode = self._stream_proc.wait()
+        self._stream_proc = None
+
+        elapsed_s = time.time() - self._stream_start
+
+        logger.info('FFMPEG ran for %0.4f s', elapsed_s)
+        logger.error('FFMPEG failed to generate timelapse, return code: %d', returncode)
+        logger.error('FFMPEG output: %s', self._readStreamLog())
+
+        # Check if video file was created
+        if self._stream_file_p.is_file():
+            logger.error('FFMPEG created broken video file, cleaning up')
+            self._stream_file_p.unlink()
+
+        raise TimelapseException('FFMPEG return code {0:d}'.format(returncode))
+
+
+    def _readStreamLog(self):
+        if not self._stream_log:
+            return b''
+
+        self._stream_log.seek(0)
+        output = self._stream_log.read()
+
+        self._stream_log.close()
+        self._stream_log = None
+
+        return output
+
+
+    def _outputOptions(self, video_file_p):
+        cmd = [
+            '-vcodec', '{0:s}'.format(self.codec),
+            '-b:v', '{0:s}'.format(self.bitrate),
+            #'-filter:v', 'setpts=50*PTS',
+            '-pix_fmt', 'yuv420p',
+            '-movflags', '+faststart',
+        ]
+
+
+        # add scaling option if defined
+        if self.vf_scale:
+            logger.warning('Setting FFMPEG scaling option: %s', self.vf_scale)
+            cmd.append('-vf')
+            cmd.append('scale={0:s}'.format(self.vf_scale))
+
+
+        # add extra options
+        if self.ffmpeg_extra_options:
+            cmd.extend(self.ffmpeg_extra_options.split(' '))
+
+
+        # finally add filename
+        cmd.append('{0:s}'.format(str(video_file_p)))
+
+        return cmd
@@ -0,0 +1,204 @@
+import time
+import json
+import hashlib
+import logging
+
+from .filetransfer.exceptions import ConnectionFailure
+
+
+logger = logging.getLogger('indi_allsky')
+
+
+class IndiAllSkyTransferClientPool(object):
+    # Connected file transfer clients of a single upload worker.  Clients are
+    # kept by class, endpoint and credentials and are used again until they
+    # are idle longer than idle_seconds.  Only the worker thread uses the
+    # pool, no locking is needed.
+
+    idle_seconds = 120
+
+    stats_interval = 3600
+
+
+    def __init__(self):
+        self._clients = dict()  # key: (client, last_used)
+        self._active = dict()  # id(client): (key, reused)
+
+        self._last_stats = time.time()
+        self._reset()
+
+
+    def _reset(self):
+        self._stats = {
+            'transfers'  : 0,
+            'connects'   : 0,
+            'reused'     : 0,
+            'reconnects' : 0,
+            'connect_s'  : 0.0,
+            'transfer_s' : 0.0,
+        }
+
+
+    def _key(self, client, connect_kwargs):
+        key_data = {
+            'class'           : client.__class__.__name__,
+            'delete'          : client.delete,
+            'port'            : client.port,
+            'connect_timeout' : client.connect_timeout,
+            'timeout'         : client.timeout,
+            'connect'         : connect_kwargs,
+        }
+
+        # credentials are not kept in the key
+        key_json = json.dumps(key_data, sort_keys=True, default=str)
+        return hashlib.sha256(key_json.encode()).hexdigest()
+
+
+    def connect(self, client, connect_kwargs):
+        # Returns a connected client.  The given client is only connected if
+        # there is no usable kept client.  The client is closed on errors.
+        key = self._key(client, connect_kwargs)
+
+        kept = self._clients.pop(key, None)
+        if kept:
+            kept_client = kept[0]
+
+            if kept_client.alive():
+                self._stats['reused'] += 1
+                self._active[id(kept_client)] = (key, True)
+                return kept_client
+
+            logger.warning('Kept %s connection is closed, reconnecting', kept_client.__class__.__name__)
+            self._close(kept_client)
+
+
+        start = time.time()
+
+        try:
+            client.connect(**connect_kwargs)
+        except Exception:
+            self._close(client)
+            raise
+
+        self._stats['connects'] += 1
+        self._stats['connect_s'] += time.time() - start
+
+        self._active[id(client)] = (key, False)
+
+        return client
+
+
+    def put(self, client, connect_kwargs, put_kwargs):
+        # Returns the client and the response.  A kept client that fails to
+        # connect is replaced once.  The client is closed on errors.
+        key, reused = self._active[id(client)]
+
+        start = time.time()
+
+        try:
+            response = client.put(**put_kwargs)
+        except ConnectionFailure as e:
+            if not reused:
+                self.discard(client)
+                raise
+
+            logger.warning('Kept %s connection failed, reconnecting: %s', client.__class__.__name__, str(e))
+            self.discard(client)
+
+            client = self.connect(self._newClient(client), connect_kwargs)
+            self._stats['reconnects'] += 1
+
+            start = time.time()
+
+            try:
+                response = client.put(**put_kwargs)
+            except Exception:
+                self.discard(client)
+                raise
+        except Exception:
+            self.discard(client)
+            raise
+
+
+        self._stats['transfers'] += 1
+        self._stats['transfer_s'] += time.time() - start
+
+        return client, response
+
+
+    def release(self, client):
+        # client is kept for the next transfer
+        key, reused = self._active.pop(id(client))
+
+        if not client.reusable:
+            self._close(client)
+            return
+
+        self._clients[key] = (client, time.time())
+
+
+    def discard(self, client):
+        self._active.pop(id(client), None)
+        self._close(client)
+
+
+    def expire(self):
+        # close clients that are idle
+        now = time.time()
+
+        for key in list(self._clients.keys()):
+            client, last_used = self._clients[key]
+
+            if now - last_used < self.idle_seconds:
+                continue
+
+            logger.info('Closing idle %s connection', client.__class__.__name__)
+            del self._clients[key]
+            self._close(client)
+
+
+        if now - self._last_stats > self.stats_interval:
+            self.logStats()
+
+
+    def closeAll(self):
+        for client, last_used in self._clients.values():
+            self._close(client)
+
+        self._clients.clear()
+
+
+    def logStats(self):
+        self._last_stats = time.time()
+
+        if not self._stats['transfers']:
+            return
+
+        logger.info(
+            'Transfers: %d, connects: %d (%0.4f s avg), reused: %d, reconnects: %d, transfer: %0.4f s avg',
+            self._stats['transfers'],
+            self._stats['connects'],
+            self._stats['connect_s'] / max(self._stats['connects'], 1),
+            self._stats['reused'],
+            self._stats['reconnects'],
+            self._stats['transfer_s'] / self._stats['transfers'],
+        )
+
+        self._reset()
+
+
+    def _newClient(self, client):
+        new_client = client.__class__(client.config, delete=client.delete)
+        new_client.port = client.port
+        new_client.connect_timeout = client.connect_timeout
+        new_client.timeout = client.timeout
+
+        return new_client
+
+
+    def _close(self, client):
+        try:
+            client.close()
+        except Exception as e:
+            # the connection may already be gone
+            logger.warning('Error closing %s connection: %s', client.__class__.__name__, str(e))
@@ -0,0 +1,257 @@
+import time
+import threading
+import queue
+import logging
+
+from . import constants
+
+
+logger = logging.getLogger('indi_allsky')
+
+
+class IndiAllSkyUploadScheduler(object):
+    # Upload tasks are dispatched to the upload workers by priority instead of
+    # the order they were queued.  A pending task is superseded by a newer task
+    # with the same supersede key, this keeps a slow endpoint from uploading
+    # stale "latest" images.  Archival uploads are handed out in batches of
+    # the same destination so a worker drains them over one connection.
+
+    # lower value, higher priority (same as the taskqueue table)
+    PRIORITY_LATEST   = 10
+    PRIORITY_ASSET    = 20
+    PRIORITY_ARCHIVE  = 50
+    PRIORITY_YOUTUBE  = 60
+    PRIORITY_DELETE   = 90
+
+    # maximum number of workers uploading to each destination
+    destination_limits = {
+        'filetransfer' : 1,
+        'mqtt'         : 1,
+        's3'           : 2,
+        'syncapi'      : 2,
+        'youtube'      : 1,
+    }
+
+    batch_size = 10
+
+    # models of archival assets, one upload per image
+    archive_models = (
+        'IndiAllSkyDbImageTable',
+        'IndiAllSkyDbThumbnailTable',
+        'IndiAllSkyDbFitsImageTable',
+        'IndiAllSkyDbRawImageTable',
+        'IndiAllSkyDbPanoramaImageTable',
+    )
+
+
+    def __init__(self, upload_q):
+        self.upload_q = upload_q
+
+        self._lock = threading.Lock()
+
+        self._pending = list()
+        self._supersede = dict()  # supersede key: pending message
+        self._superseded = list()  # task ids
+        self._active = dict()  # destination: batches being uploaded
+
+        self._seq = 0
+
+
+    @classmethod
+    def message(cls, task):
+        # queue message of an upload task
+        action = task.data.get('action')
+        model = task.data.get('model')
+
+
+        if action == constants.TRANSFER_UPLOAD:
+            destination = 'filetransfer'
+        elif action == constants.TRANSFER_MQTT:
+            destination = 'mqtt'
+        elif action in (constants.TRANSFER_S3, constants.DELETE_S3):
+            destination = 's3'
+        elif action == constants.TRANSFER_SYNC_V1:
+            destination = 'syncapi'
+        elif action == constants.TRANSFER_YOUTUBE:
+            destination = 'youtube'
+        else:
+            destination = None
+
+
+        supersede = None
+        if action == constants.TRANSFER_UPLOAD:
+            # the newest upload to a remote file replaces pending uploads
+            supersede = 'upload:{0:s}'.format(str(task.data.get('remote_file')))
+
+            if not model or model in cls.archive_models:
+                # latest image, metadata
+                priority = cls.PRIORITY_LATEST
+            else:
+                priority = cls.PRIORITY_ASSET
+        elif action == constants.TRANSFER_MQTT:
+            supersede = 'mqtt:{0:s}'.format(str(task.data.get('image_topic')))
+            priority = cls.PRIORITY_LATEST
+        elif action == constants.DELETE_S3:
+            priority = cls.PRIORITY_DELETE
+        elif action == constants.TRANSFER_YOUTUBE:
+            priority = cls.PRIORITY_YOUTUBE
+        elif model == 'IndiAllSkyDbCameraTable':
+            supersede = 'camera:{0}'.format(task.data.get('id'))
+            priority = cls.PRIORITY_LATEST
+        elif model in cls.archive_models:
+            priority = cls.PRIORITY_ARCHIVE
+        else:
+            # videos, keograms, star trails
+            priority = cls.PRIORITY_ASSET
+
+
+        if not isinstance(task.priority, type(None)):
+            priority = task.priority
+
+
+        message = {
+            'task_id'     : task.id,
+            'priority'    : priority,
+            'destination' : destination,
+            'supersede'   : supersede,
+        }
+
+        return message
+
+
+    def get(self, timeout=11):
+        # returns a list of messages for a single worker, empty after the timeout
+        end_time = time.time() + timeout
+
+        while True:
+            with self._lock:
+                self._drain()
+
+                message_list = self._next()
+                if message_list:
+                    return message_list
+
+
+            remaining_s = end_time - time.time()
+            if remaining_s <= 0:
+                return list()
+
+
+            # destinations are re-checked every second when other workers are uploading
+            try:
+                message = self.upload_q.get(timeout=min(remaining_s, 1.0))
+            except queue.Empty:
+                continue
+
+            with self._lock:
+                self._add(message)
+
+
+    def done(self, message_list):
+        if not message_list:
+            return
+
+        destination = message_list[0].get('destination')
+
+        with self._lock:
+            if self._active.get(destination):
+                self._active[destination] -= 1
+
+
+    def pending(self):
+        # number of messages waiting for a worker
+        with self._lock:
+            return len(self._pending) + self.upload_q.qsize()
+
+
+    def popSuperseded(self):
+        with self._lock:
+            task_id_list = self._superseded
+            self._superseded = list()
+
+        return task_id_list
+
+
+    def _drain(self):
+        while True:
+            try:
+                message = self.upload_q.get_nowait()
+            except queue.Empty:
+                return
+
+            self._add(message)
+
+
+    def _add(self, message):
+        # messages of older versions only have the task id
+        message.setdefault('priority', self.PRIORITY_ARCHIVE)
+        message.setdefault('destination', None)
+        message.setdefault('supersede', None)
+
+        self._seq += 1
+        message['seq'] = self._seq
+
+
+        supersede = message['supersede']
+        if supersede:
+            old_message = self._supersede.get(supersede)
+
+            if old_message:
+                logger.info('Upload task %d superseded by task %d', old_message['task_id'], message['task_id'])
+                self._pending.remove(old_message)
+                self._superseded.append(old_message['task_id'])
+
+            self._supersede[supersede] = message
+
+
+        self._pending.append(message)
+
+
+    def _next(self):
+        if not self._pending:
+            return list()
+
+
+        self._pending.sort(key=lambda x: (x['priority'], x['seq']))
+
+        for message in self._pending:
+            destination = message['destination']
+
+            limit = self.destination_limits.get(destination)
+            if limit and self._active.get(destination, 0) >= limit:
+                continue
+
+
+            message_list = [message]
+
+            if message['priority'] >= self.PRIORITY_ARCHIVE:
+                # archival uploads of the same destination are batched
+                for m in self._pending:
+                    if len(message_list) >= self.batch_size:
+                        break
+
+                    if m is message:
+                        continue
+
+                    if m['destination'] != destination:
+                        continue
+
+                    if m['priority'] < self.PRIORITY_ARCHIVE:
+                        continue
+
+                    message_list.append(m)
+
+
+            for m in message_list:
+                self._pending.remove(m)
+
+                if m['supersede'] and self._supersede.get(m['supersede']) is m:
+                    del self._supersede[m['supersede']]
+
+
+            self._active[destination] = self._active.get(destination, 0) + 1
+
+            return message_list
+
+
+        return list()
@@ -7,7 +7,6 @@ import logging
 
 #from multiprocessing import Process
 from threading import Thread
-import queue
 import threading
 
 from . import constants
@@ -19,6 +18,9 @@ from .flask.miscDb import miscDb
 from .flask import models
 
 from . import filetransfer
+from .transferClientPool import IndiAllSkyTransferClientPool
+from .uploadScheduler import IndiAllSkyUploadScheduler
+from .multipartState import IndiAllSkyMultipartState
 
 from sqlalchemy.orm.exc import NoResultFound
 
@@ -32,12 +34,17 @@ logger = logging.getLogger('indi_allsky')
 
 
 class FileUploader(Thread):
+
+    syncapi_batch_retry = 3600  # seconds before batches are tried again after a failure
+
+
     def __init__(
         self,
         idx,
         config,
         error_q,
         upload_q,
+        upload_scheduler,
     ):
         super(FileUploader, self).__init__()
 
@@ -49,6 +56,11 @@ class FileUploader(Thread):
 
         self.error_q = error_q
         self.upload_q = upload_q
+        self.upload_scheduler = upload_scheduler
+
+        self._client_pool = IndiAllSkyTransferClientPool()
+
+        self._syncapi_batch_time = 0
 
 
         self._stopper = threading.Event()
@@ -117,12 +129,21 @@ class FileUploader(Thread):
 
         while True:
             if self.stopped():
+                self._client_pool.closeAll()
                 logger.warning('Goodbye')
                 return
 
-            try:
-                u_dict = self.upload_q.get(timeout=11)  # prime number
-            except queue.Empty:
+            u_dict_list = self.upload_scheduler.get(timeout=11)  # prime number
+
+
+            superseded_list = self.upload_scheduler.popSuperseded()
+            if superseded_list:
+                with app.app_context():
+                    self.expireSuperseded(superseded_list)
+
+
+            if not u_dict_list:
+                self._client_pool.expire()
                 continue
 
             #if u_dict.get('stop'):
@@ -134,9 +155,46 @@ class FileUploader(Thread):
             #    return
 
 
-            # new context for every task, reduces the effects of caching
-            with app.app_context():
-                self.processUpload(u_dict)
+            try:
+                # remaining tasks are uploaded individually
+                task_u_dict_list = u_dict_list
+
+                if len(u_dict_list) > 1 and u_dict_list[0].get('destination') == 'syncapi':
+                    if self._syncapi_batch_time < time.time():
+                        with app.app_context():
+                            task_u_dict_list = self.processSyncApiBatch(u_dict_list)
+
+
+                for u_dict in task_u_dict_list:
+                    # new context for every task, reduces the effects of caching
+                    with app.app_context():
+                        self.processUpload(u_dict)
+            finally:
+                self.upload_scheduler.done(u_dict_list)
+
+
+            self._client_pool.expire()
+
+
+    def expireSuperseded(self, task_id_list):
+        superseded_tasks = models.IndiAllSkyDbTaskQueueTable.query\
+            .filter(models.IndiAllSkyDbTaskQueueTable.id.in_(task_id_list))\
+            .filter(models.IndiAllSkyDbTaskQueueTable.state == models.TaskQueueState.QUEUED)
+
+        for task in superseded_tasks:
+            if task.data.get('remove_local') and task.data.get('local_file'):
+                # temporary files are not uploaded
+                try:
+                    Path(task.data['local_file']).unlink()
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    logger.error('Cannot remove file: %s', str(e))
+
+            task.state = models.TaskQueueState.EXPIRED
+            task.result = 'Superseded'
+
+        db.session.commit()
 
 
     def processUpload(self, u_dict):
@@ -254,13 +312,16 @@ class FileUploader(Thread):
             }
 
             put_kwargs = {
-                'local_file'    : local_file_p,
-                'bucket'        : self.config['S3UPLOAD']['BUCKET'],
-                'namespace'     : self.config['S3UPLOAD'].get('NAMESPACE', ''),  # oci
-                'key'           : s3_key,
-                'storage_class' : self.config['S3UPLOAD']['STORAGE_CLASS'],
-                'acl'           : self.config['S3UPLOAD']['ACL'],
-                'metadata'      : metadata,
+                'local_file'      : local_file_p,
+                'bucket'          : self.config['S3UPLOAD']['BUCKET'],
+                'namespace'       : self.config['S3UPLOAD'].get('NAMESPACE', ''),  # oci
+                'key'             : s3_key,
+                'storage_class'   : self.config['S3UPLOAD']['STORAGE_CLASS'],
+                'acl'             : self.config['S3UPLOAD']['ACL'],
+                'metadata'        : metadata,
+                'part_size'       : int(self.config['S3UPLOAD'].get('PART_SIZE', 16) * 1024 * 1024),  # MB
+                'part_threads'    : self.config['S3UPLOAD'].get('PART_THREADS', 4),
+                'multipart_state' : IndiAllSkyMultipartState(),
             }
 
             try:
@@ -350,6 +411,12 @@ class FileUploader(Thread):
         elif action == constants.TRANSFER_SYNC_V1:
             ENDPOINT_URI = constants.ENDPOINT_V1[metadata['type']]
 
+            if entry and not self.config.get('SYNCAPI', {}).get('EMPTY_FILE'):
+                if not entry.validateFile():
+                    logger.error('File not found: %s', local_file_p)
+                    task.setFailed('File not found: {0:s}'.format(str(local_file_p)))
+                    return
+
             connect_kwargs = {
                 'hostname'     : '{0:s}/{1:s}'.format(self.config['SYNCAPI']['BASEURL'], ENDPOINT_URI),
                 'username'     : self.config['SYNCAPI']['USERNAME'],
@@ -408,10 +475,9 @@ class FileUploader(Thread):
         start = time.time()
 
         try:
-            client.connect(**connect_kwargs)
+            client = self._client_pool.connect(client, connect_kwargs)
         except filetransfer.exceptions.ConnectionFailure as e:
             logger.error('Connection failure: %s', e)
-            client.close()
             task.setFailed('Connection failure')
 
             self._miscDb.addNotification(
@@ -424,7 +490,6 @@ class FileUploader(Thread):
             return
         except filetransfer.exceptions.AuthenticationFailure as e:
             logger.error('Authentication failure: %s', e)
-            client.close()
             task.setFailed('Authentication failure')
 
             self._miscDb.addNotification(
@@ -437,7 +502,6 @@ class FileUploader(Thread):
             return
         except filetransfer.exceptions.CertificateValidationFailure as e:
             logger.error('Certificate validation failure: %s', e)
-            client.close()
             task.setFailed('Certificate validation failure')
 
             self._miscDb.addNotification(
@@ -449,12 +513,14 @@ class FileUploader(Thread):
 
             return
 
+        connect_elapsed_s = time.time() - start
+
+
         # Upload file
         try:
-            response = client.put(**put_kwargs)
+            client, response = self._client_pool.put(client, connect_kwargs, put_kwargs)
         except filetransfer.exceptions.ConnectionFailure as e:
             logger.error('Connection failure: %s', e)
-            client.close()
             task.setFailed('Connection failure')
 
             self._miscDb.addNotification(
@@ -467,7 +533,6 @@ class FileUploader(Thread):
             return
         except filetransfer.exceptions.AuthenticationFailure as e:
             logger.error('Authentication failure: %s', e)
-            client.close()
             task.setFailed('Authentication failure')
 
             self._miscDb.addNotification(
@@ -480,7 +545,6 @@ class FileUploader(Thread):
             return
         except filetransfer.exceptions.CertificateValidationFailure as e:
             logger.error('Certificate validation failure: %s', e)
-            client.close()
             task.setFailed('Certificate validation failure')
 
             self._miscDb.addNotification(
@@ -493,7 +557,6 @@ class FileUploader(Thread):
             return
         except filetransfer.exceptions.TransferFailure as e:
             logger.error('Tranfer failure: %s', e)
-            client.close()
             task.setFailed('Tranfer failure')
 
             self._miscDb.addNotification(
@@ -506,7 +569,6 @@ class FileUploader(Thread):
             return
         except filetransfer.exceptions.PermissionFailure as e:
             logger.error('Permission failure: %s', e)
-            client.close()
             task.setFailed('Permission failure')
 
             self._miscDb.addNotification(
@@ -519,11 +581,11 @@ class FileUploader(Thread):
             return
 
 
-        # close file transfer client
-        client.close()
+        # connection is kept for the next transfer
+        self._client_pool.release(client)
 
         upload_elapsed_s = time.time() - start
-        logger.info('Upload transaction completed in %0.4f s', upload_elapsed_s)
+        logger.info('Upload transaction completed in %0.4f s (connect %0.4f s)', upload_elapsed_s, connect_elapsed_s)
 
 
         task.setSuccess('File uploaded')
@@ -535,6 +597,9 @@ class FileUploader(Thread):
 
 
         if entry and action == constants.TRANSFER_S3:
+            if isinstance(entry, models.IndiAllSkyDbImageTable) and not entry.remote_url and not entry.s3_key:
+                self._miscDb.addImageCalendarRemote(entry)
+
             entry.s3_key = str(s3_key)
             db.session.commit()
 
@@ -574,6 +639,163 @@ class FileUploader(Thread):
         #raise Exception('Testing uncaught exception')
 
 
+    def processSyncApiBatch(self, u_dict_list):
+        # Sync API tasks of a scheduler batch are sent in a single request.
+        # Returns the messages of the tasks that need to be uploaded
+        # individually.
+        task_list = models.IndiAllSkyDbTaskQueueTable.query\
+            .filter(models.IndiAllSkyDbTaskQueueTable.id.in_([x['task_id'] for x in u_dict_list]))\
+            .filter(models.IndiAllSkyDbTaskQueueTable.state == models.TaskQueueState.QUEUED)\
+            .filter(models.IndiAllSkyDbTaskQueueTable.queue == models.TaskQueueQueue.UPLOAD)
+
+
+        batch_list = list()
+        for task in task_list:
+            if task.data.get('action') != constants.TRANSFER_SYNC_V1:
+                continue
+
+            if task.data.get('remove_local'):
+                continue
+
+
+            try:
+                _model = getattr(models, task.data.get('model') or '')
+            except AttributeError:
+                continue
+
+            entry = _model.query\
+                .filter(_model.id == task.data.get('id'))\
+                .first()
+
+            if not entry:
+                # the error is reported by processUpload()
+                continue
+
+            if not self.config.get('SYNCAPI', {}).get('EMPTY_FILE') and not entry.validateFile():
+                # the error is reported by processUpload()
+                continue
+
+
+            batch_list.append({
+                'task'       : task,
+                'entry'      : entry,
+                'metadata'   : task.data['metadata'],
+                'local_file' : Path(entry.getFilesystemPath()),
+            })
+
+
+        if len(batch_list) < 2:
+            return u_dict_list
+
+
+        batch_task_ids = set(x['task'].id for x in batch_list)
+        remaining_u_dict_list = [x for x in u_dict_list if x['task_id'] not in batch_task_ids]
+
+
+        connect_kwargs = {
+            'hostname'     : '{0:s}/{1:s}'.format(self.config['SYNCAPI']['BASEURL'], constants.ENDPOINT_V1_BATCH),
+            'username'     : self.config['SYNCAPI']['USERNAME'],
+            'apikey'       : self.config['SYNCAPI']['APIKEY'],
+            'cert_bypass'  : self.config['SYNCAPI']['CERT_BYPASS'],
+        }
+
+        put_kwargs = {
+            'batch'         : [{'metadata' : x['metadata'], 'local_file' : x['local_file']} for x in batch_list],
+            'empty_file'    : self.config.get('SYNCAPI', {}).get('EMPTY_FILE'),
+        }
+
+
+        client = filetransfer.requests_syncapi_v1(self.config)
+        client.connect_timeout = self.config.get('SYNCAPI', {}).get('CONNECT_TIMEOUT', 10.0)
+        client.timeout = self.config.get('SYNCAPI', {}).get('TIMEOUT', 60.0)
+
+
+        for x in batch_list:
+            x['task'].state = models.TaskQueueState.RUNNING
+
+        db.session.commit()
+
+
+        start = time.time()
+
+        try:
+            client = self._client_pool.connect(client, connect_kwargs)
+            client, result_list = self._client_pool.put(client, connect_kwargs, put_kwargs)
+        except filetransfer.exceptions.TransferFailure as e:
+            logger.warning('Sync API batch failed, uploading individually: %s', str(e))
+            self._syncapi_batch_time = time.time() + self.syncapi_batch_retry
+
+            for x in batch_list:
+                x['task'].state = models.TaskQueueState.QUEUED
+
+            db.session.commit()
+
+            return u_dict_list
+        except (
+            filetransfer.exceptions.ConnectionFailure,
+            filetransfer.exceptions.AuthenticationFailure,
+            filetransfer.exceptions.CertificateValidationFailure,
+        ) as e:
+            logger.error('Sync API batch failure: %s', str(e))
+
+            for x in batch_list:
+                x['task'].state = models.TaskQueueState.FAILED
+                x['task'].result = 'Batch failure'
+
+            db.session.commit()
+
+
+            self._miscDb.addNotification(
+                models.NotificationCategory.UPLOAD,
+                'syncapi',
+                'Sync API batch transfer failed: {0:s}'.format(str(e)),
+                expire=timedelta(hours=1),
+            )
+
+            return remaining_u_dict_list
+        except Exception as e:
+            # tasks are not left running, the errors are reported by processUpload()
+            logger.error('Unexpected Sync API batch error, uploading individually: %s', str(e))
+            for line in traceback.format_exc().split('\n'):
+                logger.error(line)
+
+            self._syncapi_batch_time = time.time() + self.syncapi_batch_retry
+
+            db.session.rollback()
+
+            for x in batch_list:
+                x['task'].state = models.TaskQueueState.QUEUED
+
+            db.session.commit()
+
+            return u_dict_list
+
+
+        # connection is kept for the next transfer
+        self._client_pool.release(client)
+
+
+        for x, result in zip(batch_list, result_list):
+            if result.get('error'):
+                logger.error('Sync API batch entry failed: %s', result['error'])
+                x['task'].state = models.TaskQueueState.FAILED
+                x['task'].result = 'Sync error: {0:s}'.format(str(result['error']))
+                continue
+
+            x['entry'].sync_id = result['id']
+            x['task'].state = models.TaskQueueState.SUCCESS
+            x['task'].result = 'File uploaded'
+
+        db.session.commit()
+
+
+        upload_elapsed_s = time.time() - start
+        logger.info('Sync API batch of %d entries completed in %0.4f s', len(batch_list), upload_elapsed_s)
+
+
+        return remaining_u_dict_list
+
+
     def _syncapi(self, asset_entry, metadata):
         ### sync camera
         if not self.config.get('SYNCAPI', {}).get('ENABLE'):
@@ -620,5 +842,5 @@ class FileUploader(Thread):
         db.session.add(upload_task)
         db.session.commit()
 
-        self.upload_q.put({'task_id' : upload_task.id})
+        self.upload_q.put(IndiAllSkyUploadScheduler.message(upload_task))
 
@@ -10,6 +10,7 @@ from datetime import timezone
 from pathlib import Path
 import psutil
 import tempfile
+import shutil
 import signal
 import traceback
 import logging
@@ -29,6 +30,8 @@ from .aurora import IndiAllskyAuroraUpdate
 from .smoke import IndiAllskySmokeUpdate
 from .satellite_download import IndiAllskyUpdateSatelliteData
 from .maskProcessing import MaskProcessor
+from .assetExpire import IndiAllSkyAssetExpire
+from .uploadScheduler import IndiAllSkyUploadScheduler
 
 from .flask import create_app
 from .flask import db
@@ -77,6 +80,8 @@ class VideoWorker(Process):
     thumbnail_startrail_width = 300
     thumbnail_mini_timelapse_width = 300
 
+    partial_expire_days = 3
+
 
     def __init__(
         self,
@@ -1144,6 +1149,27 @@ class VideoWorker(Process):
             self.config,
         )
         kg.angle = self.config['KEOGRAM_ANGLE']
+
+
+        # the keogram is built while images are captured
+        keogram_partial_p = KeogramGenerator.partialPath(camera.id, d_dayDate, night)
+
+        if kg.loadPartial(keogram_partial_p):
+            if kg.columns == image_count:
+                logger.warning('Using partial keogram: %s', keogram_partial_p)
+                keogram_partial = True
+            else:
+                logger.warning('Partial keogram contains %d of %d images, rebuilding keogram', kg.columns, image_count)
+                keogram_partial = False
+
+                kg = KeogramGenerator(
+                    self.config,
+                )
+                kg.angle = self.config['KEOGRAM_ANGLE']
+        else:
+            keogram_partial = False
+
+
         kg.h_scale_factor = self.config['KEOGRAM_H_SCALE']
         kg.v_scale_factor = self.config['KEOGRAM_V_SCALE']
         kg.crop_top = self.config.get('KEOGRAM_CROP_TOP', 0)
@@ -1237,26 +1263,68 @@ class VideoWorker(Process):
             self.bin_v,
             mask=self._detection_mask,
         )
-        stg.max_adu = self.config['STARTRAILS_MAX_ADU']
-        stg.mask_threshold = self.config['STARTRAILS_MASK_THOLD']
-        stg.pixel_cutoff_threshold = self.config['STARTRAILS_PIXEL_THOLD']
-        stg.min_stars = self.config.get('STARTRAILS_MIN_STARS', 0)
-        stg.latitude = camera.latitude
-        stg.longitude = camera.longitude
-        stg.sun_alt_threshold = self.config['STARTRAILS_SUN_ALT_THOLD']
-
-        if self.config['STARTRAILS_MOONMODE_THOLD']:
-            stg.moonmode_alt = self.config['NIGHT_MOONMODE_ALT_DEG']
-            stg.moonmode_phase = self.config['NIGHT_MOONMODE_PHASE']
+        stg.setupThresholds(camera.latitude, camera.longitude)
+
+
+        # the star trail is built while images are captured
+        startrail_partial_p = StarTrailGenerator.partialPath(camera.id, d_dayDate)
+        startrail_partial = False
+
+        if night and stg.loadPartial(startrail_partial_p):
+            if stg.image_count == image_count:
+                logger.warning('Using partial star trail: %s', startrail_partial_p)
+                startrail_partial = True
+            else:
+                logger.warning('Partial star trail contains %d of %d images, rebuilding star trail', stg.image_count, image_count)
+
+                stg = StarTrailGenerator(
+                    self.config,
+                    self.bin_v,
+                    mask=self._detection_mask,
+                )
+                stg.setupThresholds(camera.latitude, camera.longitude)
+
+
+        # generator that the night images are replayed through
+        if not night:
+            st_replay_g = None
+        elif not startrail_partial:
+            st_replay_g = stg
+        elif self.config.get('STARTRAILS_TIMELAPSE', True):
+            # the partial only contains the final star trail, the timelapse frames are built from the images
+            st_replay_g = StarTrailGenerator(
+                self.config,
+                self.bin_v,
+                mask=self._detection_mask,
+            )
+            st_replay_g.setupThresholds(camera.latitude, camera.longitude)
         else:
-            stg.moon_alt_threshold = self.config['STARTRAILS_MOON_ALT_THOLD']
-            stg.moon_phase_threshold = self.config['STARTRAILS_MOON_PHASE_THOLD']
+            st_replay_g = None
+
+
+        if night:
+            st_tg = TimelapseGenerator(self.config)
+            st_tg.codec = self.config['FFMPEG_CODEC']
+            st_tg.framerate = self.config['FFMPEG_FRAMERATE']
+            st_tg.bitrate = self.config['FFMPEG_BITRATE']
+            st_tg.vf_scale = self.config.get('FFMPEG_VFSCALE', '')
+            st_tg.ffmpeg_extra_options = self.config.get('FFMPEG_EXTRA_OPTIONS', '')
+
+            if st_replay_g and self.config.get('STARTRAILS_TIMELAPSE', True):
+                # the timelapse is encoded as the star trail is built
+                st_replay_g.streamTimelapse(st_tg, startrail_video_file)
+
 
         if self.config.get('STARTRAILS_USE_DB_DATA', True):
             logger.warning('Re-using image data for ADU and Star counts')
         else:
             logger.warning('Recalculating values for ADU and Star counts')
 
+        if keogram_partial and not st_replay_g:
+            # no need to read the images
+            files_entries = list()
+
+
         # Files are presorted from the DB
         for i, entry in enumerate(files_entries):
             if i % 100 == 0:
@@ -1289,16 +1357,17 @@ class VideoWorker(Process):
                     continue
 
 
-            kg.processImage(image_file_p, image_data)
+            if not keogram_partial:
+                kg.processImage(image_file_p, image_data)
 
-            if night:
+            if st_replay_g:
                 if self.config.get('STARTRAILS_USE_DB_DATA', True):
                     adu = entry.adu
                     star_count = entry.stars  # can be None
                 else:
                     adu, star_count = None, None
 
-                stg.processImage(image_file_p, image_data, adu=adu, star_count=star_count)
+                st_replay_g.processImage(image_file_p, image_data, adu=adu, star_count=star_count)
 
 
         kg.finalize(keogram_file, camera)
@@ -1366,7 +1435,11 @@ class VideoWorker(Process):
             )
 
 
-            st_frame_count = stg.timelapse_frame_count
+            if st_replay_g:
+                st_frame_count = st_replay_g.timelapse_frame_count
+            else:
+                st_frame_count = 0
+
             if st_frame_count >= self.config.get('STARTRAILS_TIMELAPSE_MINFRAMES', 250):
                 startrail_video_metadata['frames'] = st_frame_count  # add frame count
 
@@ -1377,14 +1450,10 @@ class VideoWorker(Process):
                 )
 
                 try:
-                    st_tg = TimelapseGenerator(self.config)
-                    st_tg.codec = self.config['FFMPEG_CODEC']
-                    st_tg.framerate = self.config['FFMPEG_FRAMERATE']
-                    st_tg.bitrate = self.config['FFMPEG_BITRATE']
-                    st_tg.vf_scale = self.config.get('FFMPEG_VFSCALE', '')
-                    st_tg.ffmpeg_extra_options = self.config.get('FFMPEG_EXTRA_OPTIONS', '')
-
-                    st_tg.generate(startrail_video_file, stg.timelapse_frame_list, skip_frames=0)
+                    if st_replay_g.timelapse_streaming:
+                        st_replay_g.finishTimelapseStream()
+                    else:
+                        st_tg.generate(startrail_video_file, st_replay_g.timelapse_frame_list, skip_frames=0)
                 except TimelapseException:
                     logger.error('Failed to generate startrails timelapse')
 
@@ -1399,6 +1468,9 @@ class VideoWorker(Process):
                     )
             else:
                 logger.error('Not enough frames to generate star trails timelapse: %d', st_frame_count)
+                if st_replay_g:
+                    st_replay_g.abortTimelapseStream()
+
                 startrail_video_entry = None
 
 
@@ -1566,7 +1638,7 @@ class VideoWorker(Process):
         db.session.add(upload_task)
         db.session.commit()
 
-        self.upload_q.put({'task_id' : upload_task.id})
+        self.upload_q.put(IndiAllSkyUploadScheduler.message(upload_task))
 
         task.setSuccess('Uploaded EndOfNight data')
 
@@ -1740,99 +1812,55 @@ class VideoWorker(Process):
             .order_by(IndiAllSkyDbPanoramaVideoTable.createDate.asc())
 
 
-        ### Getting IDs first then deleting each file is faster than deleting all files with
-        ### thumbnails with a single query.  Deleting associated thumbnails causes sqlalchemy
-        ### to recache after every delete which cause a 1-5 second lag for each delete
-
-
-        image_id_list = list()
-        for entry in old_images:
-            image_id_list.append(entry.id)
-
-        fits_id_list = list()
-        for entry in old_fits_images:
-            fits_id_list.append(entry.id)
-
-        raw_id_list = list()
-        for entry in old_raw_images:
-            raw_id_list.append(entry.id)
-
-        panorama_image_id_list = list()
-        for entry in old_panorama_images:
-            panorama_image_id_list.append(entry.id)
-
-
-        video_id_list = list()
-        for entry in old_videos:
-            video_id_list.append(entry.id)
-
-        mini_video_id_list = list()
-        for entry in old_mini_videos:
-            mini_video_id_list.append(entry.id)
-
-        keogram_id_list = list()
-        for entry in old_keograms:
-            keogram_id_list.append(entry.id)
+        asset_expire = IndiAllSkyAssetExpire(task=task)
 
-        startrail_image_id_list = list()
-        for entry in old_startrails:
-            startrail_image_id_list.append(entry.id)
+        asset_expire.expire(old_images, IndiAllSkyDbImageTable)
+        asset_expire.expire(old_fits_images, IndiAllSkyDbFitsImageTable)
+        asset_expire.expire(old_raw_images, IndiAllSkyDbRawImageTable)
+        asset_expire.expire(old_panorama_images, IndiAllSkyDbPanoramaImageTable)
+        asset_expire.expire(old_videos, IndiAllSkyDbVideoTable)
+        asset_expire.expire(old_mini_videos, IndiAllSkyDbMiniVideoTable)
+        asset_expire.expire(old_keograms, IndiAllSkyDbKeogramTable)
+        asset_expire.expire(old_startrails, IndiAllSkyDbStarTrailsTable)
+        asset_expire.expire(old_startrails_videos, IndiAllSkyDbStarTrailsVideoTable)
+        asset_expire.expire(old_panorama_videos, IndiAllSkyDbPanoramaVideoTable)
 
-        startrail_video_id_list = list()
-        for entry in old_startrails_videos:
-            startrail_video_id_list.append(entry.id)
 
-        panorama_video_id_list = list()
-        for entry in old_panorama_videos:
-            panorama_video_id_list.append(entry.id)
+        # the image viewer calendar is recounted after images are deleted
+        self._miscDb.rebuildImageCalendar(camera.id)
 
 
-        self._deleteAssets(IndiAllSkyDbImageTable, image_id_list)
-        self._deleteAssets(IndiAllSkyDbFitsImageTable, fits_id_list)
-        self._deleteAssets(IndiAllSkyDbRawImageTable, raw_id_list)
-        self._deleteAssets(IndiAllSkyDbPanoramaImageTable, panorama_image_id_list)
-        self._deleteAssets(IndiAllSkyDbVideoTable, video_id_list)
-        self._deleteAssets(IndiAllSkyDbMiniVideoTable, mini_video_id_list)
-        self._deleteAssets(IndiAllSkyDbKeogramTable, keogram_id_list)
-        self._deleteAssets(IndiAllSkyDbStarTrailsTable, startrail_image_id_list)
-        self._deleteAssets(IndiAllSkyDbStarTrailsVideoTable, startrail_video_id_list)
-        self._deleteAssets(IndiAllSkyDbPanoramaVideoTable, panorama_video_id_list)
+        self._expirePartialData()
 
 
         # Remove empty folders
-        dir_list = list()
-        self._getFolderFolders(self.image_dir, dir_list)
+        asset_expire.pruneEmptyFolders(self.image_dir)
 
-        empty_dirs = filter(lambda p: not any(p.iterdir()), dir_list)
-        for d in empty_dirs:
-            logger.info('Removing empty directory: %s', d)
 
-            try:
-                d.rmdir()
-            except OSError as e:
-                logger.error('Cannot remove folder: %s', str(e))
-            except PermissionError as e:
-                logger.error('Cannot remove folder: %s', str(e))
+        task.setSuccess('Expired {0:d} entries, {1:d} errors'.format(asset_expire.deleted, asset_expire.errors))
 
-        task.setSuccess('Expired data')
 
+    def _expirePartialData(self):
+        # remove partial keograms and star trails
+        cutoff_age = time.time() - (self.partial_expire_days * 86400)
 
-    def _deleteAssets(self, table, entry_id_list):
-        for entry_id in entry_id_list:
-            entry = table.query\
-                .filter(table.id == entry_id)\
-                .one()
+        for partial_folder in (KeogramGenerator.partial_folder, StarTrailGenerator.partial_folder):
+            if not partial_folder.exists():
+                continue
 
-            logger.info('Removing old %s entry: %s', entry.__class__.__name__, entry.filename)
+            for item in partial_folder.iterdir():
+                if item.stat().st_mtime > cutoff_age:
+                    continue
 
-            try:
-                entry.deleteAsset()
-            except OSError as e:
-                logger.error('Cannot remove file: %s', str(e))
-                continue
+                logger.info('Removing old partial data: %s', item)
 
-            db.session.delete(entry)
-            db.session.commit()
+                try:
+                    if item.is_dir():
+                        shutil.rmtree(str(item))
+                    else:
+                        item.unlink()
+                except OSError as e:
+                    logger.error('Cannot remove file: %s', str(e))
 
 
     def _getVideoFolder(self, video_date, camera):
@@ -1866,13 +1894,6 @@ class VideoWorker(Process):
                 self._getFolderFilesByExt(item, file_list, extension_list=extension_list)  # recursion
 
 
-    def _getFolderFolders(self, folder, dir_list):
-        for item in Path(folder).iterdir():
-            if item.is_dir():
-                dir_list.append(item)
-                self._getFolderFolders(item, dir_list)  # recursion
-
-
     def _load_detection_mask(self):
         detect_mask = self.config.get('DETECT_MASK', '')
 
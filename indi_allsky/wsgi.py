@@ -3,12 +3,12 @@
 # This file is monitored for changes via inotify
 # Updates should restart gunicorn automatically
 #
-# Version 00023
+# Version 00024
 #
 import logging
 
 from indi_allsky.flask import create_app
-application = create_app()
+application = create_app(role='web')
 
 gunicorn_logger = logging.getLogger('gunicorn.error')
 application.logger.handlers = gunicorn_logger.handlers
@@ -13,16 +13,23 @@ import signal
 import logging
 
 from sqlalchemy.sql.expression import null as sa_null
+from sqlalchemy.orm.exc import NoResultFound
+from sqlalchemy import func
 
 sys.path.append(str(Path(__file__).parent.absolute().parent))
 
+from indi_allsky.flask.models import IndiAllSkyDbCameraTable
 from indi_allsky.flask.models import IndiAllSkyDbImageTable
+from indi_allsky.flask.models import IndiAllSkyDbImageCalendarTable
+from indi_allsky.flask.models import IndiAllSkyDbChartTable
 from indi_allsky.flask.models import IndiAllSkyDbPanoramaImageTable
 from indi_allsky.flask.models import IndiAllSkyDbVideoTable
 from indi_allsky.flask.models import IndiAllSkyDbMiniVideoTable
 
+from indi_allsky.config import IndiAllSkyConfig
 from indi_allsky.flask import create_app
 from indi_allsky.flask import db
+from indi_allsky.flask.miscDb import miscDb
 
 
 # setup flask context for db access
@@ -78,11 +85,50 @@ class PopulateData(object):
             .count()
 
 
+        # cameras with images that do not have an image calendar
+        calendar_camera_list = list()
+        for camera in IndiAllSkyDbCameraTable.query:
+            calendar_entry = IndiAllSkyDbImageCalendarTable.query\
+                .filter(IndiAllSkyDbImageCalendarTable.camera_id == camera.id)\
+                .first()
+
+            if calendar_entry:
+                continue
+
+            image_entry = IndiAllSkyDbImageTable.query\
+                .filter(IndiAllSkyDbImageTable.camera_id == camera.id)\
+                .first()
+
+            if image_entry:
+                calendar_camera_list.append(camera.id)
+
+
+        # cameras with images older than the chart entries
+        chart_camera_list = list()
+        for camera in IndiAllSkyDbCameraTable.query:
+            chart_start = db.session.query(
+                func.min(IndiAllSkyDbChartTable.createDate)
+            )\
+                .filter(IndiAllSkyDbChartTable.camera_id == camera.id)\
+                .scalar()
+
+            image_query = IndiAllSkyDbImageTable.query\
+                .filter(IndiAllSkyDbImageTable.camera_id == camera.id)
+
+            if chart_start:
+                image_query = image_query.filter(IndiAllSkyDbImageTable.createDate < chart_start)
+
+            if image_query.first():
+                chart_camera_list.append(camera.id)
+
+
         print()
         print('Image entries to fix: {0:d}'.format(image_count))
         print('Panorama Image entries to fix: {0:d}'.format(panorama_image_count))
         print('Timelapse entries to fix: {0:d}'.format(video_count))
         print('Mini Timelapse entries to fix: {0:d}'.format(mini_video_count))
+        print('Image calendars to build: {0:d}'.format(len(calendar_camera_list)))
+        print('Charts to build: {0:d}'.format(len(chart_camera_list)))
         print()
 
 
@@ -90,6 +136,8 @@ class PopulateData(object):
         total_count += panorama_image_count
         total_count += video_count
         total_count += mini_video_count
+        total_count += len(calendar_camera_list)
+        total_count += len(chart_camera_list)
 
         if total_count == 0:
             print('No updates needed')
@@ -235,6 +283,28 @@ class PopulateData(object):
                 sys.exit(1)
 
 
+        ### image calendar, after the image createDate values are populated
+        logger.warning('Building image calendars...')
+        for camera_id in calendar_camera_list:
+            miscDb({}).rebuildImageCalendar(camera_id)
+
+
+        ### charts, the custom chart values depend on the config
+        if chart_camera_list:
+            try:
+                config = IndiAllSkyConfig().config
+            except NoResultFound:
+                config = dict()
+
+            logger.warning('Building charts...')
+            for camera_id in chart_camera_list:
+                miscDb(config).rebuildChartRollup(camera_id)
+
+
+                if self._shutdown:
+                    sys.exit(1)
+
+
         elapsed_s = time.time() - start
         logger.info('Entries fixed in %0.4f s', elapsed_s)
 
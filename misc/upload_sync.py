@@ -45,6 +45,7 @@ from indi_allsky import constants
 from indi_allsky.config import IndiAllSkyConfig
 from indi_allsky.flask import create_app
 from indi_allsky.miscUpload import miscUpload
+from indi_allsky.uploadScheduler import IndiAllSkyUploadScheduler
 
 
 logger = logging.getLogger('indi_allsky')
@@ -84,6 +85,7 @@ class UploadSync(object):
 
 
         self.upload_q = Queue()
+        self.upload_scheduler = IndiAllSkyUploadScheduler(self.upload_q)
         self.upload_worker_list = []
         self.upload_worker_idx = 0
 
@@ -208,7 +210,7 @@ class UploadSync(object):
                 sys.exit()
 
 
-            if self.upload_q.qsize() == 0:
+            if self.upload_scheduler.pending() == 0:
                 with app.app_context():
                     try:
                         self.addUploadEntries(upload_list)
@@ -1163,6 +1165,7 @@ class UploadSync(object):
             self.config,
             uw_dict['error_q'],
             self.upload_q,
+            self.upload_scheduler,
         )
 
         uw_dict['worker'].start()
@@ -1,3 +1,3 @@
 # Phusion Passenger interface
 from indi_allsky.flask import create_app
-application = create_app()
+application = create_app(role='web')
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+#
+# Multipart upload and resume of the boto3_s3 client against the moto S3 mock
+#
+# The first upload is interrupted after a number of parts, the second upload
+# continues with the missing parts.  The uploaded object is compared with the
+# local file.
+#
+
+import sys
+import io
+import hashlib
+import tempfile
+import argparse
+from pathlib import Path
+import logging
+
+sys.path.append(str(Path(__file__).parent.absolute().parent))
+
+import boto3
+from moto import mock_aws
+
+from indi_allsky.filetransfer import boto3_s3
+from indi_allsky.filetransfer.exceptions import ConnectionFailure
+from indi_allsky.filetransfer.multipart import MultipartState
+
+
+LOG_FORMATTER_STREAM = logging.Formatter('%(asctime)s [%(levelname)s] %(threadName)s: %(message)s')
+LOG_HANDLER_STREAM = logging.StreamHandler()
+LOG_HANDLER_STREAM.setFormatter(LOG_FORMATTER_STREAM)
+
+
+logger = logging.getLogger('indi_allsky')
+logger.handlers.clear()
+logger.addHandler(LOG_HANDLER_STREAM)
+logger.setLevel(logging.INFO)
+
+
+class S3MultipartTest(object):
+
+    bucket = 'indi-allsky-test'
+    region = 'us-east-1'
+
+
+    def __init__(self, size, part_size, threads, interrupt):
+        self.size = int(size)
+        self.part_size = int(part_size)
+        self.threads = int(threads)
+        self.interrupt = int(interrupt)
+
+        self.state = MultipartState()
+
+
+    def main(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            local_file_p = Path(tmp_dir).joinpath('timelapse.mp4')
+
+            with io.open(str(local_file_p), 'wb') as f_local:
+                f_local.write(self._fileData(self.size * 1024 * 1024))
+
+
+            with mock_aws():
+                s3 = boto3.client('s3', region_name=self.region)
+                s3.create_bucket(Bucket=self.bucket)
+
+
+                try:
+                    self._upload(local_file_p, interrupt=self.interrupt)
+                    logger.error('Upload was not interrupted')
+                    sys.exit(1)
+                except ConnectionFailure as e:
+                    logger.warning('Upload interrupted: %s', str(e))
+
+
+                self._upload(local_file_p)
+
+
+                obj = s3.get_object(Bucket=self.bucket, Key='videos/timelapse.mp4')
+                remote_md5 = hashlib.md5(obj['Body'].read()).hexdigest()
+
+                with io.open(str(local_file_p), 'rb') as f_local:
+                    local_md5 = hashlib.md5(f_local.read()).hexdigest()
+
+
+                if remote_md5 != local_md5:
+                    logger.error('Checksum mismatch: %s != %s', remote_md5, local_md5)
+                    sys.exit(1)
+
+
+                logger.warning('Checksum match: %s', local_md5)
+
+
+    def _upload(self, local_file_p, interrupt=None):
+        client = boto3_s3({})
+        client.connect(
+            hostname='amazonaws.com',
+            username='*',
+            access_key='testing',
+            secret_key='testing',
+            region=self.region,
+            tls=True,
+            cert_bypass=False,
+        )
+
+
+        if not isinstance(interrupt, type(None)):
+            # fail every part after the first parts, the upload state is kept
+            multipartPart = client.multipartPart
+
+            def interruptedPart(upload_id, part_number, data, **kwargs):
+                if part_number > interrupt:
+                    raise ConnectionFailure('Interrupted part {0:d}'.format(part_number))
+
+                return multipartPart(upload_id, part_number, data, **kwargs)
+
+            client.multipartPart = interruptedPart
+
+
+        try:
+            client.put(
+                local_file=local_file_p,
+                bucket=self.bucket,
+                key='videos/timelapse.mp4',
+                storage_class='STANDARD',
+                acl='',
+                metadata={},
+                part_size=self.part_size * 1024 * 1024,
+                part_threads=self.threads,
+                multipart_state=self.state,
+            )
+        finally:
+            client.close()
+
+
+    def _fileData(self, size):
+        # repeating block, generating large files is fast
+        block = hashlib.sha256(b'indi-allsky').digest() * 32768
+        count, remainder = divmod(size, len(block))
+        return block * count + block[:remainder]
+
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument(
+        '--size',
+        '-s',
+        help='file size (MB)',
+        type=int,
+        default=64,
+    )
+    argparser.add_argument(
+        '--part_size',
+        '-p',
+        help='part size (MB)',
+        type=int,
+        default=5,
+    )
+    argparser.add_argument(
+        '--threads',
+        '-t',
+        help='part threads',
+        type=int,
+        default=4,
+    )
+    argparser.add_argument(
+        '--interrupt',
+        '-i',
+        help='parts uploaded before the interruption',
+        type=int,
+        default=5,
+    )
+
+
+    args = argparser.parse_args()
+
+    smt = S3MultipartTest(args.size, args.part_size, args.threads, args.interrupt)
+    smt.main()
@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+#
+# Insert and query latency of the image table with a synthetic data set
+#
+# A separate SQLite database is created, the indi-allsky database is not used.
+# Run once with --legacy to recreate the single column indexes that were
+# removed and compare.
+#
+
+import sys
+import time
+import random
+import argparse
+from pathlib import Path
+from datetime import datetime
+from datetime import timedelta
+import logging
+
+sys.path.append(str(Path(__file__).parent.absolute().parent))
+
+from sqlalchemy import create_engine
+from sqlalchemy import event
+from sqlalchemy import select
+from sqlalchemy import text
+from sqlalchemy import and_
+
+from indi_allsky.flask import db
+from indi_allsky.flask.models import IndiAllSkyDbCameraTable
+from indi_allsky.flask.models import IndiAllSkyDbImageTable
+
+
+LOG_FORMATTER_STREAM = logging.Formatter('%(asctime)s [%(levelname)s] %(processName)s: %(message)s')
+LOG_HANDLER_STREAM = logging.StreamHandler()
+LOG_HANDLER_STREAM.setFormatter(LOG_FORMATTER_STREAM)
+
+
+logger = logging.getLogger('indi_allsky')
+logger.handlers.clear()
+logger.addHandler(LOG_HANDLER_STREAM)
+logger.setLevel(logging.INFO)
+
+
+class SqlIndexBench(object):
+
+    # single column indexes removed from the image table
+    legacy_index_columns = (
+        'createDate_year',
+        'createDate_month',
+        'createDate_day',
+        'createDate_hour',
+        'night',
+        'detections',
+        'kpindex',
+        'ovation_max',
+        'smoke_rating',
+        'data',
+        'exclude',
+        'width',
+        'height',
+    )
+
+    exposure_period = 15
+
+    insert_chunk = 50000
+
+    insert_rounds = 200
+    query_rounds = 20
+
+
+    def __init__(self, database, rows, legacy=False):
+        self.database = Path(database)
+        self.rows = int(rows)
+        self.legacy = legacy
+
+        self._engine = None
+        self._camera_id = None
+        self._first_date = None
+        self._last_date = None
+
+
+    def main(self):
+        if self.database.exists():
+            logger.error('Database %s already exists', self.database)
+            sys.exit(1)
+
+
+        self._engine = create_engine('sqlite:///{0:s}'.format(str(self.database)))
+        event.listen(self._engine, 'connect', self._sqlite_pragma_on_connect)
+
+        db.metadata.create_all(self._engine)
+
+        if self.legacy:
+            self._createLegacyIndexes()
+
+
+        self._populate()
+
+        with self._engine.connect() as conn:
+            conn.execute(text('ANALYZE'))
+            conn.commit()
+
+
+        self._insertLatency()
+        self._queryLatency()
+
+
+    def _sqlite_pragma_on_connect(self, dbapi_con, con_record):
+        dbapi_con.execute('PRAGMA journal_mode=WAL')
+        dbapi_con.execute('PRAGMA synchronous=NORMAL')
+        dbapi_con.execute('PRAGMA busy_timeout=20000')
+
+
+    def _createLegacyIndexes(self):
+        logger.warning('Creating legacy indexes')
+
+        with self._engine.connect() as conn:
+            for col in self.legacy_index_columns:
+                conn.execute(text('CREATE INDEX ix_legacy_image_{0:s} ON image ({0:s})'.format(col)))
+
+            conn.commit()
+
+
+    def _imageRow(self, i, createDate):
+        # createDate_* values are normally populated by misc/populate_data.py for older entries
+        night = createDate.hour >= 18 or createDate.hour < 6
+
+        if createDate.hour < 12:
+            dayDate = (createDate - timedelta(days=1)).date()
+        else:
+            dayDate = createDate.date()
+
+
+        row = {
+            'camera_id'        : self._camera_id,
+            'filename'         : 'images/ccd_bench/{0:s}/image_{1:d}.jpg'.format(dayDate.strftime('%Y%m%d'), i),
+            'createDate'       : createDate,
+            'createDate_year'  : createDate.year,
+            'createDate_month' : createDate.month,
+            'createDate_day'   : createDate.day,
+            'createDate_hour'  : createDate.hour,
+            'dayDate'          : dayDate,
+            'exposure'         : random.uniform(0.0001, 15.0),
+            'gain'             : 100,
+            'binmode'          : 1,
+            'temp'             : random.uniform(-10.0, 30.0),
+            'night'            : night,
+            'adu'              : random.uniform(20.0, 120.0),
+            'stable'           : True,
+            'moonmode'         : False,
+            'adu_roi'          : False,
+            'sqm'              : random.uniform(1000.0, 50000.0),
+            'stars'            : random.randint(0, 500),
+            'calibrated'       : True,
+            'detections'       : int(random.random() < 0.01),
+            'kpindex'          : random.uniform(0.0, 9.0),
+            'ovation_max'      : random.randint(0, 100),
+            'smoke_rating'     : random.randint(0, 5),
+            'exclude'          : False,
+            'width'            : 1920,
+            'height'           : 1080,
+            'data'             : {'sensor_temp_0' : 0.0, 'sensor_user_0' : 0.0},
+        }
+
+        return row
+
+
+    def _populate(self):
+        with self._engine.connect() as conn:
+            result = conn.execute(IndiAllSkyDbCameraTable.__table__.insert().values(name='Bench', uuid='00000000-0000-0000-0000-000000000000'))
+            self._camera_id = result.inserted_primary_key[0]
+            conn.commit()
+
+
+        self._last_date = datetime.now().replace(microsecond=0)
+        self._first_date = self._last_date - timedelta(seconds=self.rows * self.exposure_period)
+
+
+        logger.warning('Populating %d rows', self.rows)
+        start = time.time()
+
+        image_table = IndiAllSkyDbImageTable.__table__
+
+        with self._engine.connect() as conn:
+            row_list = list()
+            for i in range(self.rows):
+                createDate = self._first_date + timedelta(seconds=i * self.exposure_period)
+                row_list.append(self._imageRow(i, createDate))
+
+                if len(row_list) >= self.insert_chunk:
+                    conn.execute(image_table.insert(), row_list)
+                    conn.commit()
+                    row_list.clear()
+
+                    logger.info(' %d rows', i + 1)
+
+            if row_list:
+                conn.execute(image_table.insert(), row_list)
+                conn.commit()
+
+
+        elapsed_s = time.time() - start
+        logger.info('Populated in %0.4f s', elapsed_s)
+
+
+    def _insertLatency(self):
+        # single row inserts, one commit each, like addImage()
+        image_table = IndiAllSkyDbImageTable.__table__
+
+        elapsed_list = list()
+        with self._engine.connect() as conn:
+            for i in range(self.insert_rounds):
+                createDate = self._last_date + timedelta(seconds=(i + 1) * self.exposure_period)
+                row = self._imageRow(self.rows + i, createDate)
+
+                start = time.time()
+                conn.execute(image_table.insert(), row)
+                conn.commit()
+                elapsed_list.append(time.time() - start)
+
+
+        elapsed_list.sort()
+        logger.warning(
+            'Insert latency: avg %0.2f ms, median %0.2f ms, max %0.2f ms',
+            1000 * sum(elapsed_list) / len(elapsed_list),
+            1000 * elapsed_list[int(len(elapsed_list) / 2)],
+            1000 * elapsed_list[-1],
+        )
+
+
+    def _queryLatency(self):
+        image_table = IndiAllSkyDbImageTable.__table__
+
+        now = self._last_date
+        day_date = (now - timedelta(days=2)).date()
+        day_dt = now - timedelta(days=2)
+
+
+        query_dict = {
+            'latest image' : select(image_table.c.id, image_table.c.filename)\
+                .where(
+                    and_(
+                        image_table.c.camera_id == self._camera_id,
+                        image_table.c.createDate > now - timedelta(seconds=900),
+                    )
+                )\
+                .order_by(image_table.c.createDate.desc())\
+                .limit(1),
+            'createDate range' : select(image_table.c.id, image_table.c.filename)\
+                .where(
+                    and_(
+                        image_table.c.camera_id == self._camera_id,
+                        image_table.c.createDate > now - timedelta(seconds=3600),
+                        image_table.c.createDate < now,
+                    )
+                )\
+                .order_by(image_table.c.createDate.desc()),
+            'timelapse day' : select(image_table.c.id, image_table.c.filename)\
+                .where(
+                    and_(
+                        image_table.c.camera_id == self._camera_id,
+                        image_table.c.dayDate == day_date,
+                        image_table.c.night == True,  # noqa: E712
+                        image_table.c.exclude == False,  # noqa: E712
+                    )
+                )\
+                .order_by(image_table.c.createDate.asc()),
+            'calendar hours' : select(image_table.c.createDate_hour)\
+                .where(
+                    and_(
+                        image_table.c.camera_id == self._camera_id,
+                        image_table.c.detections >= 0,
+                        image_table.c.createDate_year == day_dt.year,
+                        image_table.c.createDate_month == day_dt.month,
+                        image_table.c.createDate_day == day_dt.day,
+                    )
+                )\
+                .distinct()\
+                .order_by(image_table.c.createDate_hour.desc()),
+        }
+
+
+        with self._engine.connect() as conn:
+            for name, query in query_dict.items():
+                query_sql = str(query.compile(self._engine, compile_kwargs={'literal_binds' : True}))
+
+                plan = conn.execute(text('EXPLAIN QUERY PLAN {0:s}'.format(query_sql))).fetchall()
+                for p in plan:
+                    logger.info('%s plan: %s', name, p[-1])
+
+
+                elapsed_list = list()
+                for i in range(self.query_rounds):
+                    start = time.time()
+                    rows = conn.execute(query).fetchall()
+                    elapsed_list.append(time.time() - start)
+
+
+                elapsed_list.sort()
+                logger.warning(
+                    '%s: %d rows, median %0.2f ms, max %0.2f ms',
+                    name,
+                    len(rows),
+                    1000 * elapsed_list[int(len(elapsed_list) / 2)],
+                    1000 * elapsed_list[-1],
+                )
+
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument(
+        '--database',
+        '-d',
+        help='database file to create',
+        type=str,
+        default='/tmp/indi_allsky_bench.sqlite',
+    )
+    argparser.add_argument(
+        '--rows',
+        '-r',
+        help='image rows',
+        type=int,
+        default=2000000,
+    )
+    argparser.add_argument(
+        '--legacy',
+        help='create the removed single column indexes',
+        action='store_true',
+    )
+
+
+    args = argparser.parse_args()
+
+    sib = SqlIndexBench(args.database, args.rows, legacy=args.legacy)
+    sib.main()